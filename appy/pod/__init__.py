@@ -84,6 +84,13 @@ class PodError(Exception):
                 buffer.write('</%s>' % subTag.elem)
             buffer.write('</%s>' % withinElement.OD.elem)
 
+# ------------------------------------------------------------------------------
+class RenderingCancelled(BaseException):
+    '''Raised when a rendering is cancelled (see Renderer.cancel). Like
+       asyncio.CancelledError, it does not inherit from Exception: it must not
+       be caught and dumped into the result like errors raised by expressions
+       or statements.'''
+
 # XXX To remove, present for backward compatibility only
 convertToXhtml = escapeXhtml
 # ------------------------------------------------------------------------------
@@ -16,7 +16,7 @@
 
 # ------------------------------------------------------------------------------
 from appy import Object
-from appy.pod import PodError
+from appy.pod import PodError, RenderingCancelled
 from appy.shared.utils import Traceback
 from appy.pod.elements import *
 
@@ -47,9 +47,16 @@ class BufferAction:
         # content. If 'from', we must dump what comes from the 'from' part of
         # the action (='fromExpr')
         self.fromExpr = fromExpr
+        # Compiled expressions, as a dict ~{s_expr: (code, errorCode)}~.
+        # self.expr and self.fromExpr are compiled once for all, at parse time.
+        self.codes = {}
+        if expr: self.getCode(expr)
+        if fromExpr: self.getCode(fromExpr)
         # Several actions may co-exist for the same buffer, as a chain of
         # BufferAction instances, defined via the following attribute.
         self.subAction = None
+        # The statement and its location in the template, used for profiling
+        self.label = None
 
     def getExceptionLine(self, e):
         '''Gets the line describing exception p_e, containing the exception
@@ -59,7 +66,7 @@ class BufferAction:
     def manageError(self, result, context, errorMessage):
         '''Manage the encountered error: dump it into the buffer or raise an
            exception.'''
-        if self.buffer.env.raiseOnError:
+        if result.state.raiseOnError:
             if not self.buffer.pod:
                 # Add in the error message the line nb where the errors occurs
                 # within the PX.
@@ -81,18 +88,33 @@ class BufferAction:
         PodError.dump(tempBuffer, errorMessage, withinElement=self.elem)
         tempBuffer.evaluate(result, context)
 
+    def getCode(self, expr):
+        '''Returns a tuple (code, errorCode) containing the compiled versions
+           of p_expr, that can contain an error expr, in the form
+           "someExpr|errorExpr". If there is no error expr, errorCode is
+           None.'''
+        res = self.codes.get(expr)
+        if not res:
+            if '|' not in expr:
+                res = compileExpression(expr), None
+            else:
+                expr_, errorExpr = expr.rsplit('|', 1)
+                res = compileExpression(expr_), compileExpression(errorExpr)
+            self.codes[expr] = res
+        return res
+
     def _evalExpr(self, expr, context):
         '''Evaluates p_expr with p_context. p_expr can contain an error expr,
            in the form "someExpr|errorExpr". If it is the case, if the "normal"
            expr raises an error, the "error" expr is evaluated instead.'''
-        if '|' not in expr:
-            res = eval(expr, context)
+        code, errorCode = self.getCode(expr)
+        if errorCode is None:
+            res = eval(code, context)
         else:
-            expr, errorExpr = expr.rsplit('|', 1)
             try:
-                res = eval(expr, context)
+                res = eval(code, context)
             except Exception:
-                res = eval(errorExpr, context)
+                res = eval(errorCode, context)
         return res
 
     def evaluateExpression(self, result, context, expr):
@@ -111,6 +133,18 @@ class BufferAction:
     def execute(self, result, context):
         '''Executes this action given some p_context and add the result to
            p_result.'''
+        state = result.state
+        if state.cancelled and state.cancelled.is_set():
+            raise RenderingCancelled()
+        profiler = state.profiler
+        if not profiler: return self._execute(result, context)
+        profiler.start('statement', self.label or self.__class__.__name__)
+        try:
+            self._execute(result, context)
+        finally:
+            profiler.stop()
+
+    def _execute(self, result, context):
         # Check that if minus is set, we have an element which can accept it
         if self.minus and isinstance(self.elem, Table) and \
            (not self.elem.tableInfo.isOneCell()):
@@ -133,7 +167,7 @@ class BufferAction:
             feRes = None
             error = False
             try:
-                feRes = eval(self.fromExpr, context)
+                feRes = eval(self.getCode(self.fromExpr)[0], context)
             except Exception as e:
                 msg = FROM_EVAL_ERROR% (self.fromExpr, self.getExceptionLine(e))
                 self.manageError(result, context, msg)
@@ -260,10 +294,18 @@ class ForAction(BufferAction):
             # number of cells for the current row.
             if not elems:
                 result.dumpElement(Cell.OD.elem)
+        # In the case of rows from a spreadsheet, identical consecutive rows are
+        # compressed: rows are dumped, one at a time, into a RowsBuffer.
+        rows = None
+        if isinstance(self.elem, Row) and self.buffer.env.compressRows:
+            from appy.pod.buffers import RowsBuffer
+            rows = result = RowsBuffer(self.buffer.env, result)
         # Enter the "for" loop
         loop, outerLoop = self.initialiseLoop(context, elems)
+        cancelled = result.state.cancelled
         i = -1
         for item in elems:
+            if cancelled and cancelled.is_set(): raise RenderingCancelled()
             i += 1
             loop.nb = i
             loop.first = i == 0
@@ -285,6 +327,9 @@ class ForAction(BufferAction):
             # Cell: increment the current column index
             if isCell:
                 currentColIndex += 1
+            elif rows:
+                rows.endRow()
+        if rows: rows.flush()
         # Cell: leave the last row with the correct number of cells, excepted
         # if the user has specified himself "columnsRepeated": it is his
         # responsibility to produce the correct number of cells.
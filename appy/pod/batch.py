@@ -0,0 +1,158 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import io, time, multiprocessing
+from appy.shared.utils import Traceback
+from appy.pod.renderer import Renderer
+from appy.pod.template import templateCache
+
+# ------------------------------------------------------------------------------
+BAD_RESULT_NAMING = 'Result naming must be None, a string containing "%d" or ' \
+                    'a function.'
+CACHE_TEMPLATE_OPTION = 'Option "cacheTemplate" can\'t be given: a batch ' \
+                        'always caches its template.'
+
+# Within a worker process, the template and renderer options of the batch
+worker = {}
+
+def compileTemplate(template):
+    '''Compiles p_template (a path or bytes) into the template cache of the
+       current process, if it is not there yet.'''
+    if isinstance(template, bytes): template = io.BytesIO(template)
+    templateCache.get(template)
+
+def initWorker(template, options):
+    '''Initializes a worker process of the pool. The template is compiled once
+       per worker: with the "fork" start method, the worker inherits it
+       from the parent process, already compiled; with "spawn" or
+       "forkserver", it starts with an empty template cache.'''
+    worker['template'] = template
+    worker['options'] = options
+    compileTemplate(template)
+
+def renderOne(task):
+    '''Renders, within a worker process, the document defined by p_task, a
+       tuple (i_index, context, result). Returns a tuple
+       (i_index, result, s_error, f_seconds).'''
+    index, context, result = task
+    template = worker['template']
+    if isinstance(template, bytes): template = io.BytesIO(template)
+    start = time.time()
+    error = None
+    try:
+        res = Renderer(template, context, result, cacheTemplate=True,
+                       **worker['options']).run()
+        if result is None: result = res
+    except Exception:
+        error = Traceback.get(4)
+    return index, result, error, time.time() - start
+
+# ------------------------------------------------------------------------------
+class BatchRenderer:
+    '''Renders the same template with many contexts, using a pool of
+       processes. Iterating over a BatchRenderer yields, for every rendered
+       document, as soon as it is complete, a tuple (i_index, result, s_error):
+       * i_index is the index of the context among the rendered contexts;
+       * result is the path to the result, or the result as bytes if
+         p_resultNaming is None;
+       * s_error is None or describes the error that prevented the document
+         from being rendered. Errors are reported per document: they never
+         stop the batch.
+
+       When iteration is over, m_getStats returns throughput stats.'''
+
+    def __init__(self, template, contexts, resultNaming, processes=None,
+                 chunkSize=1, **options):
+        # p_template is a path or a binary file-like object
+        self.template = template
+        # p_contexts is any iterable of contexts. Every context must be
+        # picklable: it is sent to a worker process.
+        self.contexts = contexts
+        # p_resultNaming is a string containing "%d", replaced with the index
+        # of the context, or a function accepting the index and the context and
+        # returning the path to the result. If None, results are produced in
+        # memory and returned as bytes.
+        if (resultNaming is not None) and not callable(resultNaming) and \
+           ('%d' not in resultNaming):
+            raise Exception(BAD_RESULT_NAMING)
+        self.resultNaming = resultNaming
+        # The number of worker processes. If None, it will be the number of
+        # CPUs. If 0, documents are rendered in the current process.
+        self.processes = processes
+        self.chunkSize = chunkSize
+        # Other options are passed to every Renderer (ie, raiseOnError)
+        if 'cacheTemplate' in options:
+            raise Exception(CACHE_TEMPLATE_OPTION)
+        self.options = options
+        # Stats
+        self.count = 0
+        self.errors = 0
+        self.renderTime = 0.0 # Sum of the rendering times of all documents
+        self.duration = 0.0 # Wall-clock time of the whole batch
+
+    def getResult(self, index, context):
+        '''Returns the result for the p_context at this p_index.'''
+        naming = self.resultNaming
+        if naming is None: return
+        if callable(naming): return naming(index, context)
+        return naming % index
+
+    def getTasks(self):
+        '''Generates the tasks to send to the workers.'''
+        for index, context in enumerate(self.contexts):
+            yield index, context, self.getResult(index, context)
+
+    def __iter__(self):
+        template = self.template
+        if not isinstance(template, str):
+            template.seek(0)
+            template = template.read()
+        # Parse the template once in this process: workers created by forking
+        # it inherit the compiled template (see initWorker).
+        compileTemplate(template)
+        start = time.time()
+        pool = None
+        try:
+            if self.processes == 0:
+                initWorker(template, self.options)
+                results = map(renderOne, self.getTasks())
+            else:
+                pool = multiprocessing.Pool(self.processes, initWorker,
+                                            (template, self.options))
+                results = pool.imap_unordered(renderOne, self.getTasks(),
+                                              self.chunkSize)
+            for index, result, error, seconds in results:
+                self.count += 1
+                if error: self.errors += 1
+                self.renderTime += seconds
+                self.duration = time.time() - start
+                yield index, result, error
+            if pool: pool.close()
+        finally:
+            if pool: pool.terminate()
+            self.duration = time.time() - start
+
+    def getStats(self):
+        '''Returns a dict of throughput stats about the rendered documents.'''
+        count = self.count
+        return {'count': count, 'errors': self.errors,
+                'duration': self.duration,
+                'perSecond': self.duration and (count / self.duration) or 0.0,
+                'averageRenderTime': count and (self.renderTime / count) or 0.0}
+# ------------------------------------------------------------------------------
@@ -15,9 +15,9 @@
 # Appy. If not, see <http://www.gnu.org/licenses/>.
 
 # ------------------------------------------------------------------------------
-import re
+import re, io, threading
 from xml.sax.saxutils import quoteattr
-from appy.shared.xml_parser import xmlPrologue, escapeXml
+from appy.shared.xml_parser import xmlPrologue, writeEscapedXml
 from appy.pod import PodError
 from appy.shared.utils import Traceback
 from appy.pod.elements import *
@@ -76,40 +76,62 @@ NULL_ACTION_ERROR = 'There was a problem with this action. Possible causes: ' \
                     'specifying any from clause; (2) you specified the from ' \
                     'clause on the same line as the action, which is not ' \
                     'allowed (ie "do text from ...").'
+
+# Placeholder, in content.xml, for the dynamic styles (see Renderer)
+DYNAMIC_STYLES = '<!DYNAMIC_STYLES!>'
 # ------------------------------------------------------------------------------
-class BufferIterator:
-    def __init__(self, buffer):
-        self.buffer = buffer
-        self.remainingSubBufferIndexes = list(self.buffer.subBuffers.keys())
-        self.remainingElemIndexes = list(self.buffer.elements.keys())
-        self.remainingSubBufferIndexes.sort()
-        self.remainingElemIndexes.sort()
-
-    def hasNext(self):
-        return self.remainingSubBufferIndexes or self.remainingElemIndexes
-
-    def __next__(self):
-        nextSubBufferIndex = None
-        if self.remainingSubBufferIndexes:
-            nextSubBufferIndex = self.remainingSubBufferIndexes[0]
-        nextExprIndex = None
-        if self.remainingElemIndexes:
-            nextExprIndex = self.remainingElemIndexes[0]
-        # Compute min between nextSubBufferIndex and nextExprIndex
-        if (nextSubBufferIndex != None) and (nextExprIndex != None):
-            res = min(nextSubBufferIndex, nextExprIndex)
-        elif (nextSubBufferIndex == None) and (nextExprIndex != None):
-            res = nextExprIndex
-        elif (nextSubBufferIndex != None) and (nextExprIndex == None):
-            res = nextSubBufferIndex
-        # Update "remaining" lists
-        if res == nextSubBufferIndex:
-            self.remainingSubBufferIndexes = self.remainingSubBufferIndexes[1:]
-            resDict = self.buffer.subBuffers
-        elif res == nextExprIndex:
-            self.remainingElemIndexes = self.remainingElemIndexes[1:]
-            resDict = self.buffer.elements
-        return res, resDict[res]
+class EvaluationPlan:
+    '''Precomputed sequence of operations required to evaluate a MemoryBuffer.
+       Evaluating a buffer consists in dumping static text interleaved with the
+       results of evaluating expressions, attributes and actions. Static parts
+       are sliced once for all when the plan is built; every evaluation of the
+       buffer (ie, every iteration of a "for" action) then simply walks the
+       plan.'''
+    # Kinds of steps
+    EXPRESSION = 0
+    ATTRIBUTES = 1
+    ACTION = 2
+
+    def __init__(self, buffer, subElements, removeMainElems):
+        # The list of steps, as tuples (s_text, i_kind, item): s_text is the
+        # static text to dump before evaluating p_item, whose kind is one of
+        # the hereabove constants.
+        steps = []
+        # Static text to dump after the last step
+        self.tail = ''
+        content = buffer.getContent()
+        if not subElements:
+            # Dump the root tag in this buffer, but not its content
+            res = buffer.reTagContent.match(content.strip())
+            if not res: self.tail = content
+            else:
+                g = res.group
+                self.tail = '<%s:%s%s></%s:%s>' % (g(1),g(2),g(3),g(1),g(2))
+            self.steps = ()
+            return
+        if removeMainElems: buffer.removeAutomaticExpressions()
+        text = []
+        currentIndex = buffer.getStartIndex(removeMainElems)
+        for index, item in buffer.getItems():
+            text.append(content[currentIndex:index])
+            currentIndex = index + 1
+            if isinstance(item, Expression):
+                kind = EvaluationPlan.EXPRESSION
+            elif isinstance(item, Attributes) or isinstance(item, Attribute):
+                kind = EvaluationPlan.ATTRIBUTES
+            elif item.action:
+                kind = EvaluationPlan.ACTION
+            else:
+                # A sub-buffer without action is static
+                text.append(item.getContent())
+                continue
+            steps.append((''.join(text), kind, item))
+            text = []
+        stopIndex = buffer.getStopIndex(removeMainElems)
+        if currentIndex < (stopIndex-1):
+            text.append(content[currentIndex:stopIndex])
+        self.tail = ''.join(text)
+        self.steps = tuple(steps)
 
 # ------------------------------------------------------------------------------
 class Buffer:
@@ -147,12 +169,13 @@ class Buffer:
            Convert attribute "number-columns-repeated" of every table column
            (or add it if it does not exist) to let the user define how he will
            repeat table columns via variable "columnsRepeated".'''
+        # p_attrs is a dict or, with the "sax" parser backend, a
+        # xml.sax.xmlreader.AttributesImpl instance wrapping a dict.
+        attrs = getattr(attrs, '_attrs', attrs)
         if elem == self.env.tags['table']:
-            attrs = attrs._attrs
             name = self.env.tags['table-name']
             attrs[name] = ':tableName|"%s"' % attrs[name]
         elif elem == self.env.tags['table-column']:
-            attrs = attrs._attrs
             key = self.env.tags['number-columns-repeated']
             columnNumber = self.env.getTable().nbOfColumns -1
             nb = (key in attrs) and attrs[key] or '1'
@@ -211,19 +234,57 @@ class Buffer:
         '''Dumps string p_content into the buffer.'''
         if self.pod:
             # Take care of converting line breaks and tabs
-            content = escapeXml(content, format='odf',
-                                nsText=self.env.namespaces[self.env.NS_TEXT])
+            writeEscapedXml(self.write, content, format='odf',
+                            nsText=self.env.namespaces[self.env.NS_TEXT])
         else:
-            content = escapeXml(content)
-        self.write(content)
+            writeEscapedXml(self.write, content)
 
 # ------------------------------------------------------------------------------
+class RenderState:
+    '''The state of a single evaluation of a tree of buffers. The tree, built
+       once for all when parsing a template, is shared by all renderings of
+       this template, possibly running at the same time in several threads:
+       everything that is specific to a rendering is stored here, on the
+       FileBuffer receiving its result, and never on the tree.'''
+    def __init__(self, context=None, raiseOnError=False, profiler=None,
+                 cancelled=None):
+        # The evaluation context
+        self.context = context
+        # When an error occurs, must we raise it or dump it into the result?
+        self.raiseOnError = raiseOnError
+        # The appy.pod.profiler.Profiler instance, if the rendering is profiled
+        self.profiler = profiler
+        # A threading.Event being set when the rendering is cancelled
+        self.cancelled = cancelled
+        # The results of the expressions tied to Attributes instances, already
+        # evaluated by them, as a dict ~{Expression: result}~ (see
+        # appy.pod.elements.Attributes.evaluate).
+        self.results = {}
+        # The attributes dumped by every Attributes instance, as a dict
+        # ~{Attributes: {s_name: s_value}}~.
+        self.attrs = {}
+
 class FileBuffer(Buffer):
-    def __init__(self, env, result):
+    def __init__(self, env, result, state=None):
         Buffer.__init__(self, env, None)
+        # p_result is the path to the file to create, or an already opened,
+        # text file-like object (ie, a StringIO instance).
         self.result = result
-        self.content = open(result, 'w', encoding='utf-8')
+        # The state of the rendering producing this result
+        self.state = state or RenderState()
+        if isinstance(result, str):
+            self.content = open(result, 'w', encoding='utf-8')
+        else:
+            self.content = result
         self.content.write(xmlPrologue)
+        # The position, in the result, of the placeholder for dynamic styles, as
+        # returned by the result's m_tell method. None if the placeholder has
+        # not been encountered.
+        self.dynamicStylesAt = None
+
+    def close(self):
+        '''Closes the result file, if this buffer has opened it.'''
+        if isinstance(self.result, str): self.content.close()
 
     # getLength is used to manage insertions into sub-buffers. But in the case
     # of a FileBuffer, we will only have 1 sub-buffer at a time, and we don't
@@ -233,16 +294,21 @@ class FileBuffer(Buffer):
     def write(self, something):
         self.content.write(something)
 
+    def markDynamicStyles(self):
+        '''Records the current position as the one where dynamic styles must
+           be inserted, once they are all known.'''
+        self.dynamicStylesAt = self.content.tell()
+
     def addExpression(self, expression, tiedHook=None):
         # At 2013-02-06, this method was not called within the whole test suite.
         try:
             expr = Expression(expression, self.pod)
             if tiedHook: tiedHook.tiedExpression = expr
-            res, escape = expr.evaluate(self.env.context)
+            res, escape = expr.evaluate(self.state.context, self.state)
             if escape: self.dumpContent(res)
             else: self.write(res)
         except Exception as e:
-            if not self.env.raiseOnError:
+            if not self.state.raiseOnError:
                 PodError.dump(self, EVAL_EXPR_ERROR % (expression, e),
                               dumpTb=False)
             else:
@@ -259,18 +325,158 @@ class FileBuffer(Buffer):
     def pushSubBuffer(self, subBuffer): pass
     def getRootBuffer(self): return self
 
+# ------------------------------------------------------------------------------
+class RowsBuffer(FileBuffer):
+    '''Buffer into which a "for" action on a table row dumps its rows, one at a
+       time, before writing them into the p_target buffer. Identical
+       consecutive rows are written as a single row whose attribute
+       "table:number-rows-repeated" holds the number of repetitions. Only the
+       current and the previous rows are kept in memory.'''
+    def __init__(self, env, target):
+        Buffer.__init__(self, env, None)
+        self.result = None
+        self.state = target.state
+        self.content = io.StringIO()
+        self.dynamicStylesAt = None
+        # The buffer into which rows are written
+        self.target = target
+        # The last row being produced, and the number of times it was produced
+        self.previous = None
+        self.count = 0
+        name = Row.OD.getFullName(env.namespaces)
+        self.rowStart = '<%s' % name
+        self.rowEnd = '</%s>' % name
+        prefix = env.namespaces[env.NS_TABLE]
+        self.repeated = ' %s:number-rows-repeated=' % prefix
+        # Formulas hold references relative to the cell they are in: repeating
+        # a row containing formulas would shift these references.
+        self.formula = ' %s:formula=' % prefix
+
+    def endRow(self):
+        '''Called when a row has been completely dumped into this buffer.'''
+        content = self.content
+        row = content.getvalue()
+        content.seek(0)
+        content.truncate()
+        if row == self.previous:
+            self.count += 1
+        else:
+            self.flush()
+            self.previous = row
+            self.count = 1
+
+    def isCompressible(self, row):
+        '''Is p_row made of a single table row, that can get attribute
+           "table:number-rows-repeated" ?'''
+        if not row.startswith(self.rowStart) or not row.endswith(self.rowEnd):
+            return
+        if self.formula in row: return
+        # The row must not contain sub-rows
+        if row.count(self.rowStart, 1) > 0: return
+        startTag = row[:row.find('>') + 1]
+        return (self.repeated not in startTag) and \
+               (startTag[len(self.rowStart)] in ' />')
+
+    def flush(self):
+        '''Writes the previous row(s) into the target buffer.'''
+        row = self.previous
+        if not row: return
+        if (self.count > 1) and self.isCompressible(row):
+            i = len(self.rowStart)
+            self.target.write('%s%s"%d"%s' % (row[:i], self.repeated,
+                                               self.count, row[i:]))
+        else:
+            for i in range(self.count): self.target.write(row)
+        self.previous = None
+        self.count = 0
+
+    def close(self): self.flush()
+
+# ------------------------------------------------------------------------------
+class RootBuffer(Buffer):
+    '''Root of the tree of buffers built while parsing a POD template. Parsing
+       a template does not evaluate anything: this buffer records, in the order
+       of the template, static content and sub-buffers. It can then be
+       evaluated as many times as needed, each time with another context, into
+       a FileBuffer.'''
+    def __init__(self, env):
+        Buffer.__init__(self, env, None)
+        # The sequence of recorded entries. Every entry is a string (static
+        # content) or a MemoryBuffer to evaluate at render time. The placeholder
+        # for dynamic styles, if present, is an entry on its own.
+        self.content = []
+        # Static content not being part of self.content yet
+        self.chunks = []
+
+    # Like for a FileBuffer, we will only have 1 sub-buffer at a time
+    def getLength(self): return 0
+
+    def write(self, something): self.chunks.append(something)
+
+    def flush(self):
+        '''Converts pending static content into an entry.'''
+        if self.chunks:
+            content = ''.join(self.chunks)
+            self.chunks = []
+            if DYNAMIC_STYLES in content:
+                before, after = content.split(DYNAMIC_STYLES, 1)
+                self.content += [before, DYNAMIC_STYLES, after]
+            else:
+                self.content.append(content)
+
+    def addBuffer(self, buffer):
+        '''Records p_buffer: its action (if any) will be executed at render
+           time, or its content will be evaluated.'''
+        self.flush()
+        self.content.append(buffer)
+
+    def addExpression(self, expression, tiedHook=None):
+        # Wrap the expression into a MemoryBuffer to evaluate at render time
+        buffer = MemoryBuffer(self.env, self)
+        buffer.addExpression(expression, tiedHook)
+        self.addBuffer(buffer)
+
+    def addAttributes(self): pass # See FileBuffer.addAttributes
+    def pushSubBuffer(self, subBuffer): pass
+    def getRootBuffer(self): return self
+
+    def evaluate(self, result, context):
+        '''Dumps, into p_result (a FileBuffer), the result of evaluating the
+           recorded entries with this p_context.'''
+        self.flush()
+        for entry in self.content:
+            if entry is DYNAMIC_STYLES:
+                result.markDynamicStyles()
+            elif isinstance(entry, str):
+                result.write(entry)
+            elif entry.action:
+                entry.action.execute(result, context)
+            else:
+                entry.evaluate(result, context)
+
 # ------------------------------------------------------------------------------
 class MemoryBuffer(Buffer):
     actionRex = re.compile(r'(?:(\w+)\s*\:\s*)?do\s+(\w+)(-)?' \
                            r'(?:\s+(for|if|else|with)\s*(.*))?')
     forRex = re.compile(r'\s*([\w\-_]+)\s+in\s+(.*)')
     varRex = re.compile(r'\s*(@?[\w\-_]+)\s*=\s*(.*)')
+    # Evaluation plans are built while buffers may be evaluated by several
+    # threads.
+    planLock = threading.Lock()
 
     def __init__(self, env, parent):
         Buffer.__init__(self, env, parent)
-        self.content = ''
+        # The buffer content is stored as a list of chunks, whose total length
+        # is self.length: adding content to a buffer does not copy its existing
+        # content. m_getContent joins the chunks when the whole content is
+        # needed.
+        self.chunks = []
+        self.length = 0
         self.elements = {}
         self.action = None
+        # Evaluation plans, built at the first evaluation of this buffer, once
+        # parsing is complete (see m_getPlan).
+        self.plans = {}
 
     def clone(self):
         '''Produces an empty buffer that is a clone of this one.'''
@@ -278,19 +484,89 @@ class MemoryBuffer(Buffer):
 
     def addSubBuffer(self, subBuffer=None):
         sb = Buffer.addSubBuffer(self, subBuffer)
-        self.content += ' ' # To avoid having several subbuffers referenced at
+        self.write(' ')     # To avoid having several subbuffers referenced at
                             # the same place within this buffer.
         return sb
 
     def getRootBuffer(self):
-        '''Returns the root buffer. For POD it is always a FileBuffer. For PX,
+        '''Returns the root buffer. For POD it is always a RootBuffer. For PX,
            it is a MemoryBuffer.'''
         if self.parent: return self.parent.getRootBuffer()
         return self
 
-    def getLength(self): return len(self.content)
+    def getLength(self): return self.length
 
-    def write(self, thing): self.content += thing
+    def write(self, thing):
+        self.chunks.append(thing)
+        self.length += len(thing)
+
+    def writeChunks(self, chunks):
+        '''Appends this list of p_chunks to this buffer.'''
+        self.chunks += chunks
+        for chunk in chunks: self.length += len(chunk)
+
+    def getContent(self):
+        '''Returns the whole buffer content, as a string.'''
+        chunks = self.chunks
+        if len(chunks) == 1: return chunks[0]
+        res = ''.join(chunks)
+        # Keep the joined content: it will not need to be joined again
+        self.chunks = res and [res] or []
+        return res
+
+    def splitChunks(self, index):
+        '''Splits the chunks of this buffer at p_index. Returns a tuple
+           (firstChunks, lastChunks). Only the chunk containing p_index, if
+           any, is copied.'''
+        chunks = self.chunks
+        pos = 0
+        for i in range(len(chunks)):
+            chunk = chunks[i]
+            end = pos + len(chunk)
+            if end == index:
+                return chunks[:i+1], chunks[i+1:]
+            elif end > index:
+                j = index - pos
+                first = chunks[:i]
+                if j: first.append(chunk[:j])
+                return first, [chunk[j:]] + chunks[i+1:]
+            pos = end
+        return chunks[:], []
+
+    def getItems(self):
+        '''Returns the sub-buffers and elements of this buffer, as a list of
+           tuples (i_index, item) sorted by index. At a given index, a
+           sub-buffer comes before an element.'''
+        res = [(index, 0, sub) for index, sub in self.subBuffers.items()]
+        res += [(index, 1, elem) for index, elem in self.elements.items()]
+        res.sort(key=lambda item: item[:2])
+        return [(index, item) for index, kind, item in res]
+
+    def getPlan(self, subElements, removeMainElems):
+        '''Returns the EvaluationPlan for evaluating this buffer with these
+           parameters. Plans are cached: a buffer must not be modified anymore
+           once it has been evaluated.'''
+        key = bool(subElements), bool(removeMainElems)
+        res = self.plans.get(key)
+        if res: return res
+        with MemoryBuffer.planLock:
+            res = self.plans.get(key)
+            if res: return res
+            if subElements and removeMainElems:
+                # Automatic expressions will be removed: plans built without
+                # removing them are not valid anymore.
+                self.plans.clear()
+            res = self.plans[key] = EvaluationPlan(self, subElements,
+                                                   removeMainElems)
+        return res
+
+    def getLocation(self):
+        '''Returns the location, in the template, of the element currently
+           parsed.'''
+        parser = self.env.parser
+        locator = parser.locator
+        return '%s, line %s, column %s' % (parser.caller.name,
+                      locator.getLineNumber(), locator.getColumnNumber())
 
     def getIndex(self, podElemName):
         res = -1
@@ -353,19 +629,26 @@ class MemoryBuffer(Buffer):
             # in the parent (if it is a temp buffer generated from a cut)
             del self.subBuffers[subIndex]
             self.subBuffers[self.getLength()] = subBuffer
-            self.content += ' '
+            self.write(' ')
 
     def transferAllContent(self):
         '''Transfer all content to parent.'''
-        if isinstance(self.parent, FileBuffer):
+        if isinstance(self.parent, RootBuffer):
             # First unreference all elements
             for index in self.getElementIndexes(expressions=False):
                 del self.elements[index]
-            self.evaluate(self.parent, self.env.context)
+            # Hand over our content to a new buffer, recorded by the root
+            # buffer for being evaluated at render time.
+            buffer = MemoryBuffer(self.env, self.parent)
+            buffer.chunks = self.chunks
+            buffer.length = self.length
+            buffer.elements = self.elements
+            buffer.subBuffers = self.subBuffers
+            self.parent.addBuffer(buffer)
         else:
             # Transfer content in itself
             oldParentLength = self.parent.getLength()
-            self.parent.write(self.content)
+            self.parent.writeChunks(self.chunks)
             # Transfer elements
             for index, podElem in self.elements.items():
                 self.parent.elements[oldParentLength + index] = podElem
@@ -388,7 +671,7 @@ class MemoryBuffer(Buffer):
                 elem.colIndex = elem.tableInfo.curColIndex
         if elem == 'x':
             # See comment on similar statement in the method below.
-            self.content += ' '
+            self.write(' ')
 
     def addExpression(self, expression, tiedHook=None):
         # Create the POD expression
@@ -397,20 +680,20 @@ class MemoryBuffer(Buffer):
         self.elements[self.getLength()] = expr
         # To be sure that an expr and an elem can't be found at the same index
         # in the buffer.
-        self.content += ' '
+        self.write(' ')
 
     def addAttributes(self):
         '''pod-only: adds an Attributes instance into this buffer.'''
         attrs = Attributes(self.env)
         self.elements[self.getLength()] = attrs
-        self.content += ' '
+        self.write(' ')
         return attrs
 
     def addAttribute(self, name, expr):
         '''px-only: adds an Attribute instance into this buffer.'''
         attr = Attribute(name, expr)
         self.elements[self.getLength()] = attr
-        self.content += ' '
+        self.write(' ')
         return attr
 
     def _getVariables(self, expr):
@@ -506,6 +789,8 @@ class MemoryBuffer(Buffer):
                     raise ParsingError(NULL_ACTION_ERROR)
                 self.action = NullAction(statementName, self, None, podElem,
                                          None, source, fromClause)
+            self.action.label = '%s (%s)' % (' / '.join(statementGroup),
+                                             self.getLocation())
             res = indexPodElem
         except ParsingError as ppe:
             PodError.dump(self, ppe, removeFirstLine=True)
@@ -544,12 +829,10 @@ class MemoryBuffer(Buffer):
         part is self.'''
         res = MemoryBuffer(self.env, None)
         # Manage buffer meta-info (elements, expressions, subbuffers)
-        iter = BufferIterator(self)
         subBuffersToDelete = []
         elementsToDelete = []
         mustShift = False
-        while iter.hasNext():
-            itemIndex, item = next(iter)
+        for itemIndex, item in self.getItems():
             if keepFirstPart:
                 if itemIndex >= index:
                     newIndex = itemIndex-index
@@ -585,12 +868,16 @@ class MemoryBuffer(Buffer):
                 subBuffers[subIndex-index] = buf
             self.subBuffers = subBuffers
         # Manage content
+        first, last = self.splitChunks(index)
+        length = self.length
         if keepFirstPart:
-            res.write(self.content[index:])
-            self.content = self.content[:index]
+            res.writeChunks(last)
+            self.chunks = first
+            self.length = index
         else:
-            res.write(self.content[:index])
-            self.content = self.content[index:]
+            res.writeChunks(first)
+            self.chunks = last
+            self.length = length - index
         return res
 
     def getElementIndexes(self, expressions=True):
@@ -636,7 +923,8 @@ class MemoryBuffer(Buffer):
         if not removeMainElems: return 0
         # Find the start position of the deepest element to remove
         deepestElem = self.action.elem.DEEPEST_TO_REMOVE
-        pos = self.content.find('<%s' % deepestElem.elem)
+        content = self.getContent()
+        pos = content.find('<%s' % deepestElem.elem)
         pos = pos + len(deepestElem.elem)
         # Now we must find the position of the end of this start tag,
         # skipping potential attributes.
@@ -644,7 +932,7 @@ class MemoryBuffer(Buffer):
         endTagFound = False # Have we found the end of this tag ?
         while not endTagFound:
             pos += 1
-            nextChar = self.content[pos]
+            nextChar = content[pos]
             if (nextChar == '>') and not inAttrValue:
                 # Yes we have it
                 endTagFound = True
@@ -657,7 +945,8 @@ class MemoryBuffer(Buffer):
         if removeMainElems:
             ns = self.env.namespaces
             deepestElem = self.action.elem.DEEPEST_TO_REMOVE
-            pos = self.content.rfind('</%s>' % deepestElem.getFullName(ns))
+            pos = self.getContent().rfind('</%s>' % \
+                                          deepestElem.getFullName(ns))
             res = pos
         else:
             res = self.getLength()
@@ -670,7 +959,7 @@ class MemoryBuffer(Buffer):
            (m_getStartIndex).'''
         # Find the start position of the deepest element to remove
         deepestElem = self.action.elem.DEEPEST_TO_REMOVE
-        pos = self.content.find('<%s' % deepestElem.elem)
+        pos = self.getContent().find('<%s' % deepestElem.elem)
         for index in list(self.elements.keys()):
             if index < pos: del self.elements[index]
 
@@ -681,50 +970,38 @@ class MemoryBuffer(Buffer):
         '''Evaluates this buffer given the current p_context and add the result
            into p_result. With pod, p_result is the root file buffer; with px
            it is a memory buffer.'''
-        if not subElements:
-            # Dump the root tag in this buffer, but not its content
-            res = self.reTagContent.match(self.content.strip())
-            if not res: result.write(self.content)
-            else:
-                g = res.group
-                result.write('<%s:%s%s></%s:%s>' % (g(1),g(2),g(3),g(1),g(2)))
-        else:
-            if removeMainElems: self.removeAutomaticExpressions()
-            iter = BufferIterator(self)
-            currentIndex = self.getStartIndex(removeMainElems)
-            while iter.hasNext():
-                index, evalEntry = next(iter)
-                result.write(self.content[currentIndex:index])
-                currentIndex = index + 1
-                if isinstance(evalEntry, Expression):
-                    try:
-                        res, escape = evalEntry.evaluate(context)
-                        if escape: result.dumpContent(res)
-                        else: result.write(res)
-                    except EvaluationError as e:
-                        # This exception has already been treated (see the 
-                        # "except" block below). Simply re-raise it when needed.
-                        if self.env.raiseOnError: raise e
-                    except Exception as e:
-                        if not self.env.raiseOnError:
-                            PodError.dump(result, EVAL_EXPR_ERROR % (
-                                          evalEntry.expr, e))
-                        else:
-                            raise EvaluationError(EVAL_EXPR_ERROR % \
-                                        (evalEntry.expr, '\n'+Traceback.get(5)))
-                elif isinstance(evalEntry, Attributes) or \
-                     isinstance(evalEntry, Attribute):
-                    result.write(evalEntry.evaluate(context))
-                else: # It is a subBuffer
-                    if evalEntry.action:
-                        evalEntry.action.execute(result, context)
+        plan = self.getPlan(subElements, removeMainElems)
+        state = result.state
+        profiler = state.profiler
+        for text, kind, item in plan.steps:
+            if text: result.write(text)
+            if kind == EvaluationPlan.EXPRESSION:
+                if profiler: profiler.start('expression', item.expr)
+                try:
+                    res, escape = item.evaluate(context, state)
+                    if escape: result.dumpContent(res)
+                    else: result.write(res)
+                except EvaluationError as e:
+                    # This exception has already been treated (see the
+                    # "except" block below). Simply re-raise it when needed.
+                    if state.raiseOnError: raise e
+                except Exception as e:
+                    if not state.raiseOnError:
+                        PodError.dump(result, EVAL_EXPR_ERROR % (item.expr, e))
                     else:
-                        result.write(evalEntry.content)
-            stopIndex = self.getStopIndex(removeMainElems)
-            if currentIndex < (stopIndex-1):
-                result.write(self.content[currentIndex:stopIndex])
+                        raise EvaluationError(EVAL_EXPR_ERROR % \
+                                        (item.expr, '\n'+Traceback.get(5)))
+                finally:
+                    if profiler: profiler.stop()
+            elif kind == EvaluationPlan.ATTRIBUTES:
+                result.write(item.evaluate(context, state))
+            else:
+                item.action.execute(result, context)
+        if plan.tail: result.write(plan.tail)
 
     def clean(self):
         '''Cleans the buffer content.'''
-        self.content = ''
+        self.chunks = []
+        self.length = 0
+        self.plans = {}
 # ------------------------------------------------------------------------------
@@ -17,7 +17,7 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
 
 # ------------------------------------------------------------------------------
-import sys, os, os.path, time, signal
+import sys, os, os.path, time, signal, subprocess, threading, tempfile, queue
 from optparse import OptionParser
 
 htmlFilters = {'odt': 'HTML (StarWriter)',
@@ -59,6 +59,11 @@ BAD_RESULT_TYPE = 'Bad result type "%s". Available types are %s.'
 CANNOT_WRITE_RESULT = 'I cannot write result "%s". %s'
 CONNECT_ERROR = 'Could not connect to LibreOffice on port %d. UNO ' \
                 '(LibreOffice API) says: %s.'
+LO_START_ERROR = 'Could not start LibreOffice on port %d. %s'
+LO_TIMEOUT = 'LibreOffice on port %d did not answer within %d seconds. It ' \
+             'was restarted.'
+LO_ERROR = 'LibreOffice on port %d failed. %s'
+POOL_TIMEOUT = 'No LibreOffice instance became available within %d seconds.'
 
 # Some constants ---------------------------------------------------------------
 DEFAULT_PORT = 2002
@@ -72,7 +77,7 @@ class Converter:
                         'openoffice.org 2': 'openof~1',
                         }
     def __init__(self, docPath, resultType, port=DEFAULT_PORT,
-                 templatePath=None):
+                 templatePath=None, desktop=None):
         self.port = port
         # The path to the document to convert
         self.docUrl, self.docPath = self.getFilePath(docPath)
@@ -81,7 +86,9 @@ class Converter:
         self.resultFilter = self.getResultFilter()
         self.resultUrl = self.getResultUrl()
         self.loContext = None
-        self.oo = None # The LibreOffice application object
+        # The LibreOffice application object. If p_desktop is given, it is
+        # the one of an already connected LibreOffice (see LoInstance).
+        self.oo = desktop
         self.doc = None # The LibreOffice loaded document
         # The path to a LibreOffice template (ie, a ".ott" file) from which
         # styles can be imported
@@ -151,8 +158,10 @@ class Converter:
             res.append(prop)
         return tuple(res)
 
-    def connect(self):
-        '''Connects to LibreOffice'''
+    @staticmethod
+    def getDesktop(port):
+        '''Connects to LibreOffice running on this p_port and returns a tuple
+           (loContext, desktop).'''
         if os.name == 'nt':
             import socket
         import uno
@@ -164,20 +173,25 @@ class Converter:
             resolver = localContext.ServiceManager.createInstanceWithContext(
                 "com.sun.star.bridge.UnoUrlResolver", localContext)
             # Connect to the running office
-            self.loContext = resolver.resolve(
+            loContext = resolver.resolve(
                 'uno:socket,host=localhost,port=%d;urp;StarOffice.' \
-                'ComponentContext' % self.port)
+                'ComponentContext' % port)
             # Is seems that we can't define a timeout for this method.
             # I need it because, for example, when a web server already listens
             # to the given port (thus, not a LibreOffice instance), this method
             # blocks.
-            smgr = self.loContext.ServiceManager
+            smgr = loContext.ServiceManager
             # Get the central desktop object
-            self.oo = smgr.createInstanceWithContext(
-                'com.sun.star.frame.Desktop', self.loContext)
+            desktop = smgr.createInstanceWithContext(
+                'com.sun.star.frame.Desktop', loContext)
+            return loContext, desktop
         except NoConnectException:
             e = sys.exc_info()[1]
-            raise ConverterError(CONNECT_ERROR % (self.port, e))
+            raise ConverterError(CONNECT_ERROR % (port, e))
+
+    def connect(self):
+        '''Connects to LibreOffice'''
+        self.loContext, self.oo = Converter.getDesktop(self.port)
 
     def updateOdtDocument(self):
         '''If the input file is an ODT document, we will perform those tasks:
@@ -256,10 +270,180 @@ class Converter:
 
     def run(self):
         '''Connects to LO, does the job and disconnects'''
-        self.connect()
-        self.loadDocument()
-        self.convertDocument()
-        self.doc.close(True)
+        if not self.oo: self.connect()
+        try:
+            self.loadDocument()
+            self.convertDocument()
+        finally:
+            # Close the document even if the conversion failed: a long-lived
+            # LibreOffice would keep it open.
+            if self.doc: self.doc.close(True)
+
+# ------------------------------------------------------------------------------
+class LoInstance:
+    '''A LibreOffice instance, running in server mode on some port, started and
+       monitored by a ConverterPool.'''
+    def __init__(self, port, sofficePath='soffice', startTimeout=60):
+        self.port = port
+        self.sofficePath = sofficePath
+        # The maximum number of seconds to wait for LibreOffice to accept
+        # connections after having been started.
+        self.startTimeout = startTimeout
+        self.process = None
+        self.oo = None # The LibreOffice application object
+        # The number of conversions performed since the last (re)start
+        self.conversions = 0
+        # Becomes True when the watchdog has killed a hung LibreOffice
+        self.killed = False
+
+    def start(self):
+        '''Starts LibreOffice and connects to it.'''
+        # Every instance has its own user profile: several instances can't
+        # share the same one.
+        profile = os.path.join(tempfile.gettempdir(), 'appyLo%d' % self.port)
+        cmd = [self.sofficePath, '--headless', '--invisible', '--nologo',
+               '--norestore', '--nodefault',
+               '-env:UserInstallation=file://%s' % profile,
+               '--accept=socket,host=localhost,port=%d;urp;' % self.port]
+        try:
+            self.process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL)
+        except OSError as oe:
+            raise ConverterError(LO_START_ERROR % (self.port, oe))
+        # Wait until LibreOffice accepts connections
+        start = time.time()
+        try:
+            while True:
+                try:
+                    self.oo = Converter.getDesktop(self.port)[1]
+                    break
+                except ConverterError as ce:
+                    if (self.process.poll() != None) or \
+                       ((time.time() - start) > self.startTimeout):
+                        raise ConverterError(LO_START_ERROR % (self.port, ce))
+                    time.sleep(0.5)
+        except BaseException:
+            # Whatever the error (UNO may not be available, for example), don't
+            # leave an orphan LibreOffice process.
+            self.stop()
+            raise
+        self.conversions = 0
+        self.killed = False
+
+    def stop(self):
+        '''Stops LibreOffice.'''
+        self.oo = None
+        if self.process and (self.process.poll() == None):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def kill(self):
+        '''Called by the watchdog when LibreOffice is hung.'''
+        self.killed = True
+        if self.process: self.process.kill()
+
+    def watch(self, timeout, function, *args):
+        '''Calls p_function with p_args. If it does not return within
+           p_timeout seconds, LibreOffice is considered as hung: it is killed
+           and restarted.'''
+        watchdog = threading.Timer(timeout, self.kill)
+        watchdog.start()
+        try:
+            return function(*args)
+        except ConverterError:
+            if not self.killed: raise
+        except Exception as e:
+            if not self.killed: raise ConverterError(LO_ERROR % (self.port, e))
+        finally:
+            watchdog.cancel()
+            if self.killed:
+                self.restart()
+                raise ConverterError(LO_TIMEOUT % (self.port, timeout))
+
+    def isAlive(self, timeout=10):
+        '''Checks that LibreOffice is still running and answers.'''
+        if not self.oo or not self.process or (self.process.poll() != None):
+            return
+        try:
+            self.watch(timeout, self.oo.getComponents)
+            return True
+        except ConverterError:
+            return
+
+    def convert(self, docPath, resultType, templatePath=None, timeout=120):
+        '''Converts p_docPath into p_resultType (see class Converter).'''
+        converter = Converter(docPath, resultType, self.port, templatePath,
+                              desktop=self.oo)
+        self.watch(timeout, converter.run)
+        self.conversions += 1
+
+# ------------------------------------------------------------------------------
+class ConverterPool:
+    '''A pool of LibreOffice instances running in server mode on successive
+       ports. Converting a document with a pool avoids starting LibreOffice or
+       connecting to it for every conversion. A pool is meant to be long-lived
+       and shared by any number of renderers (see parameter "converterPool" of
+       the Renderer): conversions requested while all instances are busy are
+       queued. Hung or dead instances are restarted.'''
+    def __init__(self, size=2, firstPort=DEFAULT_PORT, sofficePath='soffice',
+                 timeout=120, queueTimeout=300, maxConversions=None):
+        self.instances = [LoInstance(firstPort + i, sofficePath) \
+                          for i in range(size)]
+        # The maximum number of seconds for a single conversion
+        self.timeout = timeout
+        # The maximum number of seconds to wait for an available instance
+        self.queueTimeout = queueTimeout
+        # If specified, an instance is restarted after this number of
+        # conversions (LibreOffice tends to consume more and more memory).
+        self.maxConversions = maxConversions
+        # The instances that are not busy
+        self.available = queue.Queue()
+        self.started = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        '''Starts all LibreOffice instances.'''
+        with self.lock:
+            if self.started: return
+            started = []
+            try:
+                for instance in self.instances:
+                    instance.start()
+                    started.append(instance)
+            except BaseException:
+                # Stop the instances that were already started
+                for instance in started: instance.stop()
+                raise
+            for instance in started: self.available.put(instance)
+            self.started = True
+
+    def stop(self):
+        '''Stops all LibreOffice instances.'''
+        with self.lock:
+            for instance in self.instances: instance.stop()
+            self.available = queue.Queue()
+            self.started = False
+
+    def convert(self, docPath, resultType, templatePath=None):
+        '''Converts p_docPath into p_resultType with the first available
+           LibreOffice instance.'''
+        if not self.started: self.start()
+        try:
+            instance = self.available.get(timeout=self.queueTimeout)
+        except queue.Empty:
+            raise ConverterError(POOL_TIMEOUT % self.queueTimeout)
+        try:
+            if not instance.isAlive() or (self.maxConversions and \
+               (instance.conversions >= self.maxConversions)):
+                instance.restart()
+            instance.convert(docPath, resultType, templatePath, self.timeout)
+        finally:
+            self.available.put(instance)
 
 # ConverterScript-related messages ---------------------------------------------
 WRONG_NB_OF_ARGS = 'Wrong number of arguments.'
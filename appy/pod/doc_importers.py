@@ -17,12 +17,17 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
 
 # ------------------------------------------------------------------------------
-import os, os.path, time, shutil, struct, random, urllib.parse, io
+import os, os.path, time, shutil, struct, random, urllib.parse, io, hashlib, \
+       threading, subprocess, zipfile
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from appy.pod import PodError
 from appy.pod.odf_parser import OdfEnvironment
 from appy.shared import mimeTypesExts
 from appy.shared.utils import FileWrapper
 from appy.shared.dav import Resource
+from appy.pod.odt_merger import OdtMerger
+from appy.pod.template import CompiledTemplate, templateCache
 import uuid
 
 # ------------------------------------------------------------------------------
@@ -35,6 +40,7 @@ CONVERT_ERROR = 'Program "convert", from imagemagick, must be installed and ' \
                 'Conversion of SVG files must also be enabled. On Ubuntu: ' \
                 'apt-get install librsvg2-bin'
 TO_PDF_ERROR = 'ConvertImporter error while converting a doc to PDF: %s.'
+PDF_PAGE_ERROR = 'Page %d of a PDF file could not be converted into an image.'
 
 # ------------------------------------------------------------------------------
 class DocImporter:
@@ -57,7 +63,7 @@ class DocImporter:
         self.linkNs = self.ns[OdfEnvironment.NS_XLINK]
         self.drawNs = self.ns[OdfEnvironment.NS_DRAW]
         self.svgNs = self.ns[OdfEnvironment.NS_SVG]
-        self.tempFolder = renderer.tempFolder
+        self.tempFolder = renderer.getTempFolder()
         self.importFolder = self.getImportFolder()
         # Create the import folder if it does not exist.
         if not os.path.exists(self.importFolder): os.mkdir(self.importFolder)
@@ -82,6 +88,7 @@ class DocImporter:
                 f = open(self.importPath, 'wb')
                 f.write(fileContent)
                 f.close()
+            self.importPath = self.storeFile(self.importPath)
         # Some importers add specific attrs, through method init.
 
     def getUuid(self):
@@ -118,6 +125,11 @@ class DocImporter:
            computed p_importPath is not used at all.'''
         return at
 
+    def storeFile(self, path, at=None):
+        '''The file to import, from p_at if given, has been dumped at p_path.
+           Returns the path where it must finally be found.'''
+        return path
+
 class OdtImporter(DocImporter):
     '''This class allows to import the content of another ODT document into a
        pod template.'''
@@ -135,12 +147,25 @@ class OdtImporter(DocImporter):
                         (self.textNs, self.textNs, self.textNs)
         # Insert a page break before importing the doc if needed
         if self.pageBreakBefore: self.res += pageBreak
-        # Import the external odt document
-        self.res += '<%s:section %s:name="PodImportSection%f">' \
-                    '<%s:section-source %s:href="%s" ' \
-                    '%s:filter-name="writer8"/></%s:section>' % (
-                        self.textNs, self.textNs, time.time(), self.textNs,
-                        self.linkNs, self.importPath, self.textNs, self.textNs)
+        # Merge the content of the external odt document into the result
+        f = zipfile.ZipFile(self.importPath)
+        try:
+            content = f.read('content.xml').decode('utf-8')
+            merger = OdtMerger(self.renderer, self.importPath, f.read)
+            body = merger.run(content)
+        finally:
+            f.close()
+        if body is not None:
+            self.res += body
+        else:
+            # The document can't be merged: link it from a section, that
+            # LibreOffice will replace with the document content.
+            self.renderer.forceOoCall = True
+            self.res += '<%s:section %s:name="PodImportSection%f">' \
+                '<%s:section-source %s:href="%s" ' \
+                '%s:filter-name="writer8"/></%s:section>' % (
+                    self.textNs, self.textNs, time.time(), self.textNs,
+                    self.linkNs, self.importPath, self.textNs, self.textNs)
         # Insert a page break after importing the doc if needed
         if self.pageBreakAfter: self.res += pageBreak
         return self.res
@@ -156,7 +181,53 @@ class PodImporter(DocImporter):
         self.pageBreakBefore = pageBreakBefore
         self.pageBreakAfter = pageBreakAfter
 
+    def getCompiledTemplate(self):
+        '''Returns the POD template to import, compiled. It is cached: in the
+           template cache if the renderer uses it, in the renderer else. A
+           template given as content has been dumped into a file having a
+           unique name: it is cached under a hash of its content.'''
+        r = self.renderer
+        if self.at:
+            template = self.importPath
+        else:
+            template = open(self.importPath, 'rb')
+        try:
+            if r.cacheTemplate:
+                return templateCache.get(template, r.xmlParser)
+            key = templateCache.getKey(template)
+            res = r.subTemplates.get(key)
+            if not res:
+                res = r.subTemplates[key] = \
+                      CompiledTemplate(template, r.xmlParser)
+            return res
+        finally:
+            if not self.at: template.close()
+
     def run(self):
+        '''Evaluates the content of the POD template to import, with the
+           functions of the renderer: imported images and dynamic styles are
+           directly added to the result. The evaluated content is then merged
+           into the result.'''
+        r = self.renderer
+        compiled = self.getCompiledTemplate()
+        result = io.StringIO()
+        compiled.contentPart.evaluate(result, r.createContext(self.context),
+                                      r.raiseOnError, r.profiler, r.cancelled)
+        # The automatic styles of the compiled template are merged only once
+        merger = OdtMerger(r, self.importPath, compiled.read,
+                           r.subTemplateStyles.get(compiled))
+        body = merger.run(result.getvalue())
+        if body is None: return self.runWithLibreOffice()
+        r.subTemplateStyles[compiled] = merger.getStyles()
+        res = ''
+        if self.pageBreakBefore: res += r.insertPageBreak()
+        res += body
+        if self.pageBreakAfter: res += r.insertPageBreak()
+        return res
+
+    def runWithLibreOffice(self):
+        '''Renders the POD template to import into a separate ODT file, that
+           is imported by an OdtImporter.'''
         # Define where to store the pod result in the temp folder
         r = self.renderer
         # Define where to store the ODT result.
@@ -166,8 +237,9 @@ class PodImporter(DocImporter):
         renderer = r.__class__(self.importPath, self.context, resOdt,
                                pythonWithUnoPath=r.pyPath,
                                ooPort=r.ooPort, forceOoCall=r.forceOoCall,
-                               imageResolver=r.imageResolver)
-        renderer.stylesManager.stylesMapping = r.stylesManager.stylesMapping
+                               imageResolver=r.imageResolver,
+                               converterPool=r.converterPool)
+        renderer.shareStylesMapping(r)
         renderer.run()
         # The POD result is in "resOdt". Import it into the main POD result
         # using an OdtImporter.
@@ -178,45 +250,180 @@ class PodImporter(DocImporter):
 class PdfImporter(DocImporter):
     '''This class allows to import the content of a PDF file into a pod
        template. It calls gs to split the PDF into images and calls the
-       ImageImporter for importing it into the result.'''
+       ImageImporter for importing it into the result. Ranges of pages are
+       rasterized by several gs processes running in parallel; pages are
+       imported as soon as they are ready.'''
+    # The maximum number of gs processes running at the same time
+    maxProcesses = os.cpu_count() or 1
+    # The maximum number of pages rasterized by a single gs process
+    chunkSize = 10
+    # The gs device to use for every image format
+    devices = {'jpg': 'jpeg', 'png': 'png16m'}
+    # Default values for the parameters that may be set by m_init
+    pages = None
+    resolution = 125
+    imageFormat = 'jpg'
+    jpegQuality = None
+    WRONG_IMAGE_FORMAT = 'Wrong image format "%s" for PDF pages. Valid ' \
+                         'values are: %s.'
+
     def getImportFolder(self): return '%s/docImports' % self.tempFolder
-    def run(self):
-        imagePrefix = os.path.splitext(os.path.basename(self.importPath))[0]
-        # Split the PDF into images with Ghostscript
-        imagesFolder = os.path.dirname(self.importPath)
-        cmd = 'gs -dNOPAUSE -dBATCH -sDEVICE=jpeg -r125x125 ' \
-              '-sOutputFile=%s/%s%%d.jpg %s' % \
-              (imagesFolder, imagePrefix, self.importPath)
-        os.system(cmd)
-        # Check that at least one image was generated
-        succeeded = False
-        firstImage = '%s1.jpg' % imagePrefix
-        for fileName in os.listdir(imagesFolder):
-            if fileName == firstImage:
-                succeeded = True
-                break
-        if not succeeded: raise PodError(PDF_TO_IMG_ERROR)
-        # Insert images into the result.
-        noMoreImages = False
-        i = 0
-        while not noMoreImages:
+
+    def init(self, pages, resolution, imageFormat, jpegQuality):
+        '''PdfImporter-specific constructor.'''
+        if imageFormat not in self.devices:
+            raise PodError(self.WRONG_IMAGE_FORMAT % \
+                           (imageFormat, ', '.join(self.devices)))
+        # p_pages is a tuple (i_first, i_last) of the pages to import, the
+        # first page being page 1. If None, all pages are imported.
+        self.pages = pages
+        self.resolution = resolution
+        self.imageFormat = imageFormat
+        # Between 0 and 100. If None, the default gs quality is used.
+        self.jpegQuality = jpegQuality
+
+    def getPageCount(self):
+        '''Returns the number of pages in the PDF file, or None if gs can't
+           tell. It is cached, like the pages themselves.'''
+        name = '%s-count' % self.pdfHash
+        res = imageCache.get('pdf', name)
+        if res: return res
+        path = self.importPath.replace('\\', '\\\\').replace('(', '\\(') \
+                              .replace(')', '\\)')
+        # In safer mode, gs may only read the PDF file
+        cmd = ['gs', '-q', '-dNODISPLAY', '-dSAFER',
+               '--permit-file-read=%s' % self.importPath, '-c',
+               '(%s) (r) file runpdfbegin pdfpagecount = quit' % path]
+        try:
+            out = subprocess.run(cmd, stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL).stdout
+            res = int(out.split()[-1])
+        except (OSError, ValueError, IndexError):
+            return
+        imageCache.set('pdf', name, res)
+        return res
+
+    def rasterize(self, first, last):
+        '''Rasterizes, with a gs process, pages p_first to p_last, or all
+           pages if p_first is None. Returns the images, as a list of bytes.'''
+        prefix = self.getUuid()
+        format = self.imageFormat
+        cmd = ['gs', '-dNOPAUSE', '-dBATCH', '-dSAFER', '-q',
+               '-sDEVICE=%s' % self.devices[format], '-r%d' % self.resolution]
+        if self.jpegQuality is not None:
+            cmd.append('-dJPEGQ=%d' % self.jpegQuality)
+        if first is not None:
+            cmd += ['-dFirstPage=%d' % first, '-dLastPage=%d' % last]
+        cmd += ['-sOutputFile=%s/%s%%d.%s' % (self.importFolder, prefix,
+                                              format), self.importPath]
+        try:
+            subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        except OSError:
+            # gs is not installed
+            return []
+        res = []
+        i = 1
+        while True:
+            name = '%s/%s%d.%s' % (self.importFolder, prefix, i, format)
+            if not os.path.exists(name): break
+            f = open(name, 'rb')
+            res.append(f.read())
+            f.close()
+            os.remove(name)
             i += 1
-            nextImage = '%s/%s%d.jpg' % (imagesFolder, imagePrefix, i)
-            if os.path.exists(nextImage):
-                # Use internally an Image importer for doing this job.
-                imgImporter= ImageImporter(None, nextImage, 'jpg',self.renderer)
-                imgImporter.init('paragraph', True, None, None, None)
-                self.res += imgImporter.run()
-                os.remove(nextImage)
+        return res
+
+    def importImage(self, content):
+        '''Imports, into the result, this image representing a page.'''
+        # Use internally an Image importer for doing this job
+        importer = ImageImporter(content, None, self.imageFormat, self.renderer)
+        importer.init('paragraph', True, None, None, None)
+        self.res += importer.run()
+
+    def getCacheName(self, page):
+        '''Returns the name of this p_page in the image cache.'''
+        return '%s-%d-%s-%s-%d' % (self.pdfHash, self.resolution,
+                                   self.imageFormat, self.jpegQuality, page)
+
+    def run(self):
+        # Rasterized pages and the page count are cached, under a hash of the
+        # PDF file.
+        f = open(self.importPath, 'rb')
+        self.pdfHash = hashlib.sha1(f.read()).hexdigest()
+        f.close()
+        count = self.getPageCount()
+        if self.pages:
+            first, last = self.pages
+            if count: last = min(last, count)
+        elif count:
+            first, last = 1, count
+        else:
+            # Rasterize the whole document with a single gs process
+            images = self.rasterize(None, None)
+            if not images: raise PodError(PDF_TO_IMG_ERROR)
+            for image in images: self.importImage(image)
+            return self.res
+        pages = {} # ~{i_page: bytes or Future}~
+        missing = []
+        for page in range(first, last + 1):
+            content = imageCache.get('pdf', self.getCacheName(page))
+            if content is None:
+                missing.append(page)
+            else:
+                pages[page] = content
+        # Split missing pages into ranges of consecutive pages, rasterized in
+        # parallel.
+        chunks = []
+        for page in missing:
+            if chunks and (chunks[-1][1] == page - 1) and \
+               (page - chunks[-1][0] < self.chunkSize):
+                chunks[-1][1] = page
             else:
-                noMoreImages = True
+                chunks.append([page, page])
+        executor = ThreadPoolExecutor(self.maxProcesses)
+        futures = []
+        try:
+            for start, end in chunks:
+                future = executor.submit(self.rasterize, start, end)
+                futures.append(future)
+                for page in range(start, end + 1): pages[page] = (future, start)
+            # Import pages in their order, as soon as they are ready
+            imported = False
+            for page in range(first, last + 1):
+                content = pages[page]
+                if isinstance(content, tuple):
+                    future, start = content
+                    images = future.result()
+                    if page - start >= len(images):
+                        if not images: raise PodError(PDF_TO_IMG_ERROR)
+                        raise PodError(PDF_PAGE_ERROR % page)
+                    content = images[page - start]
+                    imageCache.set('pdf', self.getCacheName(page), content)
+                self.renderer.checkCancelled()
+                self.importImage(content)
+                imported = True
+        finally:
+            # If the rendering was cancelled or failed, ranges of pages that
+            # are not being rasterized yet will not be.
+            for future in futures: future.cancel()
+            executor.shutdown()
+        if not imported: raise PodError(PDF_TO_IMG_ERROR)
         return self.res
 
 class ConvertImporter(DocImporter):
     '''This class allows to import the content of any file that LibreOffice (LO)
        can convert into PDF: doc, rtf, xls. It first calls LO to convert the
        document into PDF, then calls a PdfImporter.'''
+    # Parameters for the PdfImporter (see PdfImporter.init)
+    pdfParams = (None, PdfImporter.resolution, PdfImporter.imageFormat,
+                 PdfImporter.jpegQuality)
     def getImportFolder(self): return '%s/docImports' % self.tempFolder
+
+    def init(self, pages, resolution, imageFormat, jpegQuality):
+        '''ConvertImporter-specific constructor.'''
+        self.pdfParams = (pages, resolution, imageFormat, jpegQuality)
+
     def run(self):
         # Convert the document into PDF with LibreOffice
         output = self.renderer.callLibreOffice(self.importPath, 'pdf')
@@ -224,6 +431,7 @@ class ConvertImporter(DocImporter):
         pdfFile = '%s.pdf' % os.path.splitext(self.importPath)[0]
         # Launch a PdfImporter to import this PDF into the POD result.
         pdfImporter = PdfImporter(None, pdfFile, 'pdf', self.renderer)
+        pdfImporter.init(*self.pdfParams)
         return pdfImporter.run()
 
 # Compute size of images -------------------------------------------------------
@@ -269,6 +477,139 @@ def getSize(filePath, fileType):
     else:
         return x, y
 
+# ------------------------------------------------------------------------------
+class ImageCache:
+    '''LRU cache, shared by all renderers, of the sizes of images and of the
+       PNG versions of SVG images. Images are identified by the names given to
+       them by the ImageStore, made of a hash of their content: repeated
+       renderings of the same images do not need to parse them or convert them
+       again.'''
+    def __init__(self, maxItems=1000, maxSize=20*1024*1024):
+        # The maximum number of entries to keep
+        self.maxItems = maxItems
+        # The maximum size of the cached PNG images, in bytes
+        self.maxSize = maxSize
+        # The cached entries, as a dict ~{(s_kind, s_name): value}~. For kind
+        # "size", the value is a tuple (width, height); for kind "png", it is
+        # the content of the PNG image; for kind "pdf", it is the content of a
+        # rasterized PDF page or the page count of a PDF file (see
+        # PdfImporter).
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, kind, name):
+        '''Returns the entry of this p_kind for the image named p_name, or None
+           if it is not in the cache.'''
+        key = (kind, name)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+
+    def set(self, kind, name, value):
+        '''Caches this p_value as the entry of this p_kind for the image named
+           p_name.'''
+        key = (kind, name)
+        size = isinstance(value, bytes) and len(value) or 0
+        if size > self.maxSize: return
+        with self.lock:
+            if key in self.entries: self.remove(key)
+            self.entries[key] = value
+            self.size += size
+            # Remove the least recently used entries when limits are exceeded
+            while (len(self.entries) > self.maxItems) or \
+                  (self.size > self.maxSize):
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        '''Removes the entry stored at p_key.'''
+        value = self.entries.pop(key)
+        if isinstance(value, bytes): self.size -= len(value)
+
+    def clear(self):
+        '''Empties the cache.'''
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def getSize(self, path, format):
+        '''Returns the size of the image at p_path (see function getSize).'''
+        name = os.path.basename(path)
+        res = self.get('size', name)
+        if res is None:
+            res = getSize(path, format)
+            self.set('size', name, res)
+        return res
+
+    def convertSvg(self, path, pngPath):
+        '''Converts the SVG image at p_path into a PNG image at p_pngPath.'''
+        name = os.path.basename(path)
+        content = self.get('png', name)
+        if content is None:
+            err = os.system('convert "%s" "%s"' % (path, pngPath))
+            if err:
+                raise Exception(CONVERT_ERROR)
+            f = open(pngPath, 'rb')
+            self.set('png', name, f.read())
+            f.close()
+        else:
+            f = open(pngPath, 'wb')
+            f.write(content)
+            f.close()
+
+# The cache used by all image importers
+imageCache = ImageCache()
+
+class ImageStore:
+    '''Stores the images imported into a POD result, in its "Pictures" folder,
+       under names made of a SHA-1 hash of their content: an image imported
+       several times, from the same file or URL or not, is stored only once.'''
+    def __init__(self):
+        # The stored images, as a dict ~{s_name: s_path}~, where s_name is
+        # the hash of the image followed by its extension.
+        self.paths = {}
+        # The paths of the images imported from a file or URL, as a dict
+        # ~{s_at: s_path}~: such images are not read again.
+        self.ats = {}
+
+    def getPath(self, at):
+        '''Returns the path to the image that was imported from p_at, or None
+           if it was never imported.'''
+        return self.ats.get(at)
+
+    def add(self, path, at=None):
+        '''Adds the image being at p_path, imported from p_at if given, to the
+           store, and returns the path where it is finally stored. If the same
+           image is already stored, the file at p_path is removed.'''
+        sha = hashlib.sha1()
+        f = open(path, 'rb')
+        while True:
+            chunk = f.read(65536)
+            if not chunk: break
+            sha.update(chunk)
+        f.close()
+        name = sha.hexdigest() + os.path.splitext(path)[1]
+        res = self.paths.get(name)
+        if res:
+            os.remove(path)
+        else:
+            res = os.path.join(os.path.dirname(path), name)
+            os.rename(path, res)
+            self.paths[name] = res
+        if at: self.ats[at] = res
+        return res
+
+    def replace(self, path, newPath):
+        '''The image stored at p_path has been converted into p_newPath (ie, a
+           SVG image converted into PNG): use p_newPath instead.'''
+        for paths in (self.paths, self.ats):
+            for key, value in paths.items():
+                if value == path: paths[key] = newPath
+
 class ImageImporter(DocImporter):
     '''This class allows to import into the ODT result an image stored
        externally.'''
@@ -281,17 +622,32 @@ class ImageImporter(DocImporter):
     def moveFile(self, at, importPath):
         '''Copies file at p_at into the ODT file at p_importPath.'''
         # Has this image already been imported ?
-        for imagePath, imageAt in list(self.fileNames.items()): 
-            if imageAt == at:
-                # Yes!
-                i = importPath.rfind(self.pictFolder) + 1
-                return importPath[:i] + imagePath
-        # The image has not already been imported: copy it.
+        res = self.renderer.imageStore.getPath(at)
+        if res:
+            self.format = os.path.splitext(res)[1][1:]
+            return res
+        return self.storeFile(self.copyFile(at, importPath), at)
+
+    def storeFile(self, path, at=None):
+        '''Adds the image at p_path to the image store: if the same image is
+           already part of the result, it is reused.'''
+        res = self.renderer.imageStore.add(path, at)
+        self.format = os.path.splitext(res)[1][1:]
+        return res
+
+    def copyFile(self, at, importPath):
+        '''Copies file at p_at into the ODT file at p_importPath.'''
         if not at.startswith('http'):
             shutil.copy(at, importPath)
             return importPath
-        # The image must be retrieved via a URL. Try to perform a HTTP GET.
-        response = Resource(at).get()
+        # The image must be retrieved via a URL. Try to perform a HTTP GET, or
+        # get the image from the image fetcher, that may have downloaded it
+        # already.
+        fetcher = self.renderer.imageFetcher
+        if fetcher:
+            response = fetcher.get(at)
+        else:
+            response = Resource(at).get()
         if response.code == 200:
             # At last, I can get the file format.
             self.format = mimeTypesExts[response.headers['Content-Type']]
@@ -366,17 +722,18 @@ class ImageImporter(DocImporter):
         # Compute path to image
         i = self.importPath.rfind(self.pictFolder)
         imagePath = self.importPath[i+1:].replace('\\', '/')
-        self.fileNames[imagePath] = self.at
         # In the case of SVG files, perform an image conversion to PNG
         if imagePath.endswith('.svg'):
             newImportPath = os.path.splitext(self.importPath)[0] + '.png'
-            err= os.system('convert "%s" "%s"'% (self.importPath,newImportPath))
-            if err:
-                raise Exception(CONVERT_ERROR)
+            imageCache.convertSvg(self.importPath, newImportPath)
             os.remove(self.importPath)
+            self.renderer.imageStore.replace(self.importPath, newImportPath)
             self.importPath = newImportPath
             imagePath = os.path.splitext(imagePath)[0] + '.png'
             self.format = 'png'
+        # Declare the image under its final name: the same image, imported
+        # several times, is declared once.
+        self.fileNames[imagePath] = self.at
         # Retrieve image size from self.size
         width = height = None
         if self.size and (self.sizeUnit != 'pc'):
@@ -392,7 +749,7 @@ class ImageImporter(DocImporter):
             height = float(self.cssAttrs['height']) / pxToCm
         # If width and/or height is missing, compute it.
         if not width or not height:
-            width, height = getSize(self.importPath, self.format)
+            width, height = imageCache.getSize(self.importPath, self.format)
             if self.sizeUnit == 'pc':
                 # Apply the given percentage to the real width and height.
                 width = width * (float(self.size[0])/100)
@@ -15,11 +15,21 @@
 # Appy. If not, see <http://www.gnu.org/licenses/>.
 
 # ------------------------------------------------------------------------------
-from xml.sax.saxutils import quoteattr
 from appy.shared.xml_parser import XmlElement
 from appy.pod.odf_parser import OdfEnvironment as ns
 from appy.pod import PodError
 
+# ------------------------------------------------------------------------------
+def compileExpression(expr):
+    '''Compiles Python expression p_expr and returns the code object, that can
+       be evaluated many times without being compiled again. If p_expr can't
+       be compiled, it is returned as is: the error will be raised when
+       evaluating it.'''
+    try:
+        return compile(expr, '<string>', 'eval')
+    except Exception:
+        return expr
+
 # ------------------------------------------------------------------------------
 class PodElement:
     OD_TO_POD = {'p': 'Text', 'h': 'Title', 'section': 'Section',
@@ -99,51 +109,37 @@ class Expression(PodElement):
     def __init__(self, py, pod):
         # Extract parts from expression p_py.
         self.escapeXml, self.expr, self.errorExpr = self.extractInfo(py.strip())
+        # The compiled versions of self.expr and self.errorExpr
+        self.code = compileExpression(self.expr)
+        self.errorCode = self.errorExpr and compileExpression(self.errorExpr)
         self.pod = pod # True if I work for pod, False if I work for px.
-        if self.pod:
-            # pod-only: store here the expression's true result (before being
-            # converted to a string).
-            self.result = None
-            # pod-only: the following bool indicates if this Expression instance
-            # has already been evaluated or not. Expressions which are tied to
-            # attribute hooks are already evaluated when the tied hook is
-            # evaluated: this boolean prevents the expression from being
-            # evaluated twice.
-            self.evaluated = False
-            # self.result and self.evaluated are not used by PX, because they
-            # are not thread-safe.
 
     def _eval(self, context):
         '''Evaluates self.expr with p_context. If self.errorExpr is defined,
            evaluate it if self.expr raises an error.'''
         if self.errorExpr:
             try:
-                res = eval(self.expr, context)
+                res = eval(self.code, context)
             except Exception:
-                res = eval(self.errorExpr, context)
+                res = eval(self.errorCode, context)
         else:
-            res = eval(self.expr, context)
+            res = eval(self.code, context)
         return res
 
-    def evaluate(self, context):
+    def evaluate(self, context, state=None):
         '''Evaluates the Python expression (self.expr) with a given
            p_context, and returns the result. More precisely, it returns a
            tuple (result, escapeXml). Boolean escapeXml indicates if XML chars
            must be escaped or not.'''
         escapeXml = self.escapeXml
-        # Evaluate the expression, or get it from self.result if it has already
-        # been computed.
-        if self.pod and self.evaluated:
-            res = self.result
-            # It can happen only once, to ask to evaluate an expression that
-            # was already evaluated (from the tied hook). We reset here the
-            # boolean "evaluated" to allow for the next evaluation, probably
-            # with another context.
-            self.evaluated = False
+        # pod-only: expressions which are tied to attribute hooks are already
+        # evaluated when the tied hook is evaluated: get the result from
+        # p_state (a appy.pod.buffers.RenderState instance), where the hook has
+        # stored it, instead of evaluating the expression twice.
+        if state and (self in state.results):
+            res = state.results.pop(self)
         else:
             res = self._eval(context)
-            # pod-only: cache the expression result.
-            if self.pod: self.result = res
         # Converts the expr result to a string that can be inserted in the
         # pod/px result.
         resultType = res.__class__.__name__
@@ -171,46 +167,47 @@ class Attributes(PodElement):
     dateTypes = ('DateTime',)
 
     def __init__(self, env):
-        self.attrs = {}
         # Depending on the result of a tied expression, we will dump, for
         # another tag, the series of attrs that this instance represents.
         self.tiedExpression = None
         # We will need the env to get the full names of attributes to dump.
         self.env = env
 
-    def computeAttributes(self, expr):
-        '''p_expr has been evaluated: its result is in expr.result. Depending
-           on its type, we will dump the corresponding attributes in
-           self.attrs.'''
-        exprType = expr.result.__class__.__name__
+    def computeAttributes(self, result, attrs):
+        '''The tied expression has been evaluated to p_result. Depending on
+           its type, we will dump the corresponding attributes in p_attrs.'''
+        exprType = result.__class__.__name__
         tags = self.env.tags
-        attrs = self.attrs
         if exprType in self.floatTypes:
             attrs[tags['value-type']] = 'float'
-            attrs[tags['value']] = str(expr.result)
+            attrs[tags['value']] = str(result)
         elif exprType in self.dateTypes:
             attrs[tags['value-type']] = 'date'
-            attrs[tags['value']] = expr.result.strftime('%Y-%m-%d')
+            attrs[tags['value']] = result.strftime('%Y-%m-%d')
         else:
             attrs[tags['value-type']] = 'string'
 
-    def evaluate(self, context):
-        # Evaluate first the tied expression, in order to determine its type.
+    def evaluate(self, context, state):
+        '''Evaluates the tied expression, in order to determine its type, and
+           returns the attributes to dump. The expression result is stored in
+           p_state (a appy.pod.buffers.RenderState instance), where the tied
+           expression will get it instead of being evaluated again.'''
+        expr = self.tiedExpression
         try:
-            self.tiedExpression.evaluate(context)
-            self.tiedExpression.evaluated = True
-        except Exception as e:
-            # Don't set "evaluated" to True. This way, when the buffer will
-            # evaluate the expression directly, we will really evaluate it, so
-            # the error will be dumped into the pod result.
-            pass
-        # Analyse the return type of the expression.
-        self.computeAttributes(self.tiedExpression)
-        # Now, self.attrs has been populated. Transform it into a string.
-        res = ''
-        for name, value in self.attrs.items():
-            res += ' %s=%s' % (name, quoteattr(value))
-        return res
+            result = state.results[expr] = expr._eval(context)
+        except Exception:
+            # Don't store any result. This way, when the buffer will evaluate
+            # the expression directly, we will really evaluate it, so the error
+            # will be dumped into the pod result.
+            result = None
+        # Analyse the type of the result. Attributes are kept from one
+        # evaluation to the next, within the same rendering.
+        attrs = state.attrs.get(self)
+        if attrs is None: attrs = state.attrs[self] = {}
+        self.computeAttributes(result, attrs)
+        # Transform the attributes into a string. Values are type names,
+        # numbers or dates: they never need to be escaped.
+        return ''.join([' %s="%s"' % item for item in attrs.items()])
 
 class Attribute(PodElement):
     '''Represents an HTML special attribute like "selected" or "checked".
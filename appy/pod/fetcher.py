@@ -0,0 +1,137 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import re, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from appy.shared.dav import Resource, urlRex
+
+# ------------------------------------------------------------------------------
+class ImageFetcher:
+    '''Downloads images available via HTTP concurrently, before they are
+       imported into a POD result. Pass an ImageFetcher instance to a Renderer
+       (parameter "imageFetcher"): every image imported from a URL, via
+       function "document" or via a "img" tag in a XHTML chunk, is then read
+       from the fetcher instead of being downloaded at the time it is imported.
+
+       Images from XHTML chunks are prefetched automatically: all images from
+       a chunk are downloaded in parallel before the chunk is converted. Images
+       imported via function "document" can only be known while the template
+       is evaluated: for downloading them in parallel, call m_prefetch with
+       their URLs before rendering.
+
+       Downloads are performed by a bounded pool of threads, each one keeping
+       a connection alive to every server it has already contacted. Downloaded
+       images are kept in memory, so the same fetcher can be shared by several
+       renderers: only the p_maxImages most recently used ones are kept, and
+       failed downloads are forgotten, so they are retried the next time they
+       are requested. Call m_clear to free this memory.'''
+
+    # Finds the URLs of images in a chunk of XHTML
+    imgRex = re.compile(r'<img\s[^>]*?src\s*=\s*["\'](https?://[^"\']+)["\']',
+                        re.I)
+
+    def __init__(self, maxWorkers=8, username=None, password=None,
+                 maxImages=500):
+        # The maximum number of images being downloaded at the same time
+        self.executor = ThreadPoolExecutor(maxWorkers)
+        # Credentials to use for every download, if any
+        self.username = username
+        self.password = password
+        # The downloads, as an ordered dict ~{s_url: Future}~, from the least
+        # to the most recently used. The result of every future is a
+        # appy.shared.dav.HttpResponse instance.
+        self.downloads = OrderedDict()
+        # The maximum number of downloads to keep
+        self.maxImages = maxImages
+        self.lock = threading.Lock()
+        # Every thread has its own connections, as a dict
+        # ~{(s_host, i_port): Resource}~.
+        self.local = threading.local()
+
+    def download(self, url):
+        '''Performs a HTTP GET on p_url (runs in a thread from the pool).'''
+        resources = getattr(self.local, 'resources', None)
+        if resources is None:
+            resources = self.local.resources = {}
+        host, port, uri = urlRex.match(url).groups()
+        port = port and int(port[1:]) or 80
+        resource = resources.get((host, port))
+        if not resource:
+            resource = Resource(url, self.username, self.password,
+                                keepAlive=True)
+            resources[(host, port)] = resource
+        # Pass a new dict of headers: the default one is shared by all threads
+        return resource.get(uri or '/', headers={})
+
+    def submit(self, url):
+        '''Starts downloading p_url, if not already done, and returns the
+           corresponding future.'''
+        with self.lock:
+            res = self.downloads.get(url)
+            if res:
+                self.downloads.move_to_end(url)
+                return res
+            res = self.downloads[url] = \
+                  self.executor.submit(self.download, url)
+            # Forget the least recently used downloads
+            while len(self.downloads) > self.maxImages:
+                self.downloads.popitem(last=False)
+        # Outside the lock: if the download is already finished, the callback
+        # is called immediately.
+        res.add_done_callback(lambda future: self.forgetFailed(url, future))
+        return res
+
+    def forgetFailed(self, url, future):
+        '''Called when the download of p_url, in p_future, is finished. If it
+           failed, it is forgotten.'''
+        if not future.cancelled() and (future.exception() is None) and \
+           (future.result().code == 200): return
+        with self.lock:
+            if self.downloads.get(url) is future: del self.downloads[url]
+
+    def prefetch(self, urls):
+        '''Starts downloading all these p_urls, in parallel.'''
+        for url in urls:
+            if url.startswith('http'): self.submit(url)
+
+    def prefetchXhtml(self, xhtml):
+        '''Starts downloading all the images referenced in this chunk of
+           p_xhtml, in parallel.'''
+        if xhtml and ('<img' in xhtml):
+            # The XHTML parser will unescape the URLs
+            self.prefetch([url.replace('&amp;', '&') \
+                           for url in self.imgRex.findall(xhtml)])
+
+    def get(self, url):
+        '''Returns the HttpResponse for p_url, waiting for its download to be
+           finished. Exceptions raised while downloading it are raised
+           here.'''
+        return self.submit(url).result()
+
+    def clear(self):
+        '''Forgets all downloaded images.'''
+        with self.lock:
+            self.downloads = OrderedDict()
+
+    def close(self):
+        '''Waits for the running downloads to be finished and stops the
+           threads.'''
+        self.executor.shutdown()
+# ------------------------------------------------------------------------------
@@ -48,7 +48,7 @@ class OdfEnvironment(XmlEnvironment):
 
 class OdfParser(XmlParser):
     '''XML parser that is specific for parsing ODF files.'''
-    def __init__(self, env=None, caller=None):
+    def __init__(self, env=None, caller=None, backend='sax'):
         if not env: env = OdfEnvironment()
-        XmlParser.__init__(self, env, caller)
+        XmlParser.__init__(self, env, caller, backend=backend)
 # ------------------------------------------------------------------------------
@@ -0,0 +1,299 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os, os.path, re
+from xml.sax.saxutils import unescape
+from appy.shared.xml_parser import escapeXml
+from appy.pod.odf_parser import OdfEnvironment, OdfParser
+
+# ------------------------------------------------------------------------------
+# The elements representing indexes (tables of contents...), whose content is
+# computed by LibreOffice.
+indexRex = re.compile(r'<\w+:(table-of-content|alphabetical-index|'
+                      r'illustration-index|table-index|object-index|'
+                      r'user-index|bibliography)[\s/>]')
+indexBytesRex = re.compile(indexRex.pattern.encode())
+
+def hasIndexes(content):
+    '''Has this p_content (a XML file, as bytes or string) indexes?'''
+    rex = isinstance(content, bytes) and indexBytesRex or indexRex
+    return bool(rex.search(content))
+
+# ------------------------------------------------------------------------------
+class MergerEnvironment(OdfEnvironment):
+    '''Environment for parsing the content.xml file of an ODT document to merge
+       into a POD result.'''
+    # Declarations found at the start of the body, that are not allowed
+    # elsewhere.
+    declarations = ('sequence-decls', 'variable-decls', 'user-field-decls',
+                    'dde-connection-decls', 'forms', 'calculation-settings')
+
+    def __init__(self, merger):
+        OdfEnvironment.__init__(self)
+        self.merger = merger
+        # The namespace prefixes used in the merged document, as a dict
+        # ~{s_prefix: s_namespaceUri}~.
+        self.uris = {'xml': 'xml', '': ''}
+        # The chunks of the automatic styles and of the body being dumped
+        self.styles = []
+        self.body = []
+        # The list of chunks being currently filled, or None if the current
+        # element is not part of the automatic styles or of the body.
+        self.current = None
+        # The depth of the current element within the automatic styles or body
+        self.depth = 0
+        # The depth of the current element within an element being ignored
+        self.ignoring = 0
+        # Becomes True when the body of the document is found
+        self.foundBody = False
+
+    def manageNamespaces(self, attrs):
+        OdfEnvironment.manageNamespaces(self, attrs)
+        for name, value in attrs.items():
+            if name.startswith('xmlns:'): self.uris[name[6:]] = value
+
+    def split(self, name):
+        '''Returns a tuple (s_namespaceUri, s_name) for this prefixed p_name.
+           s_namespaceUri is None if the prefix is unknown.'''
+        if ':' in name:
+            prefix, name = name.split(':', 1)
+        else:
+            prefix = ''
+        return self.uris.get(prefix), name
+
+    def getPrefix(self, uri):
+        '''Returns the prefix of namespace p_uri in the merged document.'''
+        for prefix, value in self.uris.items():
+            if value == uri: return prefix
+
+class MergerParser(OdfParser):
+    '''Parses the content.xml file of an ODT document and dumps its automatic
+       styles and body, being adapted to the POD result.'''
+    def startElement(self, elem, attrs):
+        e = self.env
+        e.manageNamespaces(attrs)
+        if e.ignoring:
+            e.ignoring += 1
+            return
+        uri, name = e.split(elem)
+        if e.current is None:
+            if uri == e.NS_OFFICE:
+                if name == 'automatic-styles':
+                    e.current = e.styles
+                elif name == 'text':
+                    e.current = e.body
+                    e.foundBody = True
+            return
+        if (e.current is e.body) and (e.depth == 0) and \
+           (name in e.declarations):
+            e.ignoring = 1
+            return
+        # The namespaces used by this element but not declared by the POD
+        # result, as a dict ~{s_prefix: s_uri}~, are declared on the element.
+        declared = {}
+        tag = e.merger.getName(uri, name, declared)
+        if not tag:
+            # A prefix that the merged document does not declare
+            e.ignoring = 1
+            return
+        res = ['<', tag]
+        inStyles = e.current is e.styles
+        for attrName, value in attrs.items():
+            if attrName.startswith('xmlns:'): continue
+            attrUri, attrName = e.split(attrName)
+            fullName = e.merger.getName(attrUri, attrName, declared)
+            if not fullName: continue
+            value = e.merger.getValue(attrUri, attrName, value, inStyles)
+            res.append(' %s="%s"' % (fullName, escapeXml(value)))
+        for prefix, nsUri in declared.items():
+            res.append(' xmlns:%s="%s"' % (prefix, escapeXml(nsUri)))
+        res.append('>')
+        e.current.append(''.join(res))
+        e.depth += 1
+
+    def endElement(self, elem):
+        e = self.env
+        if e.ignoring:
+            e.ignoring -= 1
+            return
+        if e.current is None: return
+        if e.depth == 0:
+            # The end of the automatic styles or body
+            e.current = None
+            return
+        e.depth -= 1
+        e.current.append('</%s>' % e.merger.getName(*e.split(elem)))
+
+    def characters(self, content):
+        e = self.env
+        if (e.current is not None) and not e.ignoring:
+            e.current.append(escapeXml(content))
+
+# ------------------------------------------------------------------------------
+class OdtMerger:
+    '''Merges the content of an ODT document into a POD result, without calling
+       LibreOffice: the body of the document is converted into a chunk of ODF
+       content to insert into the result; its automatic styles are added to
+       the result's dynamic styles and its pictures are added to the result's
+       image store.
+
+       Automatic styles are renamed, in order to avoid clashes with the
+       automatic styles of the result. Named styles, from the document's
+       styles.xml, and fonts are not merged: the result's named styles and
+       fonts having the same names are used instead.
+
+       Indexes (tables of contents...) can't be updated without LibreOffice:
+       if the result or the merged document contains indexes, LibreOffice is
+       still called, to update them (see Renderer.forceOoCall).'''
+    # Finds the automatic styles in content.xml
+    stylesRex = re.compile(
+        r'<(\w+):automatic-styles>(.*?)</\1:automatic-styles>', re.S)
+    # Finds the names of the automatic styles
+    namesRex = re.compile(r'\s\w+:name="([^"]*)"')
+    # Finds elements that can't be merged without LibreOffice: embedded objects
+    # are stored in sub-folders of the ODT file, and linked sections must be
+    # loaded by LibreOffice.
+    unmergeableRex = re.compile(
+        r'<\w+:(object|object-ole|section-source)[\s/>]')
+
+    def __init__(self, renderer, source, readFile, styles=None):
+        self.renderer = renderer
+        # The merged document (ie, its path), as stored in renderer.fileNames
+        # for its pictures.
+        self.source = source
+        # A function returning the content of a file from the merged document,
+        # given its name, or raising a KeyError if it does not exist.
+        self.readFile = readFile
+        # The namespaces of the POD result, as a dict ~{s_uri: s_prefix}~
+        self.namespaces = renderer.currentParser.env.namespaces
+        # If p_styles is given, the automatic styles of this document are
+        # already part of the result, because another document having the same
+        # automatic styles has already been merged: p_styles is the value of
+        # m_getStyles for this other document.
+        self.stylesMerged = bool(styles)
+        if styles:
+            self.prefix, self.styleNames = styles
+        else:
+            renderer.mergedOdts += 1
+            self.prefix = 'PodImport%d.' % renderer.mergedOdts
+            # The names of the automatic styles to rename
+            self.styleNames = set()
+        # The pictures being merged, as a dict ~{s_name: s_resultName}~
+        self.pictures = {}
+        # The namespaces of the document that the POD result does not declare
+        # (ie, LibreOffice extensions), as a dict ~{s_uri: s_prefix}~.
+        self.extraNamespaces = {}
+        # The environment of the MergerParser (see m_run)
+        self.env = None
+
+    def getExtraPrefix(self, uri):
+        '''Returns the prefix to use, in the result, for namespace p_uri that
+           the result does not declare. It is the document's prefix, excepted
+           if the result uses it for another namespace.'''
+        res = self.extraNamespaces.get(uri)
+        if res: return res
+        used = set(self.namespaces.values())
+        used.update(self.extraNamespaces.values())
+        base = res = self.env.getPrefix(uri) or 'ns'
+        i = 1
+        while res in used:
+            res = '%s%d' % (base, i)
+            i += 1
+        self.extraNamespaces[uri] = res
+        return res
+
+    def getName(self, uri, name, declared=None):
+        '''Returns the name of element or attribute p_name, from namespace
+           p_uri, as it must appear in the result, or None if p_uri is None.
+           If the result does not declare p_uri, it is added to dict
+           p_declared: the element being dumped must declare it.'''
+        if uri is None: return
+        if uri in ('', 'xml'):
+            prefix = uri
+        else:
+            prefix = self.namespaces.get(uri)
+            if not prefix:
+                prefix = self.getExtraPrefix(uri)
+                if declared is not None: declared[prefix] = uri
+        return prefix and ('%s:%s' % (prefix, name)) or name
+
+    def getValue(self, uri, name, value, inStyles):
+        '''Returns the p_value of attribute p_name, from namespace p_uri, as it
+           must appear in the result.'''
+        if name.endswith('style-name') or (inStyles and (name == 'name')):
+            if value in self.styleNames: return self.prefix + value
+        elif name == 'class-names':
+            return ' '.join([(n in self.styleNames) and (self.prefix + n) or n \
+                             for n in value.split()])
+        elif (name == 'href') and value.startswith('Pictures/'):
+            return self.getPicture(value)
+        return value
+
+    def getPicture(self, name):
+        '''Adds, to the result, the picture named p_name in the document, and
+           returns its name in the result.'''
+        if name in self.pictures: return self.pictures[name]
+        r = self.renderer
+        # The picture may already be part of the result, if the document has
+        # been rendered by the renderer (see PodImporter).
+        if name in r.fileNames: return name
+        try:
+            content = self.readFile(name)
+        except KeyError:
+            return name
+        folder = os.path.join(r.getTempFolder(), 'unzip', 'Pictures')
+        if not os.path.exists(folder): os.makedirs(folder)
+        path = os.path.join(folder, '%s%s' % (self.prefix,
+                            os.path.basename(name)))
+        f = open(path, 'wb')
+        f.write(content)
+        f.close()
+        path = r.imageStore.add(path)
+        res = 'Pictures/%s' % os.path.basename(path)
+        r.fileNames[res] = self.source
+        self.pictures[name] = res
+        return res
+
+    def getStyles(self):
+        '''Returns the info allowing to merge other documents having the same
+           automatic styles as this one, without merging these styles again.'''
+        return self.prefix, self.styleNames
+
+    def run(self, content):
+        '''Merges the document whose content.xml is p_content. Returns its
+           body, as a chunk of ODF content, or None if the document can't be
+           merged without LibreOffice.'''
+        if self.unmergeableRex.search(content): return
+        styles = self.stylesRex.search(content)
+        if styles:
+            if self.stylesMerged:
+                # Do not parse them again
+                content = content[:styles.start()] + content[styles.end():]
+            else:
+                self.styleNames = set([unescape(name) for name in \
+                                      self.namesRex.findall(styles.group(2))])
+        env = self.env = MergerEnvironment(self)
+        MergerParser(env).parse(content)
+        if not env.foundBody: return
+        r = self.renderer
+        if env.styles: r.dynamicStyles.append(''.join(env.styles))
+        if r.compiledTemplate.hasIndexes or hasIndexes(content):
+            r.forceOoCall = True
+        return ''.join(env.body)
+# ------------------------------------------------------------------------------
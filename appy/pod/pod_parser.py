@@ -17,7 +17,7 @@
 # ------------------------------------------------------------------------------
 import re
 from appy.shared.xml_parser import XmlElement
-from appy.pod.buffers import FileBuffer, MemoryBuffer
+from appy.pod.buffers import RootBuffer, MemoryBuffer
 from appy.pod.odf_parser import OdfEnvironment, OdfParser
 from appy.pod.elements import *
 
@@ -109,9 +109,12 @@ class PodEnvironment(OdfEnvironment):
         self.currentOdsHook = None
         # Names of some tags, that we will compute after namespace propagation
         self.tags = None
-        # When an error occurs, must we raise it or write it into he current
-        # buffer?
+        # When an error occurs while parsing, must we raise it or write it into
+        # the current buffer? At render time, see appy.pod.buffers.RenderState.
         self.raiseOnError = None # Will be initialized by PodParser.__init__
+        # Must identical consecutive rows produced by "for" actions on table
+        # rows be compressed into a single row (ODS templates only) ?
+        self.compressRows = False
 
     def getTable(self):
         '''Gets the currently parsed table.'''
@@ -229,13 +232,10 @@ class PodEnvironment(OdfEnvironment):
 
 # ------------------------------------------------------------------------------
 class PodParser(OdfParser):
-    def __init__(self, env, caller):
-        OdfParser.__init__(self, env, caller)
+    def __init__(self, env, caller, backend='sax'):
+        OdfParser.__init__(self, env, caller, backend)
         env.raiseOnError = caller.raiseOnError
 
-    def endDocument(self):
-        self.env.currentBuffer.content.close()
-
     def startElement(self, elem, attrs):
         e = OdfParser.startElement(self, elem, attrs)
         ns = e.onStartElement()
@@ -339,11 +339,10 @@ class PodParser(OdfParser):
                                 parent.removeLastSubBuffer()
                                 e.currentBuffer = parent
                             else:
-                                if isinstance(parent, FileBuffer):
-                                    # Execute buffer action and delete the
-                                    # buffer.
-                                    e.currentBuffer.action.execute(parent,
-                                                                   e.context)
+                                if isinstance(parent, RootBuffer):
+                                    # Record the buffer, whose action will be
+                                    # executed at render time.
+                                    parent.addBuffer(e.currentBuffer)
                                     parent.removeLastSubBuffer()
                                 e.currentBuffer = parent
                             e.mode = e.ADD_IN_SUBBUFFER
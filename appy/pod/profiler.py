@@ -0,0 +1,128 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import time, json, threading
+
+# ------------------------------------------------------------------------------
+class Profiler:
+    '''Records where time is spent while rendering POD templates. Pass a
+       Profiler instance to a Renderer (parameter "profiler") and, after
+       rendering, get the report via m_getReport, m_getJson or
+       m_dumpCollapsed.
+
+       Measures are grouped by kind:
+       * "phase"      parsing the template, rendering content.xml and
+                      styles.xml, zipping the result and calling LibreOffice;
+       * "statement"  executing a POD statement (ie, "do row for ..."), labelled
+                      with the statement and its location in the template;
+       * "expression" evaluating a POD expression;
+       * "importer"   importing a document or image (ImageImporter,
+                      OdtImporter, PdfImporter...);
+       * "xhtml"      converting XHTML chunks to ODF.
+
+       Measures are nested: the time spent in a "for" statement includes the
+       time spent evaluating the expressions it contains. The same Profiler can
+       be used for several renderings, including renderings running at the
+       same time in several threads: measures are accumulated.'''
+
+    def __init__(self):
+        # Stats, as a dict ~{(s_kind, s_label): [i_count, f_seconds]}~
+        self.stats = {}
+        # Time spent in every stack of measures, excluding the time spent in
+        # sub-measures, as a dict ~{s_stack: f_seconds}~, where s_stack is a
+        # list of "kind:label" entries separated by semicolons.
+        self.stacks = {}
+        # Every thread has its own currently running measures, as a list of
+        # lists ~[s_kind, s_label, f_start, f_childrenSeconds]~ (see
+        # m_getRunning).
+        self.local = threading.local()
+        # Stats and stacks are updated by all threads
+        self.lock = threading.Lock()
+
+    def getRunning(self):
+        '''Returns the measures currently running in the current thread.'''
+        res = getattr(self.local, 'running', None)
+        if res is None: res = self.local.running = []
+        return res
+
+    def start(self, kind, label):
+        '''Starts measuring an operation of this p_kind, identified by this
+           p_label.'''
+        self.getRunning().append([kind, label, time.perf_counter(), 0.0])
+
+    def stop(self):
+        '''Stops measuring the last operation started in the current
+           thread.'''
+        running = self.getRunning()
+        kind, label, start, children = running.pop()
+        seconds = time.perf_counter() - start
+        key = (kind, label)
+        if running: running[-1][3] += seconds
+        # Semicolons separate stack entries: they can't be part of labels
+        stack = ';'.join(['%s:%s' % (m[0], m[1].replace(';', ',')) \
+                          for m in running + [key]])
+        with self.lock:
+            stat = self.stats.get(key)
+            if stat:
+                stat[0] += 1
+                stat[1] += seconds
+            else:
+                self.stats[key] = [1, seconds]
+            self.stacks[stack] = self.stacks.get(stack, 0.0) + seconds - \
+                                 children
+
+    def clear(self):
+        '''Forgets all measures.'''
+        with self.lock:
+            self.stats = {}
+            self.stacks = {}
+
+    def getReport(self):
+        '''Returns the measures as a dict ~{s_kind: [{}]}~. Every kind of
+           measure has a list of dicts with keys "label", "count", "seconds"
+           (the total time) and "average", sorted by decreasing total time.'''
+        res = {}
+        with self.lock:
+            stats = [(key, tuple(stat)) for key, stat in self.stats.items()]
+        for (kind, label), (count, seconds) in stats:
+            if kind not in res: res[kind] = []
+            res[kind].append({'label': label, 'count': count,
+                              'seconds': seconds, 'average': seconds / count})
+        for measures in res.values():
+            measures.sort(key=lambda m: m['seconds'], reverse=True)
+        return res
+
+    def getJson(self, indent=2):
+        '''Returns the report (see m_getReport) as a JSON string.'''
+        return json.dumps(self.getReport(), indent=indent)
+
+    def dumpCollapsed(self, path):
+        '''Dumps, in the file at p_path, the measures in the "collapsed stack"
+           format, as understood by flame graph tools like flamegraph.pl or
+           speedscope: one line per stack, followed by the time spent in it, in
+           microseconds.'''
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+        f = open(path, 'w', encoding='utf-8')
+        for stack, seconds in stacks:
+            # A space separates the stack from the value
+            stack = stack.replace(' ', '_')
+            f.write('%s %d\n' % (stack, round(seconds * 1000000)))
+        f.close()
+# ------------------------------------------------------------------------------
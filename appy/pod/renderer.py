@@ -17,21 +17,24 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
 
 # ------------------------------------------------------------------------------
-import zipfile, shutil, xml.sax, os, os.path, re, mimetypes, time
+import zipfile, shutil, xml.sax, os, os.path, re, mimetypes, time, io, \
+       threading, subprocess
 from collections import UserDict
 
 import appy.pod
-from appy.pod import PodError
+from appy.pod import PodError, RenderingCancelled
 from appy.shared import mimeTypes, mimeTypesExts
-from appy.shared.xml_parser import XmlElement
-from appy.shared.zip import unzip, zip
-from appy.shared.utils import FolderDeleter, executeCommand, FileWrapper
-from appy.pod.pod_parser import PodParser, PodEnvironment, OdInsert
+from appy.shared.zip import zip, ZipWriter
+from appy.shared.utils import FolderDeleter, FileWrapper, getTempFileName
+from appy.shared.xml_parser import XmlParser
+from appy.pod.pod_parser import PodEnvironment
 from appy.pod.converter import FILE_TYPES
-from appy.pod.buffers import FileBuffer
-from appy.pod.xhtml2odt import Xhtml2OdtConverter
+from appy.pod.template import CompiledTemplate, templateCache, \
+     CONTENT_POD_STYLES, CONTENT_POD_FONTS, STYLES_POD_STYLES, STYLES_POD_FONTS
+from appy.pod.xhtml2odt import Xhtml2OdtConverter, xhtmlCache
 from appy.pod.doc_importers import \
-     OdtImporter, ImageImporter, PdfImporter, ConvertImporter, PodImporter
+     OdtImporter, ImageImporter, PdfImporter, ConvertImporter, PodImporter, \
+     ImageStore
 from appy.pod.styles_manager import StylesManager
 
 # ------------------------------------------------------------------------------
@@ -70,24 +73,7 @@ DOC_FORMAT_ERROR = 'POD was unable to deduce the document format. Please ' \
                    'png, ...).'
 DOC_WRONG_FORMAT = 'Format "%s" is not supported.'
 WARNING_FINALIZE_ERROR = 'Warning: error while calling finalize function. %s'
-
-# Default automatic text styles added by pod in content.xml
-f = open('%s/styles.in.content.xml' % os.path.dirname(appy.pod.__file__))
-CONTENT_POD_STYLES = f.read()
-f.close()
-
-# Default font added by pod in content.xml
-CONTENT_POD_FONTS = '<@style@:font-face @style@:name="PodStarSymbol" ' \
-                    '@svg@:font-family="StarSymbol"/>'
-
-# Default text styles added by pod in styles.xml
-f = open('%s/styles.in.styles.xml' % os.path.dirname(appy.pod.__file__))
-STYLES_POD_STYLES = f.read()
-f.close()
-
-# Default font added by pod
-STYLES_POD_FONTS = '<@style@:font-face @style@:name="PodStarSymbol" ' \
-                   '@svg@:font-family="StarSymbol"/>'
+WRONG_XML_PARSER = 'Unknown XML parser "%s". Available parsers are: %s.'
 
 # do ... \n from text(...) is obsolete.
 OBSOLETE_RENDER_TEXT = 'Obsolete function. Use a pod expression instead ' \
@@ -101,7 +87,9 @@ class Renderer:
     def __init__(self, template, context, result, pythonWithUnoPath=None,
                  ooPort=2002, stylesMapping={}, forceOoCall=False,
                  finalizeFunction=None, overwriteExisting=False,
-                 raiseOnError=False, imageResolver=None, stylesTemplate=None):
+                 raiseOnError=False, imageResolver=None, stylesTemplate=None,
+                 cacheTemplate=False, converterPool=None, profiler=None,
+                 imageFetcher=None, xmlParser='sax'):
         '''This Python Open Document Renderer (PodRenderer) loads a document
            template (p_template) which is an ODT or ODS file with some elements
            written in Python. Based on this template and some Python objects
@@ -109,13 +97,22 @@ class Renderer:
            that instantiates the p_template and fills it with objects from the
            p_context.
 
+         - If p_result is not a file path but a binary file-like object (ie, a
+           BytesIO instance), the result is written into it; if p_result is
+           None, m_run returns the result as bytes. In both cases, the result
+           is produced in memory, without using the file system, excepted if
+           some external document must be imported, if a p_finalizeFunction
+           is defined or if LibreOffice must be called (see p_forceOoCall).
+
          - If p_result does not end with .odt or .ods, the Renderer will call
            LibreOffice to perform a conversion. If p_forceOoCall is True, even
            if p_result ends with .odt, LibreOffice will be called, not for
            performing a conversion, but for updating some elements like indexes
            (table of contents, etc) and sections containing links to external
-           files (which is the case, for example, if you use the default
-           function "document").
+           files. ODT documents imported via the default functions "document"
+           and "pod" are merged into the result by POD itself: LibreOffice is
+           only called for those that can't be merged (ie, documents
+           containing embedded objects), or if indexes must be updated.
 
          - If the Python interpreter which runs the current script is not
            UNO-enabled, this script will run, in another process, a UNO-enabled
@@ -148,10 +145,31 @@ class Renderer:
 
          - p_stylesTemplate can be the path to a LibreOffice file (ie, a .ott
            file) whose styles will be imported within the result.
+
+         - If p_cacheTemplate is True, the parsed p_template is kept in a cache
+           (see appy.pod.template.TemplateCache) and reused by any subsequent
+           renderer using the same, unmodified, template.
+
+         - If p_converterPool is given (a appy.pod.converter.ConverterPool
+           instance), LibreOffice is called through it: its instances are
+           already running and connected, instead of connecting to
+           LibreOffice on p_ooPort.
+
+         - If p_profiler is given (a appy.pod.profiler.Profiler instance), it
+           records the time spent in every phase of the rendering, POD
+           statement, expression, importer and XHTML conversion.
+
+         - If p_imageFetcher is given (a appy.pod.fetcher.ImageFetcher
+           instance), images imported from URLs are downloaded through it, in
+           parallel.
+
+         - p_xmlParser is the backend used for parsing the template: "sax"
+           (xml.sax) or "expat" (pyexpat, called without the xml.sax layer,
+           which is faster). Both produce the same result. It also applies to
+           the templates imported via function "pod".
         '''
         self.template = template
         self.result = result
-        self.contentXml = None # Content (string) of content.xml
         self.stylesXml = None # Content (string) of styles.xml
         self.stylesManager = None # Manages the styles defined into the ODT
         # template
@@ -165,61 +183,86 @@ class Renderer:
         self.raiseOnError = raiseOnError
         self.imageResolver = imageResolver
         self.stylesTemplate = stylesTemplate
+        self.cacheTemplate = cacheTemplate
+        self.converterPool = converterPool
+        self.profiler = profiler
+        self.imageFetcher = imageFetcher
+        if xmlParser not in XmlParser.backends:
+            raise PodError(WRONG_XML_PARSER % (xmlParser,
+                                               ', '.join(XmlParser.backends)))
+        self.xmlParser = xmlParser
+        # Set when the rendering is cancelled (see m_cancel)
+        self.cancelled = threading.Event()
+        # The LibreOffice conversion process currently running, if any
+        self.loProcess = None
         # Remember potential files or images that will be included through
         # "do ... from document" statements: we will need to declare them in
         # META-INF/manifest.xml. Keys are file names as they appear within the
         # ODT file (to dump in manifest.xml); values are original paths of
-        # included images (used for avoiding to create multiple copies of a file
-        # which is imported several times).
+        # included images. Copies of the same image are avoided by
+        # self.imageStore.
         self.fileNames = {}
-        self.prepareFolders()
-        # Unzip template
-        self.unzipFolder = os.path.join(self.tempFolder, 'unzip')
-        os.mkdir(self.unzipFolder)
-        info = unzip(template, self.unzipFolder, odf=True)
-        self.contentXml = info['content.xml'].decode('utf-8')
-        self.stylesXml = info['styles.xml'].decode('utf-8')
-        self.stylesManager = StylesManager(self.stylesXml)
+        # The images imported into the result, stored once per distinct content
+        self.imageStore = ImageStore()
+        # The number of ODT documents merged into the result (see
+        # appy.pod.odt_merger.OdtMerger)
+        self.mergedOdts = 0
+        # The POD templates imported via function "pod", compiled, as a dict
+        # ~{key: CompiledTemplate}~, keys being computed like in
+        # appy.pod.template.TemplateCache (see PodImporter).
+        self.subTemplates = {}
+        # The automatic styles of these templates, merged once into the result,
+        # as a dict ~{CompiledTemplate: (s_prefix, set_names)}~ (see
+        # appy.pod.odt_merger.OdtMerger.getStyles).
+        self.subTemplateStyles = {}
+        # Get the template, unzipped and parsed
+        if cacheTemplate:
+            compiled = self.profile('phase', 'parse', templateCache.get,
+                                    template, xmlParser)
+        else:
+            compiled = self.profile('phase', 'parse', CompiledTemplate,
+                                    template, xmlParser)
+        self.compiledTemplate = compiled
+        # Must the result be produced in memory?
+        self.inMemory = not isinstance(result, str)
+        # In memory, the result of evaluating content.xml and styles.xml
+        self.parts = {} # ~{s_name: s_content}~
+        self.unzipFolder = None
+        # Will the result be zipped directly from the compiled template and the
+        # rendered parts? (see m_canZipDirectly)
+        self.zipDirectly = False
+        # The template is only dumped into the unzip folder when it is needed
+        # (see m_getTempFolder).
+        if not self.inMemory: self.prepareFolders()
+        self.stylesXml = compiled.stylesXml
+        self.stylesManager = StylesManager(self.stylesXml,
+                                           compiled.parsedStyles)
         # From LibreOffice 3.5, it is not possible anymore to dump errors into
         # the resulting ods as annotations. Indeed, annotations can't reside
         # anymore within paragraphs. ODS files generated with pod and containing
         # error messages in annotations cause LibreOffice 3.5 and 4.0 to crash.
         # LibreOffice >= 4.1 simply does not show the annotation.
-        if info['mimetype'] == mimeTypes['ods']: self.raiseOnError = True
-        # Create the content.xml parser
-        pe = PodEnvironment
-        contentInserts = (
-            OdInsert(CONTENT_POD_FONTS,
-                XmlElement('font-face-decls', nsUri=pe.NS_OFFICE),
-                nsUris={'style': pe.NS_STYLE, 'svg': pe.NS_SVG}),
-            OdInsert(CONTENT_POD_STYLES,
-                XmlElement('automatic-styles', nsUri=pe.NS_OFFICE),
-                nsUris={'style': pe.NS_STYLE, 'fo': pe.NS_FO,
-                        'text': pe.NS_TEXT, 'table': pe.NS_TABLE}))
-        self.contentParser = self.createPodParser('content.xml', context,
-                                                  contentInserts)
-        # Create the styles.xml parser
-        stylesInserts = (
-            OdInsert(STYLES_POD_FONTS,
-                XmlElement('font-face-decls', nsUri=pe.NS_OFFICE),
-                nsUris={'style': pe.NS_STYLE, 'svg': pe.NS_SVG}),
-            OdInsert(STYLES_POD_STYLES,
-                XmlElement('styles', nsUri=pe.NS_OFFICE),
-                nsUris={'style': pe.NS_STYLE, 'fo': pe.NS_FO,
-                        'text': pe.NS_TEXT}))
-        self.stylesParser = self.createPodParser('styles.xml', context,
-                                                 stylesInserts)
+        if compiled.mimetype == mimeTypes['ods']: self.raiseOnError = True
+        # The parsers of content.xml and styles.xml, with their environments
+        self.contentParser = compiled.contentPart.parser
+        self.stylesParser = compiled.stylesPart.parser
+        # Create the contexts for evaluating content.xml and styles.xml
+        self.contentContext = self.createContext(context)
+        self.stylesContext = self.createContext(context)
         # Store the styles mapping
         self.setStylesMapping(stylesMapping)
         # While working, POD may identify "dynamic styles" to insert into
         # the "automatic styles" section of content.xml, like the column styles
         # of tables generated from XHTML tables via xhtml2odt.py.
         self.dynamicStyles = []
-
-    def createPodParser(self, odtFile, context, inserts):
-        '''Creates the parser with its environment for parsing the given
-           p_odtFile (content.xml or styles.xml). p_context is given by the pod
-           user, while p_inserts depends on the ODT file we must parse.'''
+        # The position, in the result content.xml, where dynamic styles must be
+        # inserted: an index in p_self.parts['content.xml'] when rendering in
+        # memory, an offset in the file in the temp folder else.
+        self.dynamicStylesAt = None
+
+    def createContext(self, context):
+        '''Creates the context for evaluating content.xml or styles.xml, from
+           the p_context given by the pod user.'''
         evalContext = {'xhtml': self.renderXhtml,
                        'text':  self.renderText,
                        'test': self.evalIfExpression,
@@ -232,22 +275,46 @@ class Renderer:
             evalContext.update(context)
         else:
             raise PodError(BAD_CONTEXT)
-        env = PodEnvironment(evalContext, inserts)
-        fileBuffer = FileBuffer(env, os.path.join(self.tempFolder,odtFile))
-        env.currentBuffer = fileBuffer
-        return PodParser(env, self)
+        return evalContext
+
+    @staticmethod
+    def renderMany(template, contexts, resultNaming, processes=None,
+                   chunkSize=1, **options):
+        '''Renders p_template once for every context from iterable p_contexts,
+           using a pool of p_processes worker processes. The template is parsed
+           only once per process. Returns an appy.pod.batch.BatchRenderer
+           instance: iterate over it to get the results as soon as they are
+           rendered, then call its method "getStats" to get throughput stats.
+           Other p_options are passed to every Renderer (ie, raiseOnError).'''
+        from appy.pod.batch import BatchRenderer
+        return BatchRenderer(template, contexts, resultNaming, processes,
+                             chunkSize, **options)
 
     def renderXhtml(self, xhtmlString, encoding='utf-8', stylesMapping={}):
         '''Method that can be used (under the name 'xhtml') into a pod template
            for converting a chunk of XHTML content (p_xhtmlString) into a chunk
-           of ODT content.'''
+           of ODT content. Conversions are cached (see
+           appy.pod.xhtml2odt.XhtmlCache).'''
+        rawMapping = stylesMapping
         stylesMapping = self.stylesManager.checkStylesMapping(stylesMapping)
         # xhtmlString can only be a chunk of XHTML. So we must surround it with
         # a tag in order to get a XML-compliant file (we need a root tag).
         if xhtmlString == None: xhtmlString = ''
+        # Download all images from this chunk in parallel, before converting it
+        if self.imageFetcher: self.imageFetcher.prefetchXhtml(xhtmlString)
+        # Reuse the result of a previous conversion of the same chunk
+        key = xhtmlCache.getKey(self, xhtmlString, rawMapping)
+        if key:
+            res = xhtmlCache.get(key, self)
+            if res is not None: return res
         xhtmlContent = '<p>%s</p>' % xhtmlString
-        return Xhtml2OdtConverter(xhtmlContent, encoding, self.stylesManager,
-                                  stylesMapping, self).run()
+        converter = Xhtml2OdtConverter(xhtmlContent, encoding,
+                                       self.stylesManager, stylesMapping, self)
+        stylesCount = len(self.dynamicStyles)
+        res = self.profile('xhtml', 'xhtml', converter.run)
+        if key:
+            xhtmlCache.set(key, res, ''.join(self.dynamicStyles[stylesCount:]))
+        return res
 
     def renderText(self, text, encoding='utf-8', stylesMapping={}):
         '''Obsolete method.'''
@@ -268,7 +335,9 @@ class Renderer:
     def importDocument(self, content=None, at=None, format=None,
                        anchor='as-char', wrapInPara=True, size=None,
                        sizeUnit='cm', style=None,
-                       pageBreakBefore=False, pageBreakAfter=False):
+                       pageBreakBefore=False, pageBreakAfter=False,
+                       pages=None, resolution=125, imageFormat='jpg',
+                       jpegQuality=None):
         '''If p_at is not None, it represents a path or url allowing to find
            the document. If p_at is None, the content of the document is
            supposed to be in binary format in p_content. The document
@@ -293,6 +362,16 @@ class Renderer:
            p_pageBreakBefore and p_pageBreakAfter are only relevant for import
            of external odt documents, and allows to insert a page break
            before/after the inserted document.
+
+           p_pages, p_resolution, p_imageFormat and p_jpegQuality are only
+           relevant for PDF files and documents converted to PDF, whose pages
+           are imported as images:
+           * p_pages, if specified, is a tuple (first, last) of the numbers of
+                      the pages to import, the first page being page 1;
+           * p_resolution is the resolution of the images, in dpi;
+           * p_imageFormat is "jpg" or "png";
+           * p_jpegQuality, if specified, is the quality of JPEG images, from 0
+                            to 100.
         '''
         importer = None
         # Is there someting to import?
@@ -314,9 +393,9 @@ class Renderer:
                 format = mimeTypesExts[format]
         isImage = False
         isOdt = False
+        isPdf = False
         if format in self.ooFormats:
             importer = OdtImporter
-            self.forceOoCall = True
             isOdt = True
         elif (format in self.imageFormats) or not format:
             # If the format can't be guessed, we suppose it is an image.
@@ -324,15 +403,19 @@ class Renderer:
             isImage = True
         elif format == 'pdf':
             importer = PdfImporter
+            isPdf = True
         elif format in self.convertibleFormats:
             importer = ConvertImporter
+            isPdf = True
         else:
             raise PodError(DOC_WRONG_FORMAT % format)
         imp = importer(content, at, format, self)
         # Initialise image-specific parameters
         if isImage: imp.init(anchor, wrapInPara, size, sizeUnit, style)
         elif isOdt: imp.init(pageBreakBefore, pageBreakAfter)
-        return imp.run()
+        elif isPdf: imp.init(pages, resolution, imageFormat, jpegQuality)
+        return self.profile('importer', '%s (%s)' % (importer.__name__,
+                            at or format), imp.run)
 
     def importPod(self, content=None, at=None, format='odt', context=None,
                   pageBreakBefore=False, pageBreakAfter=False):
@@ -347,15 +430,15 @@ class Renderer:
         if content.__class__.__name__ == 'File':
             content = FileWrapper(content)
         imp = PodImporter(content, at, format, self)
-        self.forceOoCall = True
         # Define the context to use: either the current context of the current
         # POD renderer, or p_context if given.
         if context:
             ctx = context
         else:
-            ctx = self.contentParser.env.context
+            ctx = self.contentContext
         imp.init(ctx, pageBreakBefore, pageBreakAfter)
-        return imp.run()
+        return self.profile('importer', 'PodImporter (%s)' % (at or format),
+                            imp.run)
 
     def insertPageBreak(self):
         '''Inserts a page break into the result.'''
@@ -363,6 +446,26 @@ class Renderer:
         return '<%s:p %s:style-name="podPageBreak"></%s:p>' % \
                (textNs, textNs, textNs)
 
+    def unzipTemplate(self):
+        '''Dumps the template files into the unzip folder.'''
+        self.unzipFolder = os.path.join(self.tempFolder, 'unzip')
+        os.mkdir(self.unzipFolder)
+        self.compiledTemplate.dump(self.unzipFolder)
+
+    def getTempFolder(self):
+        '''Returns the temp folder, with the unzipped template in it. The
+           template is unzipped the first time the folder is needed: by an
+           importer, or for finalizing the result (see m_finalize). When
+           rendering in memory, the temp folder itself is created then.'''
+        if not self.tempFolder:
+            self.tempFolder = getTempFileName('pod')
+            try:
+                os.mkdir(self.tempFolder)
+            except OSError as oe:
+                raise PodError(CANT_WRITE_TEMP_FOLDER % (self.tempFolder, oe))
+        if not self.unzipFolder: self.unzipTemplate()
+        return self.tempFolder
+
     def prepareFolders(self):
         # Check if I can write the result
         if not self.overwriteExisting and os.path.exists(self.result):
@@ -392,15 +495,21 @@ class Renderer:
             j = os.path.join
             toInsert = ''
             for fileName in self.fileNames.keys():
-                if fileName.endswith('.svg'):
-                    fileName = os.path.splitext(fileName)[0] + '.png'
                 mimeType = mimetypes.guess_type(fileName)[0]
                 toInsert += ' <manifest:file-entry manifest:media-type="%s" ' \
                             'manifest:full-path="%s"/>\n' % (mimeType, fileName)
+            hook = '</manifest:manifest>'
+            if self.zipDirectly:
+                # Patch the manifest in memory
+                name = 'META-INF/manifest.xml'
+                manifest = self.compiledTemplate.getFile(name)
+                if manifest:
+                    content = manifest.read().decode('utf-8')
+                    self.parts[name] = content.replace(hook, toInsert+hook)
+                return
             manifestName = j(self.unzipFolder, j('META-INF', 'manifest.xml'))
             f = open(manifestName)
             manifestContent = f.read()
-            hook = '</manifest:manifest>'
             manifestContent = manifestContent.replace(hook, toInsert+hook)
             f.close()
             # Write the new manifest content
@@ -408,23 +517,144 @@ class Renderer:
             f.write(manifestContent)
             f.close()
 
+    def profile(self, kind, label, function, *args):
+        '''Calls p_function with p_args and returns its result. If a profiler
+           is defined, the call is measured as an operation of this p_kind,
+           identified by this p_label.'''
+        self.checkCancelled()
+        profiler = self.profiler
+        if not profiler: return function(*args)
+        profiler.start(kind, label)
+        try:
+            return function(*args)
+        finally:
+            profiler.stop()
+
+    def renderPart(self, part, context, result=None):
+        '''Evaluates this p_part (content.xml or styles.xml) of the compiled
+           template with this p_context. The result is dumped into p_result
+           (a text file-like object) if given.'''
+        profiler = self.profiler
+        if profiler: profiler.start('phase', 'render %s' % part.name)
+        try:
+            if result is not None:
+                at = part.evaluate(result, context, self.raiseOnError,
+                                   profiler, self.cancelled)
+            elif self.inMemory:
+                result = io.StringIO()
+                at = part.evaluate(result, context, self.raiseOnError,
+                                   profiler, self.cancelled)
+                self.parts[part.name] = result.getvalue()
+            else:
+                at = part.evaluate(os.path.join(self.tempFolder, part.name),
+                                   context, self.raiseOnError, profiler,
+                                   self.cancelled)
+        finally:
+            if profiler: profiler.stop()
+        if part.name == 'content.xml': self.dynamicStylesAt = at
+
+    def canZipDirectly(self):
+        '''Can the result be zipped directly from the compiled template and the
+           rendered parts, without dumping them into the unzip folder?'''
+        if self.finalizeFunction or self.forceOoCall: return
+        if self.inMemory: return True
+        resultType = os.path.splitext(self.result)[1].strip('.')
+        return resultType in self.templateTypes
+
+    def getResultName(self):
+        '''Returns the name of the temp file that will hold the ODF result.'''
+        return os.path.join(self.tempFolder,
+                            'result.%s' % self.getTemplateType())
+
+    def checkCancelled(self):
+        '''Raises RenderingCancelled if the rendering has been cancelled.'''
+        if self.cancelled.is_set(): raise RenderingCancelled()
+
     # Public interface
+    def cancel(self):
+        '''Cancels the rendering, that may be running in another thread. The
+           rendering stops, raising RenderingCancelled, as soon as it executes
+           a POD statement, iterates within a "for" statement, imports a
+           document or enters another phase. A running LibreOffice conversion
+           process is killed.'''
+        self.cancelled.set()
+        process = self.loProcess
+        if process and (process.poll() is None): process.kill()
+
+    def runAsync(self, executor=None, timeout=None):
+        '''Asynchronous version of m_run, for use within an asyncio event loop:
+           returns an awaitable asyncio.Future.
+           The rendering runs in p_executor (a concurrent.futures executor; if
+           None, the event loop's default executor is used): the event loop is
+           not blocked while the template is evaluated, while documents or
+           images are imported or while LibreOffice converts the result.
+
+           If p_timeout (in seconds) is reached, the rendering is cancelled
+           (see m_cancel) and asyncio.TimeoutError is raised. The rendering is
+           also cancelled if the returned future is cancelled.
+
+           Because the rendering runs in another thread, p_executor must be a
+           ThreadPoolExecutor. For CPU-bound batches, see m_renderMany.'''
+        import asyncio
+        loop = asyncio.get_event_loop()
+        res = asyncio.ensure_future(asyncio.wait_for(
+                loop.run_in_executor(executor, self.run), timeout))
+        def stop(future):
+            # Cancelled or timed out: stop the rendering in its thread
+            if future.cancelled() or future.exception(): self.cancel()
+        res.add_done_callback(stop)
+        return res
+
     def run(self):
-        '''Renders the result'''
+        '''Renders the result. If p_self.result is None, the result is returned
+           as bytes.'''
+        compiled = self.compiledTemplate
+        writer = None
         try:
             # Remember which parser is running
             self.currentParser = self.contentParser
             # Create the resulting content.xml
-            self.currentParser.parse(self.contentXml)
+            self.renderPart(compiled.contentPart, self.contentContext)
             self.currentParser = self.stylesParser
+            # Decide only now whether the result can be zipped directly: while
+            # evaluating content.xml, an importer may have required LibreOffice
+            # (by setting self.forceOoCall).
+            self.zipDirectly = self.canZipDirectly()
             # Create the resulting styles.xml
-            self.currentParser.parse(self.stylesXml)
+            if self.zipDirectly:
+                # Stream it straight into the result
+                writer = self.profile('phase', 'zip', self.getResultWriter)
+                f = writer.open('styles.xml')
+                try:
+                    self.renderPart(compiled.stylesPart, self.stylesContext, f)
+                finally:
+                    f.close()
+            else:
+                self.renderPart(compiled.stylesPart, self.stylesContext)
+            if writer:
+                # Patch META-INF/manifest.xml
+                self.patchManifest()
+                res = self.profile('phase', 'zip', self.writeResult, writer)
+                writer = None
+                return res
+            # The result will be produced from the unzip folder
+            tempFolder = self.getTempFolder()
+            if self.inMemory:
+                # Dump the parts into the temp folder
+                for name, content in self.parts.items():
+                    # content.xml will be written by m_finalize
+                    if name == 'content.xml': continue
+                    f = open(os.path.join(tempFolder, name), 'w',
+                             encoding='utf-8')
+                    f.write(content)
+                    f.close()
             # Patch META-INF/manifest.xml
             self.patchManifest()
             # Re-zip the result
-            self.finalize()
+            return self.finalize()
         finally:
-            FolderDeleter.delete(self.tempFolder)
+            if writer: writer.close()
+            if self.tempFolder: FolderDeleter.delete(self.tempFolder)
 
     def getStyles(self):
         '''Returns a dict of the styles that are defined into the template.'''
@@ -435,7 +665,12 @@ class Renderer:
            XHTML tags that will be found inside XHTML content given to POD,
            and, on the other hand, ODT styles found into the template.'''
         try:
-            stylesMapping = self.stylesManager.checkStylesMapping(stylesMapping)
+            checked = self.stylesManager.checkStylesMapping(stylesMapping)
+            # The key representing, in the XHTML cache, this mapping as checked
+            # against the styles of this template.
+            self.stylesMappingKey = (self.stylesManager.parsed,
+                                     xhtmlCache.getMappingKey(stylesMapping))
+            stylesMapping = checked
             # The predefined styles below are currently ignored, because the
             # xhtml2odt parser does not take into account span tags.
             if 'span[font-weight=bold]' not in stylesMapping:
@@ -444,12 +679,16 @@ class Renderer:
                 stylesMapping['span[font-style=italic]'] = 'podItalic'
             self.stylesManager.stylesMapping = stylesMapping
         except PodError as po:
-            self.contentParser.env.currentBuffer.content.close()
-            self.stylesParser.env.currentBuffer.content.close()
-            if os.path.exists(self.tempFolder):
+            if self.tempFolder and os.path.exists(self.tempFolder):
                 FolderDeleter.delete(self.tempFolder)
             raise po
 
+    def shareStylesMapping(self, renderer):
+        '''Uses the styles mapping of this other p_renderer, as checked against
+           the styles of its own template.'''
+        self.stylesManager.stylesMapping = renderer.stylesManager.stylesMapping
+        self.stylesMappingKey = renderer.stylesMappingKey
+
     def callLibreOffice(self, resultName, resultType):
         '''Call LibreOffice in server mode to convert or update the result.'''
         loOutput = ''
@@ -460,8 +699,12 @@ class Renderer:
             try:
                 from appy.pod.converter import Converter, ConverterError
                 try:
-                    Converter(resultName, resultType, self.ooPort,
-                              self.stylesTemplate).run()
+                    if self.converterPool:
+                        self.converterPool.convert(resultName, resultType,
+                                                   self.stylesTemplate)
+                    else:
+                        Converter(resultName, resultType, self.ooPort,
+                                  self.stylesTemplate).run()
                 except ConverterError as ce:
                     raise PodError(CONVERT_ERROR % str(ce))
             except ImportError:
@@ -485,7 +728,7 @@ class Renderer:
                     (self.pyPath, convScript, qResultName, resultType,
                     self.ooPort)
                 if self.stylesTemplate: cmd += ' -t%s' % self.stylesTemplate
-                loOutput = executeCommand(cmd)
+                loOutput = self.executeCommand(cmd)
         except PodError as pe:
             # When trying to call LO in server mode for producing ODT or ODS
             # (=forceOoCall=True), if an error occurs we have nevertheless
@@ -497,6 +740,19 @@ class Renderer:
                 raise pe
         return loOutput
 
+    def executeCommand(self, cmd):
+        '''Executes command p_cmd and returns the content of its stderr. The
+           process can be killed by m_cancel.'''
+        self.checkCancelled()
+        self.loProcess = subprocess.Popen(cmd, shell=True,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        try:
+            res = self.loProcess.communicate()[1]
+        finally:
+            self.loProcess = None
+        self.checkCancelled()
+        return res.decode('utf-8', 'replace')
+
     def getTemplateType(self):
         '''Identifies the type of the pod template in self.template
            (ods or odt). If self.template is a string, it is a file name and we
@@ -508,28 +764,109 @@ class Renderer:
             # A StringIO instance
             self.template.seek(0)
             firstBytes = self.template.read(90)
-            firstBytes = firstBytes[firstBytes.index('mimetype')+8:]
-            if firstBytes.startswith(mimeTypes['ods']):
+            firstBytes = firstBytes[firstBytes.index(b'mimetype')+8:]
+            if firstBytes.startswith(mimeTypes['ods'].encode()):
                 res = 'ods'
             else:
                 # We suppose this is ODT
                 res = 'odt'
         return res
 
+    def getResult(self, resultName):
+        '''The result is in file p_resultName. Move it to p_self.result or,
+           when rendering in memory, write it into p_self.result or return it
+           as bytes.'''
+        if not self.inMemory:
+            os.rename(resultName, self.result)
+            return
+        f = open(resultName, 'rb')
+        res = f.read()
+        f.close()
+        if self.result is None: return res
+        self.result.write(res)
+
+    def getResultWriter(self):
+        '''Creates the ZipWriter for the result and writes into it the files
+           from the compiled template that are not modified by pod.'''
+        if not self.inMemory:
+            out = self.getResultName()
+        else:
+            out = (self.result is None) and io.BytesIO() or self.result
+        res = ZipWriter(out)
+        # Insert the uncompressed file "mimetype" first (see appy.shared.zip)
+        compiled = self.compiledTemplate
+        mimetype = compiled.mimetype or mimeTypes[self.getTemplateType()]
+        res.write('mimetype', mimetype, zipfile.ZIP_STORED)
+        names = [member.name for member in compiled.files]
+        for member in compiled.files:
+            name = member.name
+            if (name == 'mimetype') or (name == 'META-INF/manifest.xml'):
+                continue
+            if member.isFolder():
+                # Only add empty folders, like appy.shared.zip.zip does
+                if [n for n in names if (n != name) and n.startswith(name)]:
+                    continue
+                zInfo = zipfile.ZipInfo(name, time.localtime()[:6])
+                zInfo.external_attr = 48
+                res.write(zInfo, '')
+                continue
+            res.writeMember(member)
+        return res
+
+    def writeContent(self, f):
+        '''Writes the result content.xml into p_f, a binary file-like object,
+           inserting the dynamic styles at the position recorded while
+           rendering it. Content is copied chunk by chunk: only the dynamic
+           styles are entirely loaded in memory.'''
+        at = self.dynamicStylesAt
+        dynamicStyles = ''.join(self.dynamicStyles).encode('utf-8')
+        size = 1024 * 1024 # The size of a chunk
+        if self.inMemory:
+            content = self.parts['content.xml']
+            if at is None: at = len(content)
+            for start, end in ((0, at), (at, len(content))):
+                for i in range(start, end, size):
+                    f.write(content[i:min(i+size, end)].encode('utf-8'))
+                if start == 0: f.write(dynamicStyles)
+            return
+        source = open(os.path.join(self.tempFolder, 'content.xml'), 'rb')
+        if at is not None:
+            while at:
+                chunk = source.read(min(size, at))
+                if not chunk: break
+                f.write(chunk)
+                at -= len(chunk)
+            f.write(dynamicStyles)
+        shutil.copyfileobj(source, f, size)
+        source.close()
+
+    def writeResult(self, writer):
+        '''Completes the result being written by p_writer, with content.xml,
+           the manifest and the files added by pod into the unzip folder, if
+           any.'''
+        f = writer.open('content.xml', binary=True)
+        self.writeContent(f)
+        f.close()
+        # Write the manifest
+        name = 'META-INF/manifest.xml'
+        if name in self.parts:
+            writer.write(name, self.parts[name])
+        else:
+            manifest = self.compiledTemplate.getFile(name)
+            if manifest: writer.writeMember(manifest)
+        # Add the files imported into the unzip folder (ie, images)
+        if self.unzipFolder: writer.writeFolder(self.unzipFolder)
+        writer.close()
+        if not self.inMemory: return self.getResult(self.getResultName())
+        if self.result is None: return writer.f.getvalue()
+
     def finalize(self):
         '''Re-zip the result and potentially call LibreOffice if target format
            is not among self.templateTypes or if forceOoCall is True.'''
-        for innerFile in ('content.xml', 'styles.xml'):
-            shutil.copy(os.path.join(self.tempFolder, innerFile),
-                        os.path.join(self.unzipFolder, innerFile))
-        # Insert dynamic styles
-        contentXml = os.path.join(self.unzipFolder, 'content.xml')
-        f = open(contentXml, 'r+', encoding='utf-8')
-        dynamicStyles = ''.join(self.dynamicStyles)
-        content = f.read().replace('<!DYNAMIC_STYLES!>', dynamicStyles)
-        f.seek(0)
-        f.truncate(0)
-        f.write(content)
+        shutil.copy(os.path.join(self.tempFolder, 'styles.xml'),
+                    os.path.join(self.unzipFolder, 'styles.xml'))
+        f = open(os.path.join(self.unzipFolder, 'content.xml'), 'wb')
+        self.writeContent(f)
         f.close()
         # Call the user-defined "finalize" function when present
         if self.finalizeFunction:
@@ -540,18 +877,22 @@ class Renderer:
         # Re-zip the result, first as an OpenDocument file of the same type as
         # the POD template (odt, ods...)
         resultExt = self.getTemplateType()
-        resultName = os.path.join(self.tempFolder, 'result.%s' % resultExt)
-        zip(resultName, self.unzipFolder, odf=True)
-        resultType = os.path.splitext(self.result)[1].strip('.')
+        resultName = self.getResultName()
+        self.profile('phase', 'zip', zip, resultName, self.unzipFolder, True)
+        if self.inMemory:
+            resultType = resultExt
+        else:
+            resultType = os.path.splitext(self.result)[1].strip('.')
         if (resultType in self.templateTypes) and not self.forceOoCall:
             # Simply move the ODT result to the result
-            os.rename(resultName, self.result)
+            return self.getResult(resultName)
         else:
             if resultType not in FILE_TYPES:
                 raise PodError(BAD_RESULT_TYPE % (
                     self.result, FILE_TYPES.keys()))
             # Call LibreOffice to perform the conversion or document update.
-            output = self.callLibreOffice(resultName, resultType)
+            output = self.profile('phase', 'LibreOffice',
+                                  self.callLibreOffice, resultName, resultType)
             # I (should) have the result. Move it to the correct name.
             resPrefix = os.path.splitext(resultName)[0]
             if resultType in self.templateTypes:
@@ -566,5 +907,5 @@ class Renderer:
                 finalResultName = '%s.%s' % (resPrefix, resultType)
             if not os.path.exists(finalResultName):
                 raise PodError(CONVERT_ERROR % output)
-            os.rename(finalResultName, self.result)
+            return self.getResult(finalResultName)
 # ------------------------------------------------------------------------------
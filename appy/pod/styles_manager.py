@@ -17,8 +17,8 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
 
 # ------------------------------------------------------------------------------
-import re, os.path
-from collections import UserDict
+import re, os.path, hashlib, threading
+from collections import UserDict, OrderedDict
 import appy.pod
 from appy.pod import *
 from appy.pod.odf_parser import OdfEnvironment, OdfParser
@@ -168,6 +168,84 @@ class StylesParser(OdfParser):
             e.state = READING
             e.currentStyle = None
 
+# ------------------------------------------------------------------------------
+class ParsedStyles:
+    '''The styles defined in a styles.xml file, parsed once and shared by all
+       the StylesManager instances working with this file. Instances must not
+       be modified.'''
+    def __init__(self, stylesString):
+        StylesParser(StylesEnvironment(), self).parse(stylesString)
+        # Now self.styles contains the styles.
+        # Set of text styles derived from self.styles
+        self.textStyles = set(self.styles.getStyles('text'))
+        # Set of paragraph styles derived from self.styles
+        self.paragraphStyles = set(self.styles.getStyles('paragraph'))
+        # The styles mappings already checked against these styles, as a dict
+        # ~{key: dict}~ (see m_getMappingKey and StylesManager.
+        # checkStylesMapping).
+        self.mappings = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def getMappingKey(stylesMapping):
+        '''Returns a key representing the content of p_stylesMapping, or None
+           if it has no hashable representation.'''
+        res = tuple(stylesMapping.items())
+        try:
+            hash(res)
+        except TypeError:
+            return
+        return res
+
+    def getMapping(self, key):
+        '''Returns the checked styles mapping stored at p_key, or None.'''
+        with self.lock:
+            return self.mappings.get(key)
+
+    def setMapping(self, key, mapping):
+        '''Stores this checked styles p_mapping at p_key.'''
+        with self.lock:
+            if len(self.mappings) >= 100: self.mappings.clear()
+            self.mappings[key] = mapping
+
+# ------------------------------------------------------------------------------
+class StylesCache:
+    '''LRU cache of parsed styles, shared by all renderers. Styles are cached
+       under a hash of the content of their styles.xml file.'''
+    def __init__(self, maxItems=50):
+        # The maximum number of ParsedStyles instances to keep
+        self.maxItems = maxItems
+        self.entries = OrderedDict() # ~{s_hash: ParsedStyles}~
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, stylesString):
+        '''Returns the ParsedStyles instance for p_stylesString, being the
+           content of a styles.xml file, parsing it if it is not in the cache
+           yet.'''
+        key = hashlib.sha1(stylesString.encode('utf-8')).hexdigest()
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+        res = ParsedStyles(stylesString)
+        with self.lock:
+            if key in self.entries: return self.entries[key]
+            self.entries[key] = res
+            while len(self.entries) > self.maxItems:
+                self.entries.popitem(last=False)
+        return res
+
+    def clear(self):
+        '''Empties the cache.'''
+        with self.lock:
+            self.entries.clear()
+
+# The cache used by renderers
+stylesCache = StylesCache()
+
 # -------------------------------------------------------------------------------
 class StylesManager:
     '''Reads the paragraph styles from styles.xml within an ODT file, and
@@ -178,18 +256,29 @@ class StylesManager:
         # there are 2 concrete ODT styles: podBulletItemKeepWithNext and
         # podNumberItemKeepWithNext. pod chooses the right one.
     }
-    def __init__(self, stylesString):
+    def __init__(self, stylesString, parsed=None):
+        '''p_stylesString is the content of styles.xml. If its styles were
+           already parsed (ie, by a compiled template), p_parsed holds them, as
+           a ParsedStyles instance. Else, they are retrieved from the
+           stylesCache.'''
         self.stylesString = stylesString
-        self.styles = None
+        if parsed is None: parsed = stylesCache.get(stylesString)
+        self.parsed = parsed
+        self.styles = parsed.styles
         # Global styles mapping
         self.stylesMapping = None
-        self.stylesParser = StylesParser(StylesEnvironment(), self)
-        self.stylesParser.parse(self.stylesString)
-        # Now self.styles contains the styles.
-        # List of text styles derived from self.styles
-        self.textStyles = self.styles.getStyles('text')
-        # List of paragraph styles derived from self.styles
-        self.paragraphStyles = self.styles.getStyles('paragraph')
+        # Set of text styles derived from self.styles
+        self.textStyles = parsed.textStyles
+        # Set of paragraph styles derived from self.styles
+        self.paragraphStyles = parsed.paragraphStyles
+        # The resolution table, storing the results of m_findStyle that do not
+        # depend on the local styles mapping, as a dict
+        # ~{(s_elem, s_class, s_style, i_outlineDelta): Style}~. It is valid
+        # for the global styles mapping stored in self.resolvedMapping.
+        self.resolved = {}
+        self.resolvedMapping = None
+        # Parsed CSS "style" attributes, as a dict ~{s_style: dict}~
+        self.cssStyles = {}
 
     def checkStylesAdequation(self, htmlStyle, odtStyle):
         '''Checks that p_odtStyle may be used for style p_htmlStyle.'''
@@ -245,11 +334,25 @@ class StylesManager:
                   params, which can be None, is a dict whose pairs are of the
                   form (cssAttribute, cssValue).
              (iii) an integer value (=(b)).
+
+           Checked mappings are cached, by content, in self.parsed: the
+           result is a copy of the cached mapping, that can be modified.
         '''
-        res = {}
         if not isinstance(stylesMapping, dict) and \
            not isinstance(stylesMapping, UserDict):
             raise PodError(MAPPING_NOT_DICT)
+        key = self.parsed.getMappingKey(stylesMapping)
+        res = None
+        if key is not None: res = self.parsed.getMapping(key)
+        if res is None:
+            res = self.parseStylesMapping(stylesMapping)
+            if key is not None: self.parsed.setMapping(key, res)
+        return dict(res)
+
+    def parseStylesMapping(self, stylesMapping):
+        '''Checks p_stylesMapping and returns its internal representation (see
+           m_checkStylesMapping).'''
+        res = {}
         for xhtmlStyleName, odtStyleName in stylesMapping.items():
             if not isinstance(xhtmlStyleName, str):
                 raise PodError(MAPPING_ELEM_NOT_STRING)
@@ -294,8 +397,12 @@ class StylesManager:
                         if not isinstance(value, list):
                             res[xhtmlStyleName] = [(cssAttrs, odtStyle), \
                                                    (None, value)]
+                        elif cssAttrs:
+                            value.insert(0, (cssAttrs, odtStyle))
                         else:
-                            res.insert(0, (cssAttrs, odtStyle))
+                            # The style related to no attribute at all must
+                            # be at the last position.
+                            value.append((None, odtStyle))
                 else:
                     # I must create a simple structure (i) for this mapping.
                     res[xhtmlStyleName] = odtStyle
@@ -310,7 +417,9 @@ class StylesManager:
            p_matchingAttrs is a dict of attributes corresponding to some style.
            This method returns True if p_attrs contains the winning (name,value)
            pairs that match those in p_matchingAttrs. Note that ALL attrs in
-           p_matchingAttrs must be present in p_attrs.'''
+           p_matchingAttrs must be present in p_attrs. If p_matchingAttrs is
+           None, any p_attrs match.'''
+        if not matchingAttrs: return True
         for name, value in matchingAttrs.items():
             if name not in attrs: return
             if value != attrs[name]: return
@@ -330,7 +439,11 @@ class StylesManager:
             else: return
         # If I am here, I have style info. Check if it corresponds to some style
         # in p_styles.
-        styleInfo = parseStyleAttribute(attrs['style'], asDict=True)
+        style = attrs['style']
+        styleInfo = self.cssStyles.get(style)
+        if styleInfo is None:
+            styleInfo = parseStyleAttribute(style, asDict=True)
+            if len(self.cssStyles) < 1000: self.cssStyles[style] = styleInfo
         for matchingAttrs, style in styles:
             if self.styleMatch(styleInfo, matchingAttrs):
                 return style
@@ -367,8 +480,32 @@ class StylesManager:
         if (not res) and elem in localStylesMapping:
             styles = localStylesMapping[elem]
             res = self.getStyleFromMapping(elem, attrs, styles)
+        if res:
+            self.checkStylesAdequation(elem, res)
+            return res
+        # (3) to (7) only depend on the global styles mapping and on the
+        # outline delta from the local styles mapping: get the result from
+        # the resolution table.
+        if self.resolvedMapping is not self.stylesMapping:
+            self.resolved = {}
+            self.resolvedMapping = self.stylesMapping
+        # The "style" attribute is only relevant if the global styles mapping
+        # defines styles depending on CSS attributes for p_elem.
+        style = None
+        if attrs and isinstance(self.stylesMapping.get(elem), list):
+            style = attrs.get('style')
+        key = (elem, cssStyleName, style, localStylesMapping.get('h*'))
+        if key in self.resolved: return self.resolved[key]
+        res = self.resolveStyle(elem, attrs, cssStyleName, localStylesMapping)
+        if len(self.resolved) < 10000: self.resolved[key] = res
+        return res
+
+    def resolveStyle(self, elem, attrs, cssStyleName, localStylesMapping):
+        '''Finds the ODT style for p_elem, as defined by steps (3) to (7) from
+           m_findStyle.'''
+        res = None
         # (3)
-        if (not res) and cssStyleName in self.stylesMapping:
+        if cssStyleName in self.stylesMapping:
             res = self.stylesMapping[cssStyleName]
         # (4)
         if (not res) and elem in self.stylesMapping:
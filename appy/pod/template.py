@@ -0,0 +1,262 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os, os.path, hashlib, threading
+from collections import OrderedDict
+
+import appy.pod
+from appy.shared import mimeTypes
+from appy.shared.xml_parser import XmlElement
+from appy.shared.zip import readMembers
+from appy.pod.pod_parser import PodParser, PodEnvironment, OdInsert
+from appy.pod.buffers import RootBuffer, FileBuffer, RenderState
+from appy.pod.styles_manager import stylesCache
+from appy.pod.odt_merger import hasIndexes
+
+# ------------------------------------------------------------------------------
+# Default automatic text styles added by pod in content.xml
+f = open('%s/styles.in.content.xml' % os.path.dirname(appy.pod.__file__))
+CONTENT_POD_STYLES = f.read()
+f.close()
+
+# Default font added by pod in content.xml
+CONTENT_POD_FONTS = '<@style@:font-face @style@:name="PodStarSymbol" ' \
+                    '@svg@:font-family="StarSymbol"/>'
+
+# Default text styles added by pod in styles.xml
+f = open('%s/styles.in.styles.xml' % os.path.dirname(appy.pod.__file__))
+STYLES_POD_STYLES = f.read()
+f.close()
+
+# Default font added by pod
+STYLES_POD_FONTS = '<@style@:font-face @style@:name="PodStarSymbol" ' \
+                   '@svg@:font-family="StarSymbol"/>'
+
+# ------------------------------------------------------------------------------
+def getContentInserts():
+    '''Returns the OdInsert instances to apply on content.xml.'''
+    pe = PodEnvironment
+    return (
+        OdInsert(CONTENT_POD_FONTS,
+            XmlElement('font-face-decls', nsUri=pe.NS_OFFICE),
+            nsUris={'style': pe.NS_STYLE, 'svg': pe.NS_SVG}),
+        OdInsert(CONTENT_POD_STYLES,
+            XmlElement('automatic-styles', nsUri=pe.NS_OFFICE),
+            nsUris={'style': pe.NS_STYLE, 'fo': pe.NS_FO,
+                    'text': pe.NS_TEXT, 'table': pe.NS_TABLE}))
+
+def getStylesInserts():
+    '''Returns the OdInsert instances to apply on styles.xml.'''
+    pe = PodEnvironment
+    return (
+        OdInsert(STYLES_POD_FONTS,
+            XmlElement('font-face-decls', nsUri=pe.NS_OFFICE),
+            nsUris={'style': pe.NS_STYLE, 'svg': pe.NS_SVG}),
+        OdInsert(STYLES_POD_STYLES,
+            XmlElement('styles', nsUri=pe.NS_OFFICE),
+            nsUris={'style': pe.NS_STYLE, 'fo': pe.NS_FO,
+                    'text': pe.NS_TEXT}))
+
+# ------------------------------------------------------------------------------
+class TemplatePart:
+    '''A parsed XML part (content.xml or styles.xml) of a POD template'''
+    def __init__(self, name, xml, inserts, parser='sax'):
+        self.name = name
+        # Parsing the part does not evaluate anything: it produces a tree of
+        # buffers, whose root is self.buffer. p_xml is given as bytes, or as a
+        # string. p_parser is the name of the parser backend to use (see
+        # appy.shared.xml_parser.XmlParser.backends).
+        env = PodEnvironment({}, inserts)
+        self.buffer = env.currentBuffer = RootBuffer(env)
+        self.parser = PodParser(env, self, parser)
+        self.parser.parse(xml)
+        self.buffer.flush()
+        self.env = env
+
+    # Parsing-time errors are always dumped into the buffers; at render time,
+    # the renderer decides.
+    raiseOnError = False
+
+    def evaluate(self, result, context, raiseOnError, profiler=None,
+                 cancelled=None):
+        '''Evaluates this part with this p_context and dumps the result into
+           p_result, being a file path or a text file-like object. Returns the
+           position, in p_result, where dynamic styles must be inserted, or
+           None if this part has no placeholder for it.'''
+        # The tree of buffers holds no state of the evaluation: this state is
+        # kept on the result buffer (see appy.pod.buffers.RenderState). So the
+        # same part can be evaluated by several renderers at the same time, or
+        # while it is already being evaluated (ie, a template importing itself
+        # via function "pod").
+        state = RenderState(context, raiseOnError, profiler, cancelled)
+        result = FileBuffer(self.env, result, state)
+        try:
+            self.buffer.evaluate(result, context)
+        finally:
+            result.close()
+        return result.dynamicStylesAt
+
+# ------------------------------------------------------------------------------
+class CompiledTemplate:
+    '''A POD template (ODT or ODS file) being unzipped and parsed once for all.
+       It can be rendered many times, with various contexts, possibly by
+       several renderers at the same time.'''
+    def __init__(self, template, parser='sax'):
+        # p_template can be anything accepted by the zipfile.ZipFile constructor
+        # p_parser is the name of the parser backend used to parse content.xml
+        # and styles.xml (see appy.shared.xml_parser.XmlParser.backends).
+        # Zipped files, excepted content.xml and styles.xml, are kept in their
+        # compressed form, as a list of appy.shared.zip.ZipMember instances:
+        # they are copied as is into the results.
+        self.files = []
+        self.mimetype = None
+        for member in readMembers(template):
+            name = member.name
+            if name == 'content.xml':
+                contentXml = member.read()
+                continue
+            elif name == 'styles.xml':
+                stylesXml = member.read()
+                self.stylesXml = stylesXml.decode('utf-8')
+                continue
+            elif name == 'mimetype':
+                self.mimetype = member.read()
+            self.files.append(member)
+        # Does content.xml contain indexes? If documents are merged into the
+        # result, LibreOffice must update them (see appy.pod.odt_merger).
+        self.hasIndexes = hasIndexes(contentXml)
+        # Parse the styles, or get them from the cache
+        self.parsedStyles = stylesCache.get(self.stylesXml)
+        self.styles = self.parsedStyles.styles
+        # Parse content.xml and styles.xml. With the "expat" backend, they are
+        # parsed from their bytes, as read from the zip file, without decoding
+        # them first.
+        if parser != 'expat':
+            contentXml = contentXml.decode('utf-8')
+            stylesXml = self.stylesXml
+        self.contentPart = TemplatePart('content.xml', contentXml,
+                                        getContentInserts(), parser)
+        # In spreadsheets, identical consecutive rows can be compressed
+        if self.mimetype == mimeTypes['ods'].encode():
+            self.contentPart.env.compressRows = True
+        self.stylesPart = TemplatePart('styles.xml', stylesXml,
+                                       getStylesInserts(), parser)
+        # An estimate of the memory used by this compiled template
+        self.size = len(contentXml) + 2*len(stylesXml) + \
+                    sum([member.getSize() for member in self.files])
+
+    def getFile(self, name):
+        '''Returns the ZipMember named p_name, or None if it does not exist.'''
+        for member in self.files:
+            if member.name == name: return member
+
+    def read(self, name):
+        '''Returns the content of the file named p_name, like
+           zipfile.ZipFile.read.'''
+        member = self.getFile(name)
+        if not member: raise KeyError(name)
+        return member.read()
+
+    def dump(self, folder):
+        '''Dumps, into p_folder, the template files being not parsed by POD, as
+           if the template was unzipped into it.'''
+        for member in self.files:
+            name = member.name
+            if member.isFolder():
+                # An empty folder
+                os.makedirs(os.path.join(folder, name.lstrip('/')))
+                continue
+            folderName = os.path.dirname(name)
+            if folderName:
+                folderName = os.path.join(folder, folderName)
+                if not os.path.exists(folderName): os.makedirs(folderName)
+            f = open(os.path.join(folder, name), 'wb')
+            f.write(member.read())
+            f.close()
+
+# ------------------------------------------------------------------------------
+class TemplateCache:
+    '''LRU cache of compiled templates. A template given as a path is cached
+       under its absolute path, modification time and size; a template given as
+       a file-like object is cached under a hash of its content.'''
+    def __init__(self, maxItems=20, maxSize=50*1024*1024):
+        # The maximum number of compiled templates to keep
+        self.maxItems = maxItems
+        # The maximum sum of CompiledTemplate.size, in bytes
+        self.maxSize = maxSize
+        self.templates = OrderedDict() # ~{key: CompiledTemplate}~
+        self.size = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def getKey(self, template):
+        '''Returns the key under which p_template is cached.'''
+        if isinstance(template, str):
+            stat = os.stat(template)
+            return (os.path.abspath(template), stat.st_mtime_ns, stat.st_size)
+        # A file-like object
+        template.seek(0)
+        res = hashlib.sha1(template.read()).hexdigest()
+        template.seek(0)
+        return res
+
+    def get(self, template, parser='sax'):
+        '''Returns the CompiledTemplate corresponding to p_template, compiling
+           it, with this p_parser backend, if it is not in the cache yet. All
+           backends producing the same compiled template, p_parser is not part
+           of the key.'''
+        key = self.getKey(template)
+        with self.lock:
+            if key in self.templates:
+                self.hits += 1
+                self.templates.move_to_end(key)
+                return self.templates[key]
+            self.misses += 1
+        # Compile the template outside the lock: other templates may be
+        # retrieved in the meanwhile.
+        res = CompiledTemplate(template, parser)
+        with self.lock:
+            if key in self.templates: return self.templates[key]
+            if res.size > self.maxSize: return res
+            # Remove outdated versions of the same file
+            if isinstance(key, tuple):
+                for otherKey in list(self.templates.keys()):
+                    if isinstance(otherKey, tuple) and (otherKey[0] == key[0]):
+                        self.remove(otherKey)
+            self.templates[key] = res
+            self.size += res.size
+            # Remove the least recently used templates when limits are exceeded
+            while (len(self.templates) > self.maxItems) or \
+                  (self.size > self.maxSize):
+                self.remove(next(iter(self.templates)))
+        return res
+
+    def remove(self, key):
+        '''Removes the template stored at p_key.'''
+        self.size -= self.templates.pop(key).size
+
+    def clear(self):
+        '''Empties the cache.'''
+        with self.lock:
+            self.templates.clear()
+            self.size = 0
+
+# The default cache used by renderers
+templateCache = TemplateCache()
+# ------------------------------------------------------------------------------
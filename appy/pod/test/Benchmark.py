@@ -0,0 +1,379 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+'''Micro-benchmarks for pod. Run "python Benchmark.py" to run them all, or
+   "python Benchmark.py <name> [<name>...]" to run some of them.'''
+
+# ------------------------------------------------------------------------------
+import sys, os.path, io, re, timeit, zipfile, time, threading, http.server, \
+       tempfile
+from appy.pod.elements import Expression
+from appy.shared.xml_parser import escapeXml, XmlParser
+from appy.pod.renderer import Renderer
+from appy.pod.template import CompiledTemplate
+from appy.pod.fetcher import ImageFetcher
+from appy.pod.xhtml2odt import xhtmlCache
+
+# The folder containing this script
+testFolder = os.path.dirname(os.path.abspath(__file__))
+
+# ------------------------------------------------------------------------------
+def report(title, results):
+    '''Prints the p_results of a benchmark, as a list of tuples
+       (s_label, f_seconds, i_number), where p_seconds is the time spent for
+       p_number operations.'''
+    print(title)
+    for label, seconds, number in results:
+        print('  %-40s %10.3f us/op' % (label, seconds / number * 1000000))
+
+def best(function, number, repeat=5):
+    '''Returns the best time, in seconds, for calling p_function p_number
+       times.'''
+    return min(timeit.repeat(function, number=number, repeat=repeat))
+
+def createTemplate(body, base='NoPython.odt', files=()):
+    '''Returns, as a BytesIO instance, a copy of template p_base whose body is
+       replaced with p_body, a chunk of ODF content. p_files is a list of
+       additional files to zip into it, as tuples (s_name, bytes_content).'''
+    source = zipfile.ZipFile(os.path.join(testFolder, 'templates', base))
+    res = io.BytesIO()
+    target = zipfile.ZipFile(res, 'w', zipfile.ZIP_DEFLATED)
+    for info in source.infolist():
+        content = source.read(info.filename)
+        if info.filename == 'content.xml':
+            content = re.sub(r'<office:text>.*</office:text>',
+                             '<office:text>%s</office:text>' % body,
+                             content.decode('utf-8'), flags=re.S)
+        target.writestr(info, content)
+    for name, content in files:
+        target.writestr(name, content)
+    target.close()
+    source.close()
+    res.seek(0)
+    return res
+
+def getLoopTable(columns=3):
+    '''Returns the ODF content of a table made of a single row, repeated for
+       every element of a list named "items" and made of p_columns cells
+       containing text and an expression.'''
+    res = ['<table:table table:name="Table1">'
+           '<table:table-column table:number-columns-repeated="%d"/>'
+           '<table:table-row>' % columns]
+    for j in range(columns):
+        res.append('<table:table-cell office:value-type="string"><text:p>')
+        if j == 0:
+            res.append('<office:annotation><dc:creator>Pod</dc:creator>'
+                       '<text:p>do row for item in items</text:p>'
+                       '</office:annotation>')
+        res.append('Cell %d: <text:text-input text:description="">item[%d]'
+                   '</text:text-input></text:p></table:table-cell>' % (j, j))
+    res.append('</table:table-row></table:table>')
+    return ''.join(res)
+
+def getTable(rows, columns=3, cell='Static cell %d.%d'):
+    '''Returns the ODF content of a static table made of p_rows rows and
+       p_columns columns.'''
+    res = ['<table:table table:name="Table1">'
+           '<table:table-column table:number-columns-repeated="%d"/>' % columns]
+    for i in range(rows):
+        res.append('<table:table-row>')
+        for j in range(columns):
+            res.append('<table:table-cell office:value-type="string"><text:p>'
+                       '%s</text:p></table:table-cell>' % (cell % (i, j)))
+        res.append('</table:table-row>')
+    res.append('</table:table>')
+    return ''.join(res)
+
+def benchmarkRender(title, template, context, number=3):
+    '''Reports the time needed to parse p_template and to render it with
+       p_context.'''
+    parse = best(lambda: CompiledTemplate(template), number, repeat=1)
+    render = best(lambda: Renderer(template, context, None).run(), number,
+                  repeat=1)
+    report(title, (('parse', parse, number),
+                   ('parse and render (in memory)', render, number)))
+
+# ------------------------------------------------------------------------------
+def benchmarkExpressions(number=100000):
+    '''Per-evaluation cost of a pod expression: eval of the raw string, as it
+       was done before expressions were compiled, versus evaluation of the
+       compiled Expression.'''
+    context = {'item': {'name': 'Item', 'price': 12.5, 'qty': 3}}
+    source = "'%s: %.2f' % (item['name'], item['price'] * item['qty'])"
+    expr = Expression(source, True)
+    errorSource = "item['missing']|'-'"
+    errorExpr = Expression(errorSource, True)
+    def evalErrorSource():
+        try:
+            eval("item['missing']", context)
+        except Exception:
+            eval("'-'", context)
+    report('Expressions', (
+      ('eval(string)', best(lambda: eval(source, context), number), number),
+      ('Expression (compiled)', best(lambda: expr._eval(context), number),
+       number),
+      ('eval(string), error expr', best(evalErrorSource, number), number),
+      ('Expression (compiled), error expr',
+       best(lambda: errorExpr._eval(context), number), number)))
+
+def benchmarkStaticTable(rows=5000):
+    '''Parses and renders a template containing a static table of p_rows
+       rows.'''
+    template = createTemplate(getTable(rows))
+    benchmarkRender('Static table (%d rows)' % rows, template, {})
+
+def benchmarkParsers(rows=5000, number=3):
+    '''Compiles a template containing a static table of p_rows rows, with
+       every parser backend.'''
+    template = createTemplate(getTable(rows))
+    results = []
+    for backend in XmlParser.backends:
+        results.append(('compile (%s)' % backend,
+                        best(lambda: CompiledTemplate(template, backend),
+                             number), number))
+    report('Parser backends (%d rows)' % rows, results)
+
+def benchmarkLoop(rows=5000, number=3):
+    '''Renders, from a cached compiled template, a table whose row is repeated
+       p_rows times by a "for" statement.'''
+    template = createTemplate(getLoopTable())
+    context = {'items': [('a%d' % i, 'b%d' % i, 'c%d' % i) \
+                         for i in range(rows)]}
+    def render():
+        Renderer(template, context, None, cacheTemplate=True).run()
+    render() # Put the compiled template in the cache
+    report('For loop (%d rows)' % rows,
+           (('render (cached template, in memory)', best(render, number),
+             number),))
+
+def benchmarkThreads(threads=4, rows=100, renders=5, latency=0.002):
+    '''Renders, from p_threads threads at the same time, p_renders times each,
+       a template whose row is repeated p_rows times, with or without caching
+       the compiled template. Expressions wait for p_latency seconds, like
+       expressions reading data from a database.'''
+    def get(value):
+        time.sleep(latency)
+        return value
+    template = createTemplate(getLoopTable().replace('item[0]', 'get(item[0])'))
+    context = {'get': get, 'items': [('a%d' % i, 'b%d' % i, 'c%d' % i) \
+                                     for i in range(rows)]}
+    results = []
+    for cache in (False, True):
+        def render():
+            for i in range(renders):
+                Renderer(template, context, None, cacheTemplate=cache).run()
+        start = time.time()
+        running = [threading.Thread(target=render) for i in range(threads)]
+        for thread in running: thread.start()
+        for thread in running: thread.join()
+        results.append(('render (%s)' % (cache and 'cached template' or \
+                        'template parsed every time'), time.time() - start,
+                        threads * renders))
+    report('Concurrent renders (%d threads)' % threads, results)
+
+def benchmarkPictures(count=20, size=500000, number=10):
+    '''Renders a template containing p_count pictures of p_size bytes.'''
+    files = [('Pictures/picture%d.png' % i, os.urandom(size)) \
+             for i in range(count)]
+    template = createTemplate('<text:p>Pictures</text:p>', files=files)
+    result = os.path.join(tempfile.gettempdir(), 'podPictures.odt')
+    def render(result=None):
+        Renderer(template, {}, result, cacheTemplate=True,
+                 overwriteExisting=True).run()
+    render() # Put the compiled template in the cache
+    report('Template with %d pictures of %d bytes' % (count, size),
+           (('render (cached template, in memory)', best(render, number),
+             number),
+            ('render (cached template, to a file)',
+             best(lambda: render(result), number), number)))
+    os.remove(result)
+
+def benchmarkEscape(size=10*1024*1024, number=3):
+    '''Renders a text of p_size chars through a POD expression, and escapes
+       it directly.'''
+    line = 'Some text with <special> chars & "quotes"\tand tabs.\n'
+    text = line * (size // len(line))
+    plain = text.replace('<', '').replace('>', '').replace('&', '') \
+                .replace('"', '').replace('\t', '').replace('\n', '')
+    template = createTemplate('<text:p><text:text-input text:description="">'
+                              'text</text:text-input></text:p>')
+    def render():
+        Renderer(template, {'text': text}, None, cacheTemplate=True).run()
+    render() # Put the compiled template in the cache
+    report('Escaping %d chars' % len(text), (
+      ('escapeXml (odf)', best(lambda: escapeXml(text, 'odf'), number),
+       number),
+      ('escapeXml (odf), no special char',
+       best(lambda: escapeXml(plain, 'odf'), number), number),
+      ('render (cached template, in memory)', best(render, number), number)))
+
+def benchmarkFetcher(count=20, latency=0.1, number=1):
+    '''Renders a XHTML chunk containing p_count images served by a local HTTP
+       server answering after p_latency seconds, with and without an image
+       fetcher.'''
+    image = open(os.path.join(testFolder, 'images', 'plone.png'), 'rb').read()
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(image)))
+            self.end_headers()
+            self.wfile.write(image)
+        def log_message(self, *args): pass
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/image%%d.png' % server.server_address[1]
+    xhtml = ''.join(['<p><img src="%s"/></p>' % (url % i) \
+                     for i in range(count)])
+    template = createTemplate('<text:p><text:text-input text:description="">'
+                              'xhtml(chunk)</text:text-input></text:p>')
+    fetcher = ImageFetcher()
+    def render(imageFetcher=None):
+        if imageFetcher: imageFetcher.clear()
+        Renderer(template, {'chunk': xhtml}, io.BytesIO(),
+                 cacheTemplate=True, imageFetcher=imageFetcher).run()
+    render() # Put the compiled template in the cache
+    report('XHTML with %d remote images (%.2fs latency)' % (count, latency), (
+      ('render, sequential downloads', best(render, number, repeat=1), number),
+      ('render, image fetcher', best(lambda: render(fetcher), number,
+                                     repeat=1), number)))
+    fetcher.close()
+    server.shutdown()
+
+def benchmarkSubPods(count=100, number=3):
+    '''Renders a template importing, via function "pod", p_count times another
+       POD template containing a table.'''
+    sub = createTemplate(getLoopTable())
+    f = tempfile.NamedTemporaryFile(suffix='.odt', delete=False)
+    f.write(sub.read())
+    f.close()
+    template = createTemplate('<text:p><office:annotation><dc:creator>Pod'
+      '</dc:creator><text:p>do text for i in range(%d)</text:p><text:p>from '
+      'pod(at=sub)</text:p></office:annotation>Sub-pod</text:p>' % count)
+    context = {'sub': f.name, 'items': [('a', 'b', 'c')] * 10}
+    def render():
+        Renderer(template, context, None, cacheTemplate=True).run()
+    render() # Put the compiled templates in the cache
+    report('Template importing %d sub-pods' % count,
+           (('render (cached template, in memory)', best(render, number,
+             repeat=1), number),))
+    os.remove(f.name)
+
+def benchmarkOdsRows(rows=50000, number=1):
+    '''Renders a spreadsheet whose row is repeated p_rows times by a "for"
+       statement, with distinct and with identical rows.'''
+    template = os.path.join(testFolder, 'templates', 'OdsSimple.ods')
+    distinct = [['%d' % i, i, 'three'] for i in range(rows)]
+    identical = [['one', 2, 'three']] * rows
+    def render(data):
+        return Renderer(template, {'data': data}, None,
+                        cacheTemplate=True).run()
+    render(distinct[:1]) # Put the compiled template in the cache
+    report('Spreadsheet (%d rows)' % rows, (
+      ('render, distinct rows', best(lambda: render(distinct), number,
+                                     repeat=3), number),
+      ('render, identical rows', best(lambda: render(identical), number,
+                                      repeat=3), number)))
+
+def benchmarkStyles(number=100000):
+    '''Finds the ODT styles of XHTML elements, with a global styles mapping
+       depending on CSS attributes.'''
+    template = os.path.join(testFolder, 'templates', 'NoPython.odt')
+    mapping = {'p[text-align=center]': 'Heading', 'p': 'Text body',
+               'warning': 'Caption', 'h*': 1}
+    manager = Renderer(template, {}, None, stylesMapping=mapping).stylesManager
+    local = manager.checkStylesMapping({})
+    elems = (('p', {'style': 'text-align: center'}), ('p', {}),
+             ('div', {'class': 'warning'}), ('h2', {}), ('b', {}))
+    def find():
+        for elem, attrs in elems: manager.findStyle(elem, attrs, None, local)
+    report('Finding the styles of %d elements' % len(elems),
+           (('findStyle', best(find, number), number),))
+
+def benchmarkXhtml(count=1000, number=3):
+    '''Renders a template converting p_count times the same XHTML chunk, with
+       and without the XHTML cache.'''
+    clause = '<p>The <b>parties</b> agree to the terms below.</p><ul>%s</ul>' \
+             '<table><tr><th>Term</th><th>Value</th></tr><tr><td>Duration' \
+             '</td><td>12 months</td></tr></table>' % \
+             ''.join(['<li>Clause %d applies.</li>' % i for i in range(5)])
+    template = createTemplate('<text:p><office:annotation><dc:creator>Pod'
+      '</dc:creator><text:p>do text for i in range(%d)</text:p><text:p>from '
+      'xhtml(clause)</text:p></office:annotation>Clause</text:p>' % count)
+    def render():
+        Renderer(template, {'clause': clause}, None, cacheTemplate=True).run()
+    render() # Put the compiled template in the cache
+    maxItems = xhtmlCache.maxItems
+    xhtmlCache.maxItems = 0
+    xhtmlCache.clear()
+    uncached = best(render, number)
+    xhtmlCache.maxItems = maxItems
+    report('XHTML chunk converted %d times' % count, (
+      ('render, no cache', uncached, number),
+      ('render, XHTML cache', best(render, number), number)))
+
+def getRichText(size):
+    '''Returns a chunk of XHTML of about p_size chars, like a rich text field
+       edited in a CMS.'''
+    part = '<p>Some <b>bold</b> and <i>italic</i> text, with a <a href="' \
+           'http://appyframework.org">link</a>.   Whitespace\n  is crunched.' \
+           '</p><ul><li>First item</li><li>Second <u>item</u></li></ul>' \
+           '<h2>Title</h2><div>A division<br/>on two lines</div>' \
+           '<table><tr><td>Cell</td><td><p>Paragraph in a cell</p></td>' \
+           '</tr></table>'
+    return part * (size // len(part))
+
+def benchmarkXhtmlSizes(sizes=(100*1024, 1024*1024, 5*1024*1024)):
+    '''Renders a template converting a single XHTML chunk of each of these
+       p_sizes, in chars.'''
+    template = createTemplate('<text:p><office:annotation><dc:creator>Pod'
+      '</dc:creator><text:p>do text</text:p><text:p>from xhtml(chunk)'
+      '</text:p></office:annotation>Chunk</text:p>')
+    results = []
+    for size in sizes:
+        chunk = getRichText(size)
+        def render():
+            xhtmlCache.clear()
+            Renderer(template, {'chunk': chunk}, None,
+                     cacheTemplate=True).run()
+        results.append(('render, %d KB' % (size // 1024),
+                        best(render, 1, repeat=1), 1))
+    report('Converting XHTML chunks', results)
+
+# ------------------------------------------------------------------------------
+benchmarks = {'escape': benchmarkEscape,
+              'expressions': benchmarkExpressions,
+              'fetcher': benchmarkFetcher,
+              'loop': benchmarkLoop,
+              'odsRows': benchmarkOdsRows,
+              'parsers': benchmarkParsers,
+              'pictures': benchmarkPictures,
+              'staticTable': benchmarkStaticTable,
+              'styles': benchmarkStyles,
+              'subPods': benchmarkSubPods,
+              'threads': benchmarkThreads,
+              'xhtml': benchmarkXhtml,
+              'xhtmlSizes': benchmarkXhtmlSizes}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(benchmarks.keys())
+    for name in names: benchmarks[name]()
+# ------------------------------------------------------------------------------
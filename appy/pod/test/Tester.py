@@ -21,7 +21,7 @@ import os, os.path, sys, zipfile, re, shutil
 import appy.shared.test
 from appy.shared.test import TesterError
 from appy.shared.utils import FolderDeleter
-from appy.shared.xml_parser import escapeXml
+from appy.shared.xml_parser import escapeXml, XmlParser
 from appy.pod.odf_parser import OdfEnvironment, OdfParser
 from appy.pod.renderer import Renderer
 
@@ -127,7 +127,8 @@ class Test(appy.shared.test.Test):
         # Call the renderer.
         Renderer(template, context, self.result, ooPort=ooPort,
                  pythonWithUnoPath=pythonWithUno,
-                 stylesMapping=stylesMapping).run()
+                 stylesMapping=stylesMapping,
+                 xmlParser=self.config['xmlParser']).run()
         # Store all result files
         # I should allow to do this from an option given to Tester.py: this code
         # keeps in a separate folder the odt results of all ran tests.
@@ -225,6 +226,16 @@ class PodTestFactory(appy.shared.test.TestFactory):
 class PodTester(appy.shared.test.Tester):
     def __init__(self, testPlan):
         appy.shared.test.Tester.__init__(self, testPlan, [], PodTestFactory)
+        # Templates are parsed with the backend chosen on the command line
+        self.config['xmlParser'] = self.options.xmlParser
+
+    def addOptions(self, optParser):
+        backends = XmlParser.backends
+        optParser.add_option("-p", "--parser", dest="xmlParser",
+                             default="sax", choices=list(backends), help=\
+                             "The XML parser backend used for parsing the " \
+                             "templates: %s (default: sax)." % \
+                             ', '.join(backends))
 
 # ------------------------------------------------------------------------------
 if __name__ == '__main__':
@@ -0,0 +1,8 @@
+data = [ \
+  ['1', 2, 'three'],
+  ['1', 2, 'three'],
+  ['1', 2, 'three'],
+  ['A', 'BB', 'CCC'],
+  ['A', 'BB', 'CCC'],
+  ['1', 2, 'three']
+]
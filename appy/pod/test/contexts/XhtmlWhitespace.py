@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+xhtmlInput = '''
+<p>Spaces,   tabs	and
+   newlines   are crunched.</p>
+<p>Whitespace   <b>  between  </b>   inline <i>elements</i>  is kept once.</p>
+<p>Non-breaking&nbsp;  spaces&nbsp;&nbsp; &nbsp;	are kept.&nbsp;</p>
+<p>   Leading and trailing whitespace.   </p>
+<p>Entities &amp;   &lt;tags&gt;
+ &nbsp; mixed  with &eacute;   whitespace.</p>'''
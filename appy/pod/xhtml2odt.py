@@ -6,7 +6,8 @@
 # Contributors: Gauthier Bastien, Fabio Marcuzzi, IMIO.
 
 # ------------------------------------------------------------------------------
-import xml.sax, time, random
+import xml.sax, time, random, re, hashlib, threading
+from collections import OrderedDict
 from appy.pod import *
 from appy.pod.odf_parser import OdfEnvironment
 from appy.pod.styles_manager import Style
@@ -33,6 +34,55 @@ NOT_INSIDE_P_OR_P = NOT_INSIDE_P + ('p', 'div')
 NOT_INSIDE_LIST = ('table',)
 IGNORABLE_TAGS = ('meta', 'title', 'style', 'script')
 
+# ------------------------------------------------------------------------------
+def getTableName():
+    '''Returns a name for an ODF table generated from a XHTML table.'''
+    elems = str(time.time()).split('.')
+    return 'AppyTable%s%s%d' % (elems[0], elems[1], random.randint(1,100))
+
+# ------------------------------------------------------------------------------
+class OutputBuilder:
+    '''Builds a string from chunks, in linear time. The end of the string can
+       be retracted, ie, for removing start tags that would otherwise be
+       followed by their end tags.'''
+    def __init__(self):
+        self.chunks = []
+
+    def __bool__(self): return bool(self.chunks)
+
+    def write(self, s):
+        if s: self.chunks.append(s)
+
+    def getTail(self, size):
+        '''Returns the last chars of the string, at least p_size if the string
+           is long enough.'''
+        chunks = self.chunks
+        i = len(chunks)
+        length = 0
+        while i and (length < size):
+            i -= 1
+            length += len(chunks[i])
+        return ''.join(chunks[i:])
+
+    def endswith(self, s):
+        return self.getTail(len(s)).endswith(s)
+
+    def retract(self, size):
+        '''Removes the last p_size chars from the string.'''
+        chunks = self.chunks
+        while size and chunks:
+            last = chunks.pop()
+            if len(last) > size:
+                chunks.append(last[:-size])
+                break
+            size -= len(last)
+
+    def getValue(self):
+        '''Returns the whole string.'''
+        res = ''.join(self.chunks)
+        self.chunks = res and [res] or []
+        return res
+
 # ------------------------------------------------------------------------------
 class HtmlElement:
     '''Every time an HTML element is encountered during the SAX parsing,
@@ -213,15 +263,15 @@ class HtmlTable:
        the parent buffer, which may be the global buffer or another table
        buffer.'''
     def __init__(self, env):
-        elems = str(time.time()).split('.')
-        self.name= 'AppyTable%s%s%d' % (elems[0],elems[1],random.randint(1,100))
+        self.name = getTableName()
         self.styleNs = env.ns[OdfEnvironment.NS_STYLE]
-        self.res = '' # The sub-buffer
-        self.tempRes = '' # The temporary sub-buffer, into which we will
-        # dump all table sub-elements, until we encounter the end of the first
-        # row. Then, we will know how much columns are defined in the table;
-        # we will dump columns declarations into self.res and dump self.tempRes
-        # into self.res.
+        self.res = OutputBuilder() # The sub-buffer
+        # The temporary sub-buffer, into which we will dump all table
+        # sub-elements, until we encounter the end of the first row. Then, we
+        # will know how much columns are defined in the table; we will dump
+        # columns declarations into self.res and dump self.tempRes into
+        # self.res.
+        self.tempRes = OutputBuilder()
         self.firstRowParsed = False # Was the first table row completely parsed?
         self.nbOfColumns = 0
         # Are we currently within a table cell? Instead of a boolean, the field
@@ -294,8 +344,9 @@ class XhtmlEnvironment(XmlEnvironment):
         XmlEnvironment.__init__(self)
         self.renderer = renderer
         self.ns = renderer.currentParser.env.namespaces
-        self.res = ''
-        self.currentContent = ''
+        self.res = OutputBuilder()
+        # The text content not dumped yet, as a list of non-empty chunks
+        self.currentContent = []
         self.currentElements = [] # Stack of currently walked elements
         self.currentLists = [] # Stack of currently walked lists (ul or ol)
         self.currentTables = [] # Stack of currently walked tables
@@ -331,25 +382,26 @@ class XhtmlEnvironment(XmlEnvironment):
         '''Dumps content that was temporarily stored in self.currentContent
            into the result.'''
         contentSize = 0
+        content = ''.join(self.currentContent)
+        self.currentContent = []
         # Remove the trailing whitespace if needed
         if place == 'start':
-            if self.currentContent.endswith(' ') and \
+            if content.endswith(' ') and \
                ((elem not in INNER_TAGS) or (elem == 'br')):
-                self.currentContent = self.currentContent[:-1]
+                content = content[:-1]
         # Remove the leading whitespace if needed
-        if self.currentContent.startswith(' '):
+        if content.startswith(' '):
             if not self.lastElem or \
                ((self.lastElem not in INNER_TAGS) or (self.lastElem == 'br')):
-                self.currentContent = self.currentContent[1:]
-        if self.currentContent:
+                content = content[1:]
+        if content:
             # Manage missing elements
             currentElem = self.getCurrentElement()
             if self.anElementIsMissing(currentElem, None):
                 currentElem.addInnerParagraph(self)
-            # Dump and reinitialize the current content
-            contentSize = len(self.currentContent)
-            self.dumpString(escapeXml(self.currentContent))
-            self.currentContent = ''
+            # Dump the current content
+            contentSize = len(content)
+            self.dumpString(escapeXml(content))
         # If we are within a table cell, update the total size of cell content
         if not contentSize: return
         if self.currentTables and self.currentTables[-1].inCell:
@@ -399,7 +451,7 @@ class XhtmlEnvironment(XmlEnvironment):
         if self.res.endswith(startTags):
             # In this case I would dump an empty (series of) tag(s). Instead, I
             # will remove those tags.
-            self.res = self.res[:-len(startTags)]
+            self.res.retract(len(startTags))
         else:
             self.dumpString(self.getTags(conflictElems, start=False))
 
@@ -411,11 +463,11 @@ class XhtmlEnvironment(XmlEnvironment):
         if self.currentTables:
             currentTable = self.currentTables[-1]
             if (not currentTable.res) or currentTable.firstRowParsed:
-                currentTable.res += s
+                currentTable.res.write(s)
             else:
-                currentTable.tempRes += s
+                currentTable.tempRes.write(s)
         else:
-            self.res += s
+            self.res.write(s)
 
     def getTagsToReopen(self, conflictElems):
         '''Normally, tags to reopen are equal to p_conflictElems. But we have a
@@ -484,7 +536,7 @@ class XhtmlEnvironment(XmlEnvironment):
             # Computes the column styles required by the table
             table.computeColumnStyles(self.parser.caller.renderer)
             # Dumps the content of the last parsed table into the parent buffer
-            self.dumpString(table.res)
+            self.dumpString(table.res.getValue())
             # Remove cell-paragraph from local styles mapping if it was added
             map = self.parser.caller.localStylesMapping
             if not self.currentTables and ('p' in map):
@@ -500,10 +552,10 @@ class XhtmlEnvironment(XmlEnvironment):
                 # First row is parsed. I know the number of columns in the
                 # table: I can dump the columns declarations.
                 for i in range(1, table.nbOfColumns + 1):
-                    table.res+= '<%s:table-column %s:style-name="%s.%d"/>' % \
-                                (self.tableNs, self.tableNs, table.name, i)
-                table.res += table.tempRes
-                table.tempRes = ''
+                    table.res.write('<%s:table-column %s:style-name="%s.%d"/>'%\
+                                    (self.tableNs, self.tableNs, table.name, i))
+                table.res.write(table.tempRes.getValue())
+                table.tempRes = OutputBuilder()
         elif elem in TABLE_CELL_TAGS:
             # Update attr "columnContentSizes" of the currently parsed table,
             # excepted if the cell spans several columns.
@@ -601,7 +653,7 @@ class XhtmlParser(XmlParser):
             startTag = e.getTags((currentElem,), start=True)
         if currentElem.isConflictual and e.res.endswith(startTag):
             # We will not dump it, it would constitute a silly empty tag.
-            e.res = e.res[:-len(startTag)]
+            e.res.retract(len(startTag))
         else:
             # Dump the end tag. But dump some additional stuff if required.
             if elem in XHTML_LISTS:
@@ -619,7 +671,12 @@ class XhtmlParser(XmlParser):
     def characters(self, content):
         e = XmlParser.characters(self, content)
         if e.ignore: return
-        e.currentContent += WhitespaceCruncher.crunch(content, e.currentContent)
+        chunks = e.currentContent
+        # Only the last char of the current content matters for crunching
+        previousIsWhite = bool(chunks) and \
+                          (chunks[-1][-1] in WhitespaceCruncher.allWhitechars)
+        content = WhitespaceCruncher.crunch(content, previousIsWhite)
+        if content: chunks.append(content)
 
 # -------------------------------------------------------------------------------
 class Xhtml2OdtConverter:
@@ -636,9 +693,98 @@ class Xhtml2OdtConverter:
 
     def run(self):
         self.xhtmlParser.parse(self.xhtmlString)
-        return self.xhtmlParser.env.res
+        return self.xhtmlParser.env.res.getValue()
 
     def findStyle(self, elem, attrs=None, classValue=None):
         return self.stylesManager.findStyle(elem, attrs, classValue,
                                             self.localStylesMapping)
 # ------------------------------------------------------------------------------
+class XhtmlCache:
+    '''LRU cache, shared by all renderers, of the ODT chunks produced from
+       XHTML chunks. A chunk converted once is not parsed again, as long as it
+       is converted with the same template styles (the same
+       appy.pod.styles_manager.ParsedStyles instance), styles mappings and
+       namespaces.
+
+       The column styles of the tables it contains, added to the renderer's
+       dynamic styles, are cached with it and added again every time it is
+       reused. Tables are renamed every time, so that every use produces
+       distinct tables and styles. Chunks containing images are never cached:
+       images must be imported into every result.'''
+    # Finds the names of tables generated from XHTML tables
+    tableNameRex = re.compile(r'AppyTable\d+')
+
+    def __init__(self, maxItems=1000, maxSize=20*1024*1024):
+        # The maximum number of entries to keep
+        self.maxItems = maxItems
+        # The maximum size of the cached ODT chunks and styles, in chars
+        self.maxSize = maxSize
+        # The cached entries, as a dict ~{key: (s_chunk, s_styles)}~
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def getMappingKey(stylesMapping):
+        '''Returns a hashable representation of p_stylesMapping, as given to
+           the renderer.'''
+        if not stylesMapping: return ()
+        return tuple(sorted(stylesMapping.items()))
+
+    def getKey(self, renderer, xhtml, stylesMapping):
+        '''Returns the key under which the conversion of p_xhtml, by
+           p_renderer, with this local p_stylesMapping, is cached, or None if
+           it can't be cached.'''
+        if '<img' in xhtml.lower(): return
+        namespaces = renderer.currentParser.env.namespaces
+        return (hashlib.sha1(xhtml.encode('utf-8')).hexdigest(),
+                renderer.stylesManager.parsed, renderer.stylesMappingKey,
+                self.getMappingKey(stylesMapping),
+                tuple(sorted(namespaces.items())))
+
+    def get(self, key, renderer):
+        '''Returns the ODT chunk cached at p_key, after having added its
+           dynamic styles to p_renderer, or None if it is not in the cache.'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return
+            self.hits += 1
+            self.entries.move_to_end(key)
+        chunk, styles = entry
+        if not styles: return chunk
+        # Give new names to the tables and to their column styles
+        names = {}
+        rename = lambda match: names.setdefault(match.group(0),getTableName())
+        renderer.dynamicStyles.append(self.tableNameRex.sub(rename, styles))
+        return self.tableNameRex.sub(rename, chunk)
+
+    def set(self, key, chunk, styles):
+        '''Caches this ODT p_chunk and its dynamic p_styles at p_key.'''
+        size = len(chunk) + len(styles)
+        if size > self.maxSize: return
+        with self.lock:
+            if key in self.entries: self.remove(key)
+            self.entries[key] = (chunk, styles)
+            self.size += size
+            # Remove the least recently used entries when limits are exceeded
+            while (len(self.entries) > self.maxItems) or \
+                  (self.size > self.maxSize):
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        '''Removes the entry stored at p_key.'''
+        chunk, styles = self.entries.pop(key)
+        self.size -= len(chunk) + len(styles)
+
+    def clear(self):
+        '''Empties the cache.'''
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+# The cache used by renderers
+xhtmlCache = XhtmlCache()
+# ------------------------------------------------------------------------------
@@ -128,7 +128,7 @@ class Resource:
        through HTTP.'''
 
     def __init__(self, url, username=None, password=None, measure=False,
-                 utf8=True):
+                 utf8=True, keepAlive=False):
         self.username = username
         self.password = password
         self.url = url
@@ -151,6 +151,11 @@ class Resource:
         # resource (like a cookie), you can store them in the following dict.
         self.headers = {'Host': self.host}
         self.utf8 = utf8
+        # If p_keepAlive is True, the connection to the server is kept open and
+        # reused by the next requests sent through this resource object, to
+        # any URI on the same server.
+        self.keepAlive = keepAlive
+        self.conn = None
 
     def __repr__(self):
         return '<Dav resource at %s>' % self.url
@@ -164,12 +169,16 @@ class Resource:
         headers['Authorization'] = "Basic %s" % b64encode(credentials.encode()).decode()
         headers['User-Agent'] = 'Appy'
         headers['Host'] = self.host
-        headers['Connection'] = 'close'
+        # A kept-alive connection must not be closed by the server
+        if not self.keepAlive: headers['Connection'] = 'close'
         headers['Accept'] = '*/*'
         return headers
 
-    def send(self, method, uri, body=None, headers={}, bodyType=None):
-        '''Sends a HTTP request with p_method, for p_uri.'''
+    def getConnection(self):
+        '''Returns a tuple (connection, b_reused): the connection to the
+           server is a new one, or the kept-alive one if p_self.keepAlive is
+           True.'''
+        if self.conn: return self.conn, True
         conn = http.client.HTTPConnection(self.host, self.port)
         try:
             conn.connect()
@@ -177,6 +186,30 @@ class Resource:
             raise ResourceError('Check your Internet connection (%s)'% str(sge))
         except socket.error as se:
             raise ResourceError('Connection error (%s)' % str(se))
+        if self.keepAlive: self.conn = conn
+        return conn, False
+
+    def close(self):
+        '''Closes the kept-alive connection, if any.'''
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def send(self, method, uri, body=None, headers={}, bodyType=None):
+        '''Sends a HTTP request with p_method, for p_uri.'''
+        conn, reused = self.getConnection()
+        try:
+            return self.sendOn(conn, method, uri, body, headers, bodyType)
+        except (http.client.HTTPException, socket.error):
+            self.close()
+            if not reused or body: raise
+            # The server has closed the kept-alive connection: retry with a
+            # new one.
+            conn, reused = self.getConnection()
+            return self.sendOn(conn, method, uri, body, headers, bodyType)
+
+    def sendOn(self, conn, method, uri, body, headers, bodyType):
+        '''Sends a HTTP request with p_method, for p_uri, on this p_conn.'''
         # Tell what kind of HTTP request it will be.
         conn.putrequest(method, uri, skip_host=True)
         # Add HTTP headers
@@ -193,7 +226,9 @@ class Resource:
         response = conn.getresponse()
         if self.measure: endTime = time.time()
         body = response.read()
-        conn.close()
+        if not self.keepAlive or response.will_close:
+            conn.close()
+            self.conn = None
         # Return a smart object containing the various parts of the response
         duration = None
         if self.measure:
@@ -212,7 +212,9 @@ class Tester:
                              "Keep the temp folder, in order to be able to " \
                              "copy some results and make them expected " \
                              "results when needed.")
+        self.addOptions(optParser)
         (options, args) = optParser.parse_args()
+        self.options = options
         if self.flavours:
             if len(args) != 1:
                 raise TesterError(WRONG_ARGS % self.flavours)
@@ -221,6 +223,9 @@ class Tester:
                 raise TesterError(WRONG_FLAVOUR % (self.flavour, self.flavours))
         self.verbose = options.verbose == True
         self.keepTemp = options.keepTemp == True
+    def addOptions(self, optParser):
+        '''Sub-classes may add their own options to p_optParser. Their values
+           are in self.options.'''
     def runSuite(self, suite):
         self.report.say('*' * 79)
         self.report.say('* Suite %s.' % suite['Name'])
@@ -673,30 +673,24 @@ class WhitespaceCruncher:
     '''Takes care of removing unnecessary whitespace in several contexts'''
     whitechars = u' \r\t\n' # Chars considered as whitespace
     allWhitechars = whitechars + u' ' # nbsp
+    # Runs of whitechars, and runs of whitechars following a nbsp
+    whiteRex = re.compile(u'[ \r\t\n]+')
+    nbspRex = re.compile(u'\xa0[ \r\t\n]+')
+
     @staticmethod
-    def crunch(s, previous=None):
+    def crunch(s, previousIsWhite=False):
         '''Return a version of p_s (expected to be a unicode string) where all
            "whitechars" are:
            * converted to real whitespace;
            * reduced in such a way that there cannot be 2 consecutive
              whitespace chars.
-           If p_previous is given, those rules must also apply globally to
-           previous+s.'''
-        res = ''
-        # Initialise the previous char
-        if previous:
-            previousChar = previous[-1]
-        else:
-            previousChar = u''
-        for char in s:
-            if char in WhitespaceCruncher.whitechars:
-                # Include the current whitechar in the result if the previous
-                # char is not a whitespace or nbsp.
-                if not previousChar or \
-                   (previousChar not in WhitespaceCruncher.allWhitechars):
-                    res += u' '
-            else: res += char
-            previousChar = char
+           A run of whitechars is thus converted to a single whitespace, or
+           removed if it follows a nbsp. If p_previousIsWhite is True, p_s
+           continues a string whose last char is a whitechar or a nbsp: the
+           run of whitechars starting p_s, if any, is removed, too.'''
+        wc = WhitespaceCruncher
+        res = wc.whiteRex.sub(u' ', wc.nbspRex.sub(u'\xa0', s))
+        if previousIsWhite and s and (s[0] in wc.whitechars): res = res[1:]
         # "res" can be a single whitespace. It is up to the caller method to
         # identify when this single whitespace must be kept or crunched.
         return res
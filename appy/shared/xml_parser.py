@@ -19,6 +19,7 @@
 
 # ------------------------------------------------------------------------------
 import xml.sax, difflib, types, cgi
+from xml.parsers import expat
 from xml.parsers.expat import XML_PARAM_ENTITY_PARSING_NEVER
 from xml.sax.handler import ContentHandler, ErrorHandler, feature_external_ges
 from xml.sax.xmlreader import InputSource
@@ -71,48 +72,60 @@ for k, v in html.entities.entitydefs.items():
     if k not in HTML_ENTITIES and k not in XML_ENTITIES:
         HTML_ENTITIES[k] = ''
 
+# Replacements for escaping XML chars, as tuples (s_char, s_replacement). "&"
+# must come first. We do not escape 'apos': there is no particular need for
+# that.
+XML_REPLACEMENTS = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'),
+                    ('"', '&quot;'))
+XHTML_REPLACEMENTS = XML_REPLACEMENTS + (('\r', ''), ('\n', '<br/>'))
+# For the ODF format, replacements depend on the name of the "text" namespace
+ODF_REPLACEMENTS = {} # ~{s_nsText: replacements}~
+# Strings longer than this are escaped chunk by chunk by m_writeEscapedXml
+ESCAPE_CHUNK = 65536
+
+def getReplacements(format, nsText):
+    '''Returns the replacements to perform for escaping a string in this
+       p_format (see m_escapeXml).'''
+    if format != 'odf': return XML_REPLACEMENTS
+    res = ODF_REPLACEMENTS.get(nsText)
+    if not res:
+        res = XML_REPLACEMENTS + (('\r', ''),
+                                  ('\n', '<%s:line-break/>' % nsText),
+                                  ('\t', '<%s:tab/>' % nsText))
+        ODF_REPLACEMENTS[nsText] = res
+    return res
+
+def replaceChars(s, replacements):
+    '''Performs p_replacements on p_s. Searching a char is much faster than
+       replacing it: most strings, that do not contain any special char, are
+       returned unchanged after a few searches.'''
+    for char, replacement in replacements:
+        if char in s: s = s.replace(char, replacement)
+    return s
+
 def escapeXml(s, format='xml', nsText='text'):
     '''Returns p_s, whose XML special chars have been replaced with escaped XML
        entities. If p_format is "odf", line breaks and tabs are converted to
        their ODF counterparts. In this case, it is needed to give the name of
        the "text" namespace (p_nsText) as defined in the ODF document where the
        line breaks and tabs must be inserted.'''
-    if isinstance(s, str):
-        res = ''
-    else:
-        res = ''
-    odf = format == 'odf'
-    for c in s:
-        if c in XML_SPECIAL_CHARS_NO_APOS:
-            # We do not escape 'apos': there is no particular need for that.
-            res += XML_SPECIAL_CHARS_NO_APOS[c]
-        elif odf and (c == '\n'):
-            res += '<%s:line-break/>' % nsText
-        elif odf and (c == '\t'):
-            res += '<%s:tab/>' % nsText
-        elif odf and (c == '\r'):
-            pass
-        else:
-            res += c
-    return res
+    return replaceChars(s, getReplacements(format, nsText))
+
+def writeEscapedXml(write, s, format='xml', nsText='text'):
+    '''Like m_escapeXml, but, instead of returning the escaped string, passes
+       it to function p_write. A long string is escaped and written chunk by
+       chunk, so its escaped version is never entirely in memory.'''
+    replacements = getReplacements(format, nsText)
+    if len(s) <= ESCAPE_CHUNK:
+        write(replaceChars(s, replacements))
+        return
+    for i in range(0, len(s), ESCAPE_CHUNK):
+        write(replaceChars(s[i:i+ESCAPE_CHUNK], replacements))
 
 def escapeXhtml(s):
     '''Return p_s, whose XHTML special chars and carriage return chars have
        been replaced with corresponding XHTML entities.'''
-    if isinstance(s, str):
-        res = ''
-    else:
-        res = ''
-    for c in s:
-        if c in XML_SPECIAL_CHARS_NO_APOS:
-            res += XML_SPECIAL_CHARS_NO_APOS[c]
-        elif c == '\n':
-            res += '<br/>'
-        elif c == '\r':
-            pass
-        else:
-            res += c
-    return res
+    return replaceChars(s, XHTML_REPLACEMENTS)
 
 # ------------------------------------------------------------------------------
 class XmlElement:
@@ -174,12 +187,28 @@ class XmlEnvironment:
         '''Returns the namespace corresponding to o_nsUri.'''
         return self.namespaces[nsUri]
 
+class ExpatLocator:
+    '''Locator giving the current position of a pyexpat parser, like the
+       locator given by xml.sax to its content handlers.'''
+    def __init__(self, parser): self.parser = parser
+    def getLineNumber(self): return self.parser.CurrentLineNumber
+    def getColumnNumber(self): return self.parser.CurrentColumnNumber
+    def getPublicId(self): return None
+    def getSystemId(self): return None
+
 class XmlParser(ContentHandler, ErrorHandler):
     '''Basic expat-based XML parser that does things like :
       - remembering the currently parsed element;
       - managing namespace declarations.
       This parser also knows about HTML entities.'''
-    def __init__(self, env=None, caller=None, raiseOnError=True):
+    # The available backends. With "sax", parsing is performed by xml.sax and
+    # attributes are given to m_startElement as xml.sax AttributesImpl
+    # instances. With "expat", this parser's methods are directly called by
+    # pyexpat, without the xml.sax layer: attributes are given as dicts.
+    backends = ('sax', 'expat')
+
+    def __init__(self, env=None, caller=None, raiseOnError=True,
+                 backend='sax'):
         '''p_env should be an instance of a class that inherits from
            XmlEnvironment: it specifies the environment to use for this SAX
            parser.'''
@@ -192,9 +221,12 @@ class XmlParser(ContentHandler, ErrorHandler):
         self.res = None # The result of parsing.
         # Raise or not an error when a parsing error is encountered.
         self.raiseOnError = raiseOnError
+        # The backend to use (see attribute "backends")
+        self.backend = backend
 
     # ContentHandler methods ---------------------------------------------------
     def startDocument(self):
+        if self.backend != 'sax': return
         parser = self.parser._parser
         parser.UseForeignDTD(True)
         parser.SetParamEntityParsing(XML_PARAM_ENTITY_PARSING_NEVER)
@@ -247,12 +279,14 @@ class XmlParser(ContentHandler, ErrorHandler):
         '''
         from io import BytesIO
         self._xml = xml
+        if self.backend == 'expat': return self.parseWithExpat(xml, source)
         self.parser.setContentHandler(self)
         self.parser.setErrorHandler(self)
         self.parser.setFeature(feature_external_ges, False)
         inputSource = InputSource()
         if source == 'string':
-            inputSource.setByteStream(BytesIO(xml.encode('utf-8')))
+            if isinstance(xml, str): xml = xml.encode('utf-8')
+            inputSource.setByteStream(BytesIO(xml))
         else:
             if isinstance(xml, str):
                 xml = open(xml,'rb')
@@ -261,6 +295,40 @@ class XmlParser(ContentHandler, ErrorHandler):
         if hasattr(xml, 'close'): xml.close()
         return self.res
 
+    def skippedExpatEntity(self, name, isParameterEntity):
+        if isParameterEntity: name = '%' + name
+        self.skippedEntity(name)
+
+    def parseWithExpat(self, xml, source='string'):
+        '''Parses p_xml (see m_parse) with pyexpat, that directly calls this
+           parser's methods. If p_xml is a string, it can be given as bytes,
+           avoiding to encode it.'''
+        parser = expat.ParserCreate()
+        parser.UseForeignDTD(True)
+        parser.SetParamEntityParsing(XML_PARAM_ENTITY_PARSING_NEVER)
+        # Get text in a single call, instead of one call per line
+        parser.buffer_text = True
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.characters
+        parser.SkippedEntityHandler = self.skippedExpatEntity
+        locator = ExpatLocator(parser)
+        self.setDocumentLocator(locator)
+        self.startDocument()
+        if source != 'string' and isinstance(xml, str): xml = open(xml, 'rb')
+        try:
+            if source == 'string':
+                parser.Parse(xml, True)
+            else:
+                parser.ParseFile(xml)
+        except expat.ExpatError as e:
+            self.fatalError(SAXParseException(expat.ErrorString(e.code), e,
+                                              locator))
+        finally:
+            if hasattr(xml, 'close'): xml.close()
+        self.endDocument()
+        return self.res
+
 # ------------------------------------------------------------------------------
 from appy.shared import UnmarshalledFile
 from appy import Object
@@ -1,9 +1,13 @@
 '''Functions for (un)zipping files'''
 
 # ------------------------------------------------------------------------------
-import os, os.path, zipfile, time
+import os, os.path, zipfile, time, struct, zlib, io
 from appy.shared import mimeTypes
 
+# Extensions of files whose content is already compressed: compressing them
+# again would cost CPU time for (almost) nothing, so they are stored as is.
+compressedExtensions = ('png', 'jpg', 'jpeg', 'gif')
+
 # ------------------------------------------------------------------------------
 def unzip(f, folder, odf=False):
     '''Unzips file p_f into p_folder. p_f can be any anything accepted by the
@@ -90,4 +94,137 @@ def zip(f, folder, odf=False):
             zInfo.external_attr = 48
             zipFile.writestr(zInfo, '')
     zipFile.close()
+
+# ------------------------------------------------------------------------------
+class ZipMember:
+    '''A file from a zip archive, kept in its compressed form: it can be copied
+       into another zip archive without being decompressed and compressed
+       again.'''
+    def __init__(self, info, raw, content=None):
+        self.name = info.filename
+        # The zipfile.ZipInfo instance describing this member
+        self.info = info
+        # The compressed bytes. None if the member uses a compression method
+        # that is not supported for raw copies: in that case, the uncompressed
+        # content is in p_content.
+        self.raw = raw
+        self.content = content
+
+    def isFolder(self):
+        return self.name.endswith('/') or self.name.endswith(os.sep)
+
+    def read(self):
+        '''Returns the uncompressed content of this member.'''
+        if self.raw is None: return self.content
+        if self.info.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(self.raw, -15)
+        return self.raw
+
+    def getSize(self):
+        '''Returns the size of this member in memory.'''
+        if self.raw is None: return len(self.content)
+        return len(self.raw)
+
+def readMembers(f):
+    '''Returns the list of the files from zip file p_f (anything accepted by
+       the zipfile.ZipFile constructor), as ZipMember instances.'''
+    zipFile = zipfile.ZipFile(f)
+    res = []
+    fp = zipFile.fp
+    for info in zipFile.infolist():
+        if (info.compress_type not in (zipfile.ZIP_STORED,
+            zipfile.ZIP_DEFLATED)) or (info.flag_bits & 0x1):
+            # Unsupported compression method or encrypted member
+            res.append(ZipMember(info, None, zipFile.read(info)))
+            continue
+        # Skip the local file header: its variable-length name and extra
+        # field may differ from the ones in the central directory.
+        fp.seek(info.header_offset)
+        header = fp.read(30)
+        nameLength, extraLength = struct.unpack('<HH', header[26:30])
+        fp.seek(nameLength + extraLength, 1)
+        res.append(ZipMember(info, fp.read(info.compress_size)))
+    zipFile.close()
+    return res
+
+# ------------------------------------------------------------------------------
+class ZipWriter:
+    '''Produces a zip file by streaming files into it, copying members of
+       other zip files without recompressing them.'''
+    def __init__(self, f):
+        # p_f is a file name or a binary file-like object
+        self.f = f
+        self.zipFile = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+        self.names = set()
+
+    def getCompressType(self, name):
+        '''Returns the compression method for the file named p_name.'''
+        ext = os.path.splitext(name)[1][1:].lower()
+        if ext in compressedExtensions: return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def writeMember(self, member):
+        '''Copies p_member, a ZipMember instance, as is.'''
+        if member.raw is None:
+            self.write(member.name, member.content)
+            return
+        source = member.info
+        info = zipfile.ZipInfo(member.name, source.date_time)
+        info.compress_type = source.compress_type
+        info.external_attr = source.external_attr
+        info.create_system = source.create_system
+        info.CRC = source.CRC
+        info.compress_size = source.compress_size
+        info.file_size = source.file_size
+        # Sizes and CRC are known: there is no data descriptor to write. Only
+        # keep the flag indicating that the name is encoded in UTF-8.
+        info.flag_bits = source.flag_bits & 0x800
+        zipFile = self.zipFile
+        # The zipfile module has no public API for writing already compressed
+        # data: do it the way ZipFile.writestr does.
+        fp = zipFile.fp
+        info.header_offset = fp.tell()
+        fp.write(info.FileHeader())
+        fp.write(member.raw)
+        zipFile.filelist.append(info)
+        zipFile.NameToInfo[info.filename] = info
+        zipFile.start_dir = fp.tell()
+        self.names.add(member.name)
+
+    def write(self, name, content, compressType=None):
+        '''Writes, in an entry named p_name, p_content, being bytes or a
+           string.'''
+        if isinstance(name, zipfile.ZipInfo):
+            self.zipFile.writestr(name, content)
+            self.names.add(name.filename)
+            return
+        if compressType is None: compressType = self.getCompressType(name)
+        self.zipFile.writestr(name, content, compressType)
+        self.names.add(name)
+
+    def writeFile(self, path, name):
+        '''Streams the file at p_path into an entry named p_name.'''
+        self.zipFile.write(path, name, self.getCompressType(name))
+        self.names.add(name)
+
+    def open(self, name, binary=False):
+        '''Opens, for writing text (or bytes if p_binary is True), an entry
+           named p_name. Writing into the zip file is not possible until the
+           returned object is closed.'''
+        self.names.add(name)
+        res = self.zipFile.open(name, 'w')
+        if binary: return res
+        return io.TextIOWrapper(res, encoding='utf-8')
+
+    def writeFolder(self, folder):
+        '''Adds the files from p_folder not being already in the zip file.'''
+        for dir, dirnames, filenames in os.walk(folder):
+            folderName = os.path.relpath(dir, folder)
+            for name in filenames:
+                if folderName != '.': name = '%s/%s' % (folderName, name)
+                name = name.replace(os.sep, '/')
+                if name in self.names: continue
+                self.writeFile(os.path.join(folder, name), name)
+
+    def close(self): self.zipFile.close()
 # ------------------------------------------------------------------------------